@@ -12,12 +12,14 @@ Description: Compare two data sets produced
 """
 
 import os
+import sys
 import argparse
 import sqlite3
 import itertools
 
 import tapir
 import tapir.rfunctions
+from tapir.db import get_threshold, get_threshold_clause
 
 from rpy2 import robjects
 from rpy2.rinterface import RRuntimeError
@@ -64,6 +66,9 @@ def get_args():
     parser.add_argument('--height', help="Figure height, in inches", default=6,
         type=float)
     parser.add_argument('--dpi', help="Figure dpi", default = 150, type=int)
+    parser.add_argument('--threshold', help="""The informativeness threshold
+        to compare, if the databases hold PI at several""", default=None,
+        type=int)
     args = parser.parse_args()
 
     # factor out the common prefix in database names
@@ -88,26 +93,30 @@ def order_intervals(intervals):
     sorted_intervals = [e[k] for k in ky]
     return "c{0}".format(tuple(sorted_intervals))
 
-def get_interval_query(interval, locus_table, interval_table, name, rows):
+def get_interval_query(interval, locus_table, interval_table, name, rows,
+        threshold):
     if rows == 'all':
         qry = '''"SELECT {0}.locus, interval, pi, '{3}' as db FROM {0}, {1} 
-            WHERE {0}.id = {1}.id and interval='{2}' ORDER BY 
+            WHERE {0}.id = {1}.id and interval='{2}' and {5} ORDER BY 
             pi DESC"'''.format(locus_table,
-            interval_table, interval, name, rows)
+            interval_table, interval, name, rows,
+            get_threshold_clause(threshold))
     else:
         qry = '''"SELECT {0}.locus, interval, pi, '{3}' as db FROM {0}, {1} 
-            WHERE {0}.id = {1}.id and interval='{2}' ORDER BY 
+            WHERE {0}.id = {1}.id and interval='{2}' and {5} ORDER BY 
             pi DESC limit {4}"'''.format(locus_table,
-            interval_table, interval, name, rows)
+            interval_table, interval, name, rows,
+            get_threshold_clause(threshold))
     return qry
 
-def get_r_data_by_top(locus_table, interval_table, intervals, names, rows):
+def get_r_data_by_top(locus_table, interval_table, intervals, names, rows,
+        thresholds):
     # it is faster here to iterate over intervals rather than try and do this
     # with a single query.
     for con, name in names.iteritems():
         for k, interval in enumerate(intervals):
             qry = get_interval_query(interval, locus_table, interval_table,
-                name, rows)
+                name, rows, thresholds[con])
             robjects.r('''con{0}_data{1} <- dbGetQuery(con{0}, {2})'''.format(
                 con, k, qry))
     # prepare string for binding data sets into single stack
@@ -117,9 +126,10 @@ def get_r_data_by_top(locus_table, interval_table, intervals, names, rows):
     frame = robjects.r('''data <- rbind({})'''.format(d_string))
     return frame
 
-def compare_mean_boxplot(locus_table, interval_table, intervals, loci, names, rows):
+def compare_mean_boxplot(locus_table, interval_table, intervals, loci, names, rows,
+        thresholds):
     frame = get_r_data_by_top(locus_table, interval_table, intervals, names,
-            rows)
+            rows, thresholds)
     if len(intervals) > 1:
         sort_string = '''data$interval <- factor(data$interval, {})'''.format(order_intervals(frame[1]))
         robjects.r(sort_string)
@@ -138,9 +148,9 @@ def compare_mean_boxplot(locus_table, interval_table, intervals, loci, names, ro
     return plot
 
 def compare_sum_barplot(locus_table, interval_table, intervals, loci, names,
-        rows):
+        rows, thresholds):
     frame = get_r_data_by_top(locus_table, interval_table, intervals, names,
-            rows)
+            rows, thresholds)
     #pdb.set_trace()
     frame2 = robjects.r('''agg_data <- aggregate(pi ~ interval + db, data = data, sum)''')
     if len(intervals) > 1:
@@ -164,14 +174,14 @@ def compare_sum_barplot(locus_table, interval_table, intervals, loci, names,
         ggplot2.scale_fill_brewer("database", palette="Blues")
     return plot
 
-def make_plot(args, names):
+def make_plot(args, names, thresholds):
     plots = []
     if args.plot_type == 'compare-mean-boxplot':
         plots.append(compare_mean_boxplot(LOCUS, INTERVAL, args.intervals,
-            args.loci, names, args.top))
+            args.loci, names, args.top, thresholds))
     elif args.plot_type == 'compare-sum-barplot':
         plots.append(compare_sum_barplot(LOCUS, INTERVAL, args.intervals,
-            args.loci, names, args.top))
+            args.loci, names, args.top, thresholds))
     plotter = tapir.rfunctions.setup_plotter(args.output, tapir.get_output_type(args.output),
             args.width, args.height, "in", args.dpi)
     for plot in plots:
@@ -195,6 +205,20 @@ def get_or_check_intervals(args, get=False):
     if get:
         return [str(i[0]) for i in results[0]]
 
+def get_thresholds(args):
+    """Return the threshold to read from each database, keyed like the R
+    connections"""
+    thresholds = {}
+    for idx, db in enumerate(args.db, start=1):
+        con = sqlite3.connect(db)
+        try:
+            thresholds[idx] = get_threshold(con.cursor(), args.threshold)
+        except ValueError as e:
+            sys.exit("\n{0}: {1}".format(db, e))
+        finally:
+            con.close()
+    return thresholds
+
 def main():
     # suppress warnings - this is primarily to suppress scale_fill_brewer being
     # unhappy w/ < 3 factors
@@ -204,6 +228,8 @@ def main():
         args.intervals = get_or_check_intervals(args, get = True)
     else:
         get_or_check_intervals(args)
+    # a database holds a row per locus for each threshold it was computed at
+    thresholds = get_thresholds(args)
     # ggplot2 gets loaded as a module.  here load sqlite
     # and iterface through robjects
     tapir.rfunctions.load_sqlite()
@@ -212,7 +238,7 @@ def main():
     for idx, db in enumerate(args.db, start=1):
         tapir.rfunctions.get_db_conn(db, idx)
         names[idx] = args.db_names[idx - 1] # python starts at 0
-    make_plot(args, names)
+    make_plot(args, names, thresholds)
 
 if __name__ == '__main__':
     main()
@@ -5,23 +5,29 @@ import os
 import sys
 import glob
 import numpy
+import Queue
+import itertools
 import sqlite3
+import threading
 import argparse
 
-from subprocess import Popen, PIPE
-
 import tapir
 
 
 import pdb
 
+# the supermatrix, read once and shared with (forked) workers
+SUPERMATRIX = {}
+
 def get_args():
     """Get CLI arguments and options"""
     parser = argparse.ArgumentParser(description="""tapir:  compute the
             phylogenetic informativeness of DNA loci""")
 
-    parser.add_argument('alignments', help="The folder of alignments",
-        action=tapir.FullPaths, type=tapir.is_dir)
+    parser.add_argument('alignments', help="""The folder of alignments
+        (NEXUS, FASTA, or PHYLIP, optionally gzipped), a manifest file listing
+        them, or a single alignment with --supermatrix""", action=tapir.FullPaths,
+        type=tapir.is_dir_or_file)
     parser.add_argument('tree', help="The input tree", action=tapir.FullPaths)
 
     required = parser.add_argument_group("required arguments")
@@ -37,20 +43,122 @@ def get_args():
         default=os.getcwd(), action=tapir.FullPaths, type=tapir.is_dir)
     parser.add_argument('--hyphy', help="The path to hyphy (if not in $PATH)",
         default="hyphy2")
+    parser.add_argument('--hyphy-timeout', help="""Kill a hyphy job that
+        runs longer than this many seconds""", default=None, type=float,
+        dest='hyphy_timeout')
+    parser.add_argument('--hyphy-retries', help="""Number of times to retry a
+        hyphy job that fails or times out""", default=1, type=int,
+        dest='hyphy_retries')
+    parser.add_argument('--rate-engine', help="""Estimate site rates with
+        hyphy (hyphy), or in-process with numpy (numpy), by maximum likelihood
+        under GTR (or F81, if --model is JC or F81) on the corrected tree""",
+        choices=['hyphy', 'numpy'], default='hyphy', dest='rate_engine')
+    parser.add_argument('--no-prune', help="""Send every locus the full
+        tree, rather than the tree pruned to the taxa in its alignment""",
+        default=False, action='store_true', dest='no_prune')
     parser.add_argument('--template', help="""Path to the hypy
         temlate file if in non-standard location""", default = None,)
+    parser.add_argument('--model', help="""Restrict the hyphy model search to
+        a comma-separated list of models (JC, F81, HKY, TrN, GTR, or hyphy
+        model strings such as 010010).  The default fits all 203 reversible
+        models""", default='all', type=tapir.get_models)
+    parser.add_argument('--reuse-models', help="""Restrict the model search
+        for each locus to the model chosen for it in this (earlier) tapir
+        database""", default=None, action=tapir.FullPaths,
+        dest='reuse_models')
+    parser.add_argument('--batch-size', help="""Number of loci to send to
+        each hyphy process (using the batch template)""", default=1, type=int,
+        dest='batch_size')
+    parser.add_argument('--batch-template', help="""Path to the hyphy batch
+        template file if in non-standard location""", default=None,
+        dest='batch_template')
     parser.add_argument('--threshold', help="""Minimum number of taxa without
-        a gap for a site to be considered informative""", default=3, type=int)
+        a gap for a site to be considered informative.  Give a comma-separated
+        list to compute PI at several thresholds""", default=[3],
+        type=tapir.get_list_from_ints)
     parser.add_argument('--multiprocessing', help="""Enable parallel
         calculation of rates""", default=False, action='store_true')
+    parser.add_argument('--cores', help="""Number of worker processes
+        (implies --multiprocessing; default is one fewer than the number of
+        CPUs)""", default=None, type=int)
+    parser.add_argument('--hyphy-jobs', help="""Number of hyphy processes
+        to run at once (default is --cores)""", default=None, type=int,
+        dest='hyphy_jobs')
+    parser.add_argument('--max-pending', help="""Maximum number of loci
+        queued between each stage at any time (default is twice --cores)""",
+        default=None, type=int, dest='max_pending')
     parser.add_argument('--site-rates', default=False, action='store_true',
         help="Use previously calculated site rates")
-    parser.add_argument('--subset-pi-map-file', help="""Calculate PI for a
-        subset of sites. If specified, this should be a tab-delimited file
+    parser.add_argument('--max-memory', help="""Memory ceiling (MB) for the
+        blocks used to compute PI across times and sites""", default=4.,
+        type=float, dest='max_memory')
+    parser.add_argument('--engine', help="""Compute PI site-by-site (site) or
+        once per unique site rate (unique)""", choices=['site', 'unique'],
+        default='site')
+    parser.add_argument('--rate-tolerance', help="""With --engine unique, bin
+        site rates so each is within this relative error of its bin""",
+        default=0., type=float, dest='rate_tolerance')
+    parser.add_argument('--cache-dir', help="""Directory in which to cache
+        hyphy site rates across runs""", default=tapir.get_default_cache_dir(),
+        action=tapir.FullPaths, dest='cache_dir')
+    parser.add_argument('--no-cache', help="""Do not read or write cached
+        hyphy site rates""", default=False, action='store_true',
+        dest='no_cache')
+    parser.add_argument('--cache-max-size', help="""Maximum size (MB) of the
+        site-rate cache""", default=1024., type=float, dest='cache_max_size')
+    parser.add_argument('--cache-max-age', help="""Maximum age (days) of
+        entries in the site-rate cache""", default=90., type=float,
+        dest='cache_max_age')
+    parser.add_argument('--resume', help="""Store each locus as it finishes
+        and, when restarting in the same output directory, skip loci already
+        in the database""", default=False, action='store_true')
+    parser.add_argument('--supermatrix', help="""Treat `alignments` as a
+        single concatenated alignment, and compute PI for each of its
+        charsets""", default=False, action='store_true')
+    parser.add_argument('--charsets', help="""A file of NEXUS charsets
+        defining the loci in the supermatrix (default is the sets block of the
+        supermatrix)""", default=None, action=tapir.FullPaths)
+    parser.add_argument('--subset-pi-map-file', help="""Calculate PI for
+        subsets of sites. If specified, this should be a tab-delimited file
         with the alignment file name in the 1st column, the start of the
-        interval (0-offset) in the 2nd column, and the end of the interval in
-        the 3rd column.""")
-    return parser.parse_args()
+        interval (0-offset) in the 2nd column, the end of the interval in
+        the 3rd column, and, optionally, a name for the subset in the 4th
+        column.  An alignment may have any number of subsets.""")
+    parser.add_argument('--window', help="""Calculate PI for sliding windows
+        of SIZE sites every STEP sites (default STEP is SIZE) along each
+        alignment, given as SIZE or SIZE,STEP""", default=None,
+        type=tapir.get_window)
+    parser.add_argument('--stride', help="""Also calculate PI for every
+        STRIDE-th site, starting at each of the first STRIDE sites (e.g. 3
+        for codon positions)""", default=None, type=int)
+    parser.add_argument('--compact-net', help="""Store the net PI of each locus
+        as a single blob of float32 or float64 values, rather than a row per
+        time.  A `net` view presents the blobs as rows""", default=None,
+        choices=['float32', 'float64'], dest='compact_net')
+    parser.add_argument('--store-rates', help="""Also store the site rates of
+        each locus (needs --compact-net)""", default=False,
+        action='store_true', dest='store_rates')
+    parser.add_argument('--npy-store', help="""Also write net PI, PI at the
+        times of interest, and PI over the intervals as loci x time matrices
+        in .npy files (that open as memory maps) alongside the database""",
+        default=False, action='store_true', dest='npy_store')
+    parser.add_argument('--shard', help="""Compute PI for only the I-th of N
+        shards of the loci (e.g. 3/10), of about equal total size, for cluster
+        array jobs""", default=None, type=tapir.get_shard_spec)
+    args = parser.parse_args()
+    if args.store_rates and not args.compact_net:
+        parser.error("--store-rates needs --compact-net")
+    if args.stride is not None and args.stride < 1:
+        parser.error("--stride must be at least 1")
+    if args.supermatrix and not os.path.isfile(args.alignments):
+        parser.error("--supermatrix needs an alignment file")
+    if not args.supermatrix and os.path.isfile(args.alignments) and \
+            (tapir.get_format(args.alignments) or
+            args.alignments.endswith('.rates')):
+        parser.error("{0} is not a folder or a manifest (use --supermatrix "
+            "to compute PI for the charsets of an alignment)".format(
+            args.alignments))
+    return args
 
 def welcome_message():
     return '''
@@ -81,54 +189,278 @@ def welcome_message():
     *                                                 *
     ***************************************************\n\n'''
 
-def worker(params):
-    #pdb.set_trace()
-    time_vector, hyphy, template, towrite, output, correction, alignment, times, epochs, threshold, subsets = params
-    # if twowrite is set, run hyphy, else, we've sent site rates
-    sys.stdout.write(".")
-    sys.stdout.flush()
-    if towrite:
-        try:
-            hyphy = Popen([hyphy, template], stdin=PIPE, stdout=PIPE)
-        except OSError as e:
-            if e.errno == 2:
-                raise Exception("hyphy not found")
-            raise Exception("couldn't communicate with hyphy: {0}".format(e))
-        stdout, stderr = hyphy.communicate(towrite)
-        if stdout.startswith("Error"):
-            raise Exception("hyphy error: {0}".format(stdout))
-        rates = tapir.parse_site_rates(output, correction = correction)
-        good_sites = tapir.get_informative_sites(alignment, threshold)
-        rates = tapir.cull_uninformative_rates(rates, good_sites)
+def prepare_inputs(batch):
+    """Point each locus in the batch at a copy of the tree pruned to its taxa
+    and, for hyphy, at an uncompressed copy of its alignment"""
+    for params in batch:
+        towrite, settings = params[3], params[7]
+        if not towrite:
+            continue
+        alignment, tree, output, models = towrite.split("\n")
+        if settings['prune']:
+            taxa = tapir.get_alignment(alignment)[0]
+            tree = tapir.prune_tree(tree, taxa)
+        if settings['rate_engine'] == 'hyphy':
+            # hyphy can't read gzipped alignments
+            alignment = tapir.get_uncompressed(alignment,
+                os.path.dirname(output))
+        params[3] = "\n".join([alignment, tree, output, models])
+
+def estimate_rates(batch):
+    """HyPhy stage: write the site rates for a batch of loci (unless we've been
+    sent site rates already)"""
+    settings = batch[0][7]
+    if settings['partition']:
+        # the supermatrix was rated once, up front
+        return batch
+    prepare_inputs(batch)
+    if settings['rate_engine'] == 'numpy':
+        # rates are estimated in the PI stage, without hyphy
+        return batch
+    # loci are run together when they share a (pruned) tree
+    jobs, keys, trees = {}, {}, []
+    for params in batch:
+        time_vector, hyphy, template, towrite, output, correction, alignment, settings = params
+        # if twowrite is set, run hyphy, else, we've sent site rates
+        if not towrite:
+            continue
+        # towrite holds the lines hyphy reads: alignment, tree, output, models
+        alignment, tree, output, models = towrite.split("\n")
+        cache = settings['cache']
+        key = None
+        if cache:
+            key = tapir.get_cache_key(alignment, tree, template,
+                cache['version'], models)
+            if tapir.get_cached_rates(cache['dir'], key, output):
+                continue
+        if tree not in jobs:
+            trees.append(tree)
+            jobs[tree], keys[tree] = [], []
+        jobs[tree].append((towrite, (alignment, output, models)))
+        keys[tree].append(key)
+    for tree in trees:
+        if len(jobs[tree]) == 1:
+            towrite, (alignment, output, models) = jobs[tree][0]
+            tapir.run_hyphy(hyphy, template, towrite, output,
+                settings['hyphy_timeout'], settings['hyphy_retries'])
+        else:
+            # one hyphy process for the whole batch
+            tapir.run_hyphy_batch(hyphy, settings['batch_template'], template,
+                tree, [job for towrite, job in jobs[tree]],
+                settings['hyphy_timeout'], settings['hyphy_retries'])
+        if settings['cache']:
+            for (towrite, (alignment, output, models)), key in zip(jobs[tree],
+                    keys[tree]):
+                tapir.put_cached_rates(settings['cache']['dir'], key, output)
+    return batch
+
+def iter_folder(path, extension):
+    """Yield the files in a folder as it is read, exiting if there are none"""
+    found = False
+    for f in tapir.iter_files(path, extension):
+        found = True
+        yield f
+    if not found:
+        sys.exit("\n{0}".format(tapir.get_no_files_error(path, extension)))
+
+def get_inputs(path, extension, subsets):
+    """Return the files in a folder (as it is read) or listed in a manifest,
+    adding any subsets the manifest gives to `subsets`"""
+    if os.path.isdir(path):
+        return iter_folder(path, extension)
+    try:
+        files, manifest_subsets = tapir.get_manifest(path)
+    except (IOError, ValueError) as e:
+        sys.exit("\n{0}".format(e))
+    for name, items in manifest_subsets.iteritems():
+        subsets.setdefault(name, []).extend(items)
+    return files
+
+def get_shard(params, shard, supermatrix = False):
+    """Return the loci in a shard, balanced by alignment (or charset) size"""
+    index, count = shard
+    if supermatrix:
+        size = lambda p: tapir.get_partition_size(p[7]['partition'][1])
+        name = lambda p: p[7]['partition'][0]
+    else:
+        size = lambda p: tapir.get_file_size(p[6])
+        name = lambda p: p[6]
+    return tapir.get_shard_items(params, index, count, size, name)
+
+def get_supermatrix(path):
+    """Read the supermatrix at `path`, once per process"""
+    if path not in SUPERMATRIX:
+        SUPERMATRIX[path] = tapir.get_alignment(path)
+    return SUPERMATRIX[path]
+
+def get_locus(params):
+    """Return the name under which a locus is stored"""
+    partition = params[7]['partition']
+    if partition:
+        return partition[0]
+    return tapir.get_locus_name(params[6])
+
+def get_rates(params):
+    """Return the site rates for a locus, the number of taxa with a nucleotide
+    at each site (None if we've been sent site rates), and the model the rates
+    were estimated under"""
+    time_vector, hyphy, template, towrite, output, correction, alignment, settings = params
+    if not towrite:
+        # we've been sent site rates
+        return tapir.parse_site_rates(output, correction = correction), None, \
+            None
+    partition = settings['partition']
+    alignment, tree, output, models = towrite.split("\n")
+    if partition:
+        # charsets are views of the supermatrix
+        labels, characters = get_supermatrix(params[6])
+        characters = tapir.get_partition(characters, partition[1])
+    else:
+        labels, characters = tapir.get_alignment(alignment)
+    if settings['rate_engine'] == 'numpy':
+        model = '000000' if set(models.split(',')) == set(['000000']) else '012345'
+        rates = tapir.estimate_array_site_rates(labels, characters, tree,
+            'F81' if model == '000000' else 'GTR', correction)
+    elif partition:
+        # sliced from the supermatrix rates in main
+        rates = settings['partition_rates']
+        model = settings['partition_model']
     else:
         rates = tapir.parse_site_rates(output, correction = correction)
-    alignment_basename = os.path.basename(alignment)
-    # if we are subsetting the rates vector, do so now
-    if os.path.basename(alignment) in subsets:
-        rates = rates[subsets[alignment_basename][0]:subsets[alignment_basename][1]]
+        model = tapir.get_site_rate_model(output)
+    return rates, tapir.get_informative_counts(characters), model
+
+def compute_pi(params):
+    """PI stage: compute PI from the site rates for a locus, once for each
+    informativeness threshold"""
+    time_vector, hyphy, template, towrite, output, correction, alignment, settings = params
+    sys.stdout.write(".")
+    sys.stdout.flush()
+    rates, counts, model = get_rates(params)
+    if settings['partition']:
+        alignment = settings['partition'][0]
+    if counts is None:
+        # site rates we've been sent are used as-is
+        return [get_locus_pi(time_vector, alignment, rates, model, None,
+            settings)]
+    results = []
+    for threshold in settings['threshold']:
+        good_sites = tapir.get_threshold_mask(counts, threshold)
+        results.append(get_locus_pi(time_vector, alignment,
+            tapir.cull_uninformative_rates(rates, good_sites), model,
+            threshold, settings))
+    return results
+
+def get_locus_pi(time_vector, alignment, rates, model, threshold, settings):
+    """Compute PI for the (culled) site rates of a locus"""
+    # any number of site ranges, answered from one prefix-sum index
+    subsets = settings['subsets'].get(os.path.basename(alignment), [])
+    windows = []
+    if settings['window']:
+        windows = tapir.get_windows(len(rates), *settings['window'])
+    pi_subsets = []
+    if subsets or windows:
+        index = tapir.get_site_pi_index(time_vector, rates, settings['times'],
+            settings['epochs'])
+        # subsets from the map file also get their net PI; windows, which
+        # may be many, don't
+        pi_subsets = tapir.get_subset_pi(index, settings['times'],
+            settings['epochs'], subsets, time_vector, rates,
+            settings['max_memory'])
+        pi_subsets.extend(tapir.get_subset_pi(index, settings['times'],
+            settings['epochs'], windows))
     # compute the mean, ensuring we mask the nans.
     mean_rate = numpy.mean(numpy.ma.masked_array(rates, numpy.isnan(rates)))
-    # send column of times and vector of site rates to get_townsend_pi.
-    # Because of structure, we can take advantage of numpy's
-    # elementwise speedup
-    pi = tapir.get_townsend_pi(time_vector, rates)
     # len(rates) gives the number of "#Sites" per PhyDesign website
     # numpy.sum(numpy.isnan(rates)) counts undefined sites
     # numpy.sum(numpy.isfinite(rates)) counts #Rates per PhyDesign website
-    # pdb.set_trace()
-    pi_net = numpy.nansum(pi, axis = 1)
-    pi_times = tapir.get_net_pi_for_periods(pi, times)
-    # remove the numpy.nan records before computing the integral
-    pi_epochs = tapir.get_net_integral_for_epochs(rates[numpy.isfinite(rates)], epochs)
-    return alignment, rates, mean_rate, pi, pi_net, pi_times, pi_epochs
+    # sum PI across sites in blocks, rather than building the full
+    # time x site matrix, and only keep the reductions
+    pi_net, pi_times, pi_epochs = tapir.get_pi_for_rates(time_vector, rates,
+        settings['times'], settings['epochs'], settings['engine'],
+        settings['tolerance'], settings['max_memory'])
+    # and for codon positions (or any stride), from views of the same rates
+    if settings['stride']:
+        pi_subsets.extend(tapir.get_stride_pi(time_vector, rates,
+            settings['times'], settings['epochs'], settings['stride'],
+            settings['engine'], settings['tolerance'], settings['max_memory']))
+    return alignment, rates, mean_rate, pi_net, pi_times, pi_epochs, model, \
+        pi_subsets, threshold
+
+def worker(params):
+    """Run every stage for a single locus"""
+    return compute_pi(estimate_rates([params])[0])
+
+def get_batches(params, size):
+    """Split loci into batches of `size` for the hyphy stage"""
+    return [params[i:i + size] for i in xrange(0, len(params), size)]
+
+def write_results(db_name, results, errors, dtype = None, rates = False,
+        store = None):
+    """Writer stage: store loci as they arrive on the `results` queue, until
+    we receive None.  If `store` is set, loci are also added to the .npy store
+    it describes.  Errors are added to `errors` rather than raised, and the
+    queue is drained regardless, so the main thread never blocks on it"""
+    conn = None
+    done = False
+    try:
+        # sqlite connections belong to the thread that creates them
+        conn, c = tapir.create_probe_db(db_name, resume = True, compact =
+            bool(dtype))
+        if store:
+            store = tapir.open_store_for_writing(c, store['path'],
+                store['time'], store['times'], store['epochs'])
+            conn.commit()
+        # indexes are rebuilt once we're done, rather than updated row by row
+        tapir.drop_indexes(c)
+        while not done:
+            # take whatever has queued up while we were writing, and store it
+            # in a single transaction
+            batch = [results.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(results.get_nowait())
+                except Queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                done = True
+            if errors:
+                # keep draining, so the upstream stages don't block
+                continue
+            try:
+                # each commit holds whole loci (at every threshold), so an
+                # interrupted run can resume
+                for pi in batch:
+                    keys = tapir.insert_pi_data(conn, c, pi, dtype, rates)
+                    if store:
+                        tapir.append_to_store(store, c, keys, pi)
+                conn.commit()
+                if store:
+                    tapir.sync_store(store)
+            except Exception as e:
+                errors.append(e)
+        if store:
+            tapir.close_store(store)
+        if not errors:
+            tapir.finish_probe_db(conn, c)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        # keep draining, so the main thread doesn't block on a full queue
+        while not done:
+            done = results.get() is None
+        if conn is not None:
+            conn.close()
 
 def main():
     """Main loop"""
     args = get_args()
     # print message
     print welcome_message()
-    # make output dir
-    args.output = tapir.create_unique_dir(args.output)
+    # make output dir, unless we're picking up where we left off
+    if not args.resume:
+        args.output = tapir.create_unique_dir(args.output)
     # correct branch lengths
     tree_depth, correction, tree = tapir.correct_branch_lengths(args.tree, args.tree_format, d = args.output)
     # generate a vector of times given start and stops
@@ -136,45 +468,149 @@ def main():
     # get PI subsets if specified
     subset_pi = dict()
     if args.subset_pi_map_file:
-        subset_pi = dict(tapir.parse_subset_map_file(args.subset_pi_map_file))
+        try:
+            subset_pi = tapir.get_subset_map(args.subset_pi_map_file)
+        except ValueError as e:
+            sys.exit("\n{0}".format(e))
     params = []
+    # options shared by every locus
+    settings = {
+            'times':args.times,
+            'epochs':args.intervals,
+            'threshold':args.threshold,
+            'subsets':subset_pi,
+            'max_memory':int(args.max_memory * 2**20),
+            'engine':args.engine,
+            'tolerance':args.rate_tolerance,
+            'cache':None,
+            'hyphy_timeout':args.hyphy_timeout,
+            'hyphy_retries':args.hyphy_retries,
+            'batch_template':args.batch_template or tapir.get_hyphy_batch_conf(),
+            'rate_engine':args.rate_engine,
+            'prune':not args.no_prune,
+            'partition':None,
+            'partition_rates':None,
+            'partition_model':None,
+            'window':args.window,
+            'stride':args.stride,
+        }
     # get path to batch/template file for hyphy
     if not args.template:
         template = tapir.get_hyphy_conf()
     else:
         template = args.template
-    if not args.site_rates:
+    if not (args.site_rates or args.no_cache or args.rate_engine == 'numpy'):
+        settings['cache'] = {
+                'dir':args.cache_dir,
+                'version':tapir.get_hyphy_version(args.hyphy)
+            }
+    reuse = {}
+    if args.reuse_models:
+        reuse = tapir.get_locus_models(args.reuse_models)
+    if args.supermatrix:
+        print "\nEstimating site rates and PI for the charsets of {0}:".format(
+            args.alignments)
+        labels, characters = get_supermatrix(args.alignments)
+        charsets = tapir.get_charsets(args.charsets or args.alignments,
+            characters.shape[1])
+        output = os.path.join(args.output, os.path.basename(args.alignments) + '.rates')
+        towrite = "\n".join([args.alignments, tree, output, args.model])
+        supermatrix = [time_vector, args.hyphy, template, towrite, output,
+            correction, args.alignments, settings]
+        for name, slices in charsets:
+            params.append([time_vector, args.hyphy, template, towrite, output,
+                correction, args.alignments, dict(settings, partition = (name,
+                slices))])
+    elif not args.site_rates:
         print "\nEstimating site rates and PI for files:"
-        for alignment in tapir.get_files(args.alignments, '*.nex,*.nexus'):
+        for alignment in get_inputs(args.alignments,
+                tapir.ALIGNMENT_EXTENSIONS, subset_pi):
             output = os.path.join(args.output, os.path.basename(alignment) + '.rates')
-            towrite = "\n".join([alignment, tree, output])
-            params.append([time_vector, args.hyphy, template, towrite, output, correction, alignment,
-                args.times, args.intervals, args.threshold, subset_pi])
+            # restrict the model search to what we chose last time, if asked
+            models = reuse.get(tapir.get_locus_name(alignment), args.model)
+            towrite = "\n".join([alignment, tree, output, models])
+            params.append([time_vector, args.hyphy, template, towrite, output,
+                correction, alignment, settings])
     else:
         print "Estimating PI for files (--site-rate option):"
-        for rate_file in tapir.get_files(args.alignments, '*.rates'):
+        for rate_file in get_inputs(args.alignments, '*.rates', subset_pi):
             params.append([time_vector, args.hyphy, template, None, rate_file,
-                correction, rate_file, args.times, args.intervals,
-                args.threshold, subset_pi])
-    if not args.multiprocessing:
-        pis = map(worker, params)
-    else:
-        from multiprocessing import Pool, cpu_count
-        pool = Pool(processes = cpu_count() - 1)
-        pis = pool.map(worker, params)
+                correction, rate_file, settings])
+    if args.shard:
+        # before skipping completed loci, so shards don't change on resume
+        params = get_shard(params, args.shard, args.supermatrix)
+        print "Shard {0} of {1}: {2} loci".format(args.shard[0] + 1,
+            args.shard[1], len(params))
     # store results somewhere
     db_name = os.path.join(args.output,
         'phylogenetic-informativeness.sqlite')
-    sys.stdout.write("\nStoring results in {0}...".format(db_name))
-    sys.stdout.flush()
-    conn, c = tapir.create_probe_db(db_name)
-    tapir.insert_pi_data(conn, c, pis)
-    conn.commit()
-    sys.stdout.write("DONE")
-    sys.stdout.flush()
-    print "\n"
+    try:
+        conn, c = tapir.create_probe_db(db_name, resume = args.resume,
+            compact = bool(args.compact_net))
+    except ValueError as e:
+        sys.exit("\n{0}".format(e))
+    if args.resume:
+        completed = tapir.get_completed_loci(c)
+        params = [p for p in params if get_locus(p) not in completed]
+        print "Skipping {0} loci already in {1}".format(len(completed), db_name)
     c.close()
     conn.close()
+    # dispatch the largest alignments first, so they don't straggle at the end
+    if args.supermatrix:
+        params.sort(key = lambda p: tapir.get_partition_size(
+            p[7]['partition'][1]), reverse = True)
+        if params and args.rate_engine == 'hyphy':
+            # rate the whole supermatrix once, then slice rates by charset,
+            # so each charset is sent its slice rather than parsing it all
+            estimate_rates([supermatrix])
+            rates = tapir.parse_site_rates(output, correction = correction)
+            model = tapir.get_site_rate_model(output)
+            for p in params:
+                p[7]['partition_rates'] = numpy.array(tapir.get_partition(rates,
+                    p[7]['partition'][1]))
+                p[7]['partition_model'] = model
+    else:
+        params = tapir.sort_by_size(params, lambda p: p[6])
+    if args.multiprocessing or args.cores:
+        cores = tapir.get_cores(args.cores)
+    else:
+        cores = 1
+    hyphy_jobs = args.hyphy_jobs or cores
+    # run hyphy in threads (it's a subprocess), PI in processes (it's numpy),
+    # and write from a single thread, with bounded queues between them so
+    # hyphy jobs overlap with the python work
+    batches = get_batches(params, max(1, args.batch_size))
+    rated = tapir.imap_threaded(estimate_rates, batches, hyphy_jobs,
+        args.max_pending)
+    rated = itertools.chain.from_iterable(rated)
+    pis = tapir.imap_bounded(compute_pi, rated, cores, args.max_pending)
+    results = Queue.Queue(args.max_pending or 2 * cores)
+    errors = []
+    store = None
+    if args.npy_store:
+        store = {
+                'path':tapir.get_store_path(db_name),
+                'time':time_vector,
+                'times':args.times,
+                'epochs':args.intervals,
+            }
+    writer = threading.Thread(target = write_results, args = (db_name,
+        results, errors, args.compact_net, args.store_rates, store))
+    writer.start()
+    try:
+        for pi in pis:
+            results.put(pi)
+    finally:
+        results.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+    if settings['cache']:
+        tapir.evict_cache(args.cache_dir, args.cache_max_size * 2**20,
+            args.cache_max_age * 86400)
+    sys.stdout.write("\nStored results in {0}".format(db_name))
+    sys.stdout.flush()
+    print "\n"
 
 if __name__ == '__main__':
     main()
@@ -2,6 +2,7 @@
 
 import os
 import re
+import sys
 import collections
 import argparse
 import sqlite3
@@ -13,6 +14,7 @@ import matplotlib.cm as cm
 from matplotlib.backends.backend_pdf import PdfPages
 
 from tapir.base import FullPaths
+from tapir.db import get_net_curves, get_threshold, get_threshold_clause
 
 import pdb
 
@@ -51,6 +53,8 @@ def get_args():
     parser.add_argument('--height', help="figure height, in inches", default=6,
         type=float)
     parser.add_argument('--keep-extension', help="keep the .nex extension in loci names", action="store_true")
+    parser.add_argument('--threshold', help="informativeness threshold to "
+        + "plot, if the database holds PI at several", default=None, type=int)
     return parser.parse_args()
 
 def nice_grid(ax):
@@ -147,10 +151,11 @@ def create_line_plot(data, fig, colors):
     nice_grid(ax)
 
 
-def get_epochs(conn):
+def get_epochs(conn, threshold):
     c = conn.cursor()
     c.execute("""SELECT loci.locus, interval, pi
-                  FROM interval JOIN loci USING (id)""")
+                  FROM interval JOIN loci USING (id)
+                  WHERE {0}""".format(get_threshold_clause(threshold)))
 
     # Rearrange data into the following format:
     # results = {loci1: {epoch1: PI, epoch2: PI, ...}, ...}
@@ -160,15 +165,11 @@ def get_epochs(conn):
         results[loci][epoch] = pi
     return results
 
-def get_net_pi(conn):
-    c = conn.cursor()
-    c.execute("""SELECT loci.locus, time, pi
-                 FROM net JOIN loci USING (id)""")
-
+def get_net_pi(conn, threshold):
+    # reads net PI stored as rows or as blobs
     results = collections.defaultdict(dict)
-    for row in c:
-        loci, mya, pi = list(row)
-        results[loci][mya] = pi
+    for loci, mya, pi in get_net_curves(conn.cursor(), [threshold]):
+        results[loci].update(zip(mya.tolist(), pi.tolist()))
     return results
 
 def rm_ext(dd):
@@ -182,8 +183,13 @@ def rm_ext(dd):
 def main():
     args = get_args()
     conn = sqlite3.connect(args.database)
-    epoch_data = get_epochs(conn)
-    net_pi_data = get_net_pi(conn)
+    # a database holds a row per locus for each threshold it was computed at
+    try:
+        threshold = get_threshold(conn.cursor(), args.threshold)
+    except ValueError as e:
+        sys.exit("\n{0}".format(e))
+    epoch_data = get_epochs(conn, threshold)
+    net_pi_data = get_net_pi(conn, threshold)
 
     if not args.keep_extension:
         epoch_data, net_pi_data = [rm_ext(x) for x in [epoch_data, net_pi_data]]
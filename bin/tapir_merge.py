@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+File: tapir_merge.py
+
+Description: merge the PI databases written by separate (e.g. cluster array)
+runs of tapir_compute.py into one
+
+"""
+
+import os
+import sys
+import sqlite3
+import argparse
+
+import tapir
+
+#import pdb
+
+def get_args():
+    """Get CLI arguments and options"""
+    parser = argparse.ArgumentParser(description="""tapir:  merge PI
+            databases (shards) into one""")
+    parser.add_argument('output', help="""The merged database""",
+        type=tapir.to_full_paths)
+    parser.add_argument('shards', help="""The databases to merge, or folders
+        to search (recursively) for *.sqlite databases""", nargs='+',
+        type=tapir.to_full_paths)
+    parser.add_argument('--resume', help="""Add to an existing merged
+        database, skipping shards already in it""", default=False,
+        action='store_true')
+    parser.add_argument('--cores', help="""Merge groups of shards in
+        parallel, then merge the groups""", default=1, type=int)
+    return parser.parse_args()
+
+def get_shards(paths, output):
+    """Return the databases in `paths`, in order, searching folders"""
+    shards = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for root, dirs, files in os.walk(path):
+                found.extend([os.path.join(root, f) for f in files if
+                    f.endswith('.sqlite')])
+            shards.extend(sorted(found))
+        else:
+            shards.append(path)
+    # don't merge the output (or the parts of it) into itself
+    seen = set([output, output + '-wal', output + '-shm'])
+    unique = []
+    for shard in shards:
+        if shard not in seen and not is_part_name(shard, output):
+            unique.append(shard)
+            seen.add(shard)
+    return unique
+
+def get_part_name(output, k):
+    """Return the name of the k-th part of a parallel merge"""
+    return "{0}.part{1}".format(output, k)
+
+def is_part_name(path, output):
+    """Return True if `path` is a part of a parallel merge into `output`"""
+    prefix = get_part_name(output, '')
+    return path.startswith(prefix) and path[len(prefix):].isdigit()
+
+def remove_database(db_name):
+    """Remove a database and its write-ahead log"""
+    for pth in [db_name, db_name + '-wal', db_name + '-shm']:
+        if os.path.exists(pth):
+            os.remove(pth)
+
+def merge_part(params):
+    """Merge a group of shards into a part of the output"""
+    part, shards = params
+    tapir.merge_databases(part, shards, finish = False)
+    return part
+
+def main():
+    """Main loop"""
+    args = get_args()
+    shards = get_shards(args.shards, args.output)
+    if os.path.exists(args.output):
+        if not args.resume:
+            sys.exit("\n{0} exists (use --resume to add to it)".format(
+                args.output))
+        conn = sqlite3.connect(args.output)
+        done = tapir.get_merged_shards(conn.cursor())
+        conn.commit()
+        conn.close()
+        shards = [s for s in shards if s not in done]
+    try:
+        print "Merging {0} databases into {1}".format(len(shards), args.output)
+        cores = tapir.get_cores(args.cores) if args.cores > 1 else 1
+        if cores > 1 and len(shards) > cores:
+            # a two-level merge: contiguous groups in parallel, so loci keep
+            # the order of the shards, then the groups
+            size = -(-len(shards) // cores)
+            groups = [(get_part_name(args.output, k), shards[i:i + size]) for k, i
+                in enumerate(xrange(0, len(shards), size))]
+            for part, group in groups:
+                # parts from an interrupted run may hold shards merged since
+                remove_database(part)
+            parts = list(tapir.imap_bounded(merge_part, groups, cores))
+            parts.sort(key = lambda part: int(part.rsplit('part', 1)[1]))
+            try:
+                tapir.merge_databases(args.output, parts, resume = True)
+            finally:
+                for part in parts:
+                    remove_database(part)
+        else:
+            tapir.merge_databases(args.output, shards, resume = True)
+    except (IOError, ValueError, sqlite3.IntegrityError) as e:
+        sys.exit("\n{0}".format(e))
+    print "Stored results in {0}\n".format(args.output)
+
+if __name__ == '__main__':
+    main()
@@ -12,12 +12,16 @@ Description: create plots from data in SQLite
 """
 
 import os
+import sys
+import sqlite3
 import argparse
 
 import tapir
 import tapir.rfunctions
+from tapir.db import get_net_curves, get_threshold, get_threshold_clause
 
 from rpy2 import robjects
+import rpy2.rlike.container as rlc
 from rpy2.rinterface import RRuntimeError
 
 try:
@@ -58,13 +62,30 @@ def get_args():
             default = 6.0, type=float)
     parser.add_argument('--dpi', help="Figure dpi", default = 150,
         type=int)
+    parser.add_argument('--threshold', help="The informativeness threshold "
+        + "to plot, if the database holds PI at several", default = None,
+        type=int)
     return parser.parse_args()
 
-def single_locus_net_informativeness(locus_table, net_pi_table, locus):
-    qry = '''"SELECT {0}.locus, time, pi FROM {0}, {1} 
-    WHERE {0}.id = {1}.id AND locus = '{2}'"'''.format(locus_table,
-            net_pi_table, locus)
-    frame = robjects.r('''dbGetQuery(con, {})'''.format(qry))
+def get_net_frame(c, loci, threshold):
+    """Read the net PI of `loci` (or of every locus, given 'all') into an R
+    data frame.  Blobs in compact databases are read straight into arrays,
+    rather than decoded row by row by the `net` view"""
+    if loci[0].lower() == 'all':
+        loci = None
+    names, times, pi = [], [], []
+    for locus, locus_times, locus_pi in get_net_curves(c, [threshold], loci):
+        names.extend([locus] * len(locus_times))
+        times.extend(locus_times.tolist())
+        pi.extend(locus_pi.tolist())
+    return robjects.DataFrame(rlc.OrdDict([
+            ('locus', robjects.StrVector(names)),
+            ('time', robjects.FloatVector(times)),
+            ('pi', robjects.FloatVector(pi)),
+        ]))
+
+def single_locus_net_informativeness(c, locus, threshold):
+    frame = get_net_frame(c, [locus], threshold)
     gg_frame = ggplot2.ggplot(frame)
     plot = gg_frame + ggplot2.aes_string(x = 'time', y='pi') + \
             ggplot2.geom_point(size = 3, alpha = 0.4) + \
@@ -74,17 +95,8 @@ def single_locus_net_informativeness(locus_table, net_pi_table, locus):
 
     return plot
 
-def multiple_locus_net_informativeness_scatterplot(locus_table, net_pi_table,
-        loci):
-    if loci[0].lower() != 'all':
-        qry = '''"SELECT {0}.locus, time, pi FROM {0}, {1} 
-            WHERE {0}.id = {1}.id and locus in {2}"'''.format(locus_table,
-            net_pi_table, tuple(loci))
-    else:
-        qry = '''"SELECT {0}.locus, time, pi FROM {0}, {1} 
-            WHERE {0}.id = {1}.id"'''.format(locus_table,
-            net_pi_table)
-    frame = robjects.r('''dbGetQuery(con, {})'''.format(qry))
+def multiple_locus_net_informativeness_scatterplot(c, loci, threshold):
+    frame = get_net_frame(c, loci, threshold)
     gg_frame = ggplot2.ggplot(frame)
     plot = gg_frame + ggplot2.aes_string(x = 'time', y = 'pi') + \
             ggplot2.geom_point(ggplot2.aes_string(colour = 'locus'), \
@@ -92,16 +104,8 @@ def multiple_locus_net_informativeness_scatterplot(locus_table, net_pi_table,
             ggplot2.scale_y_continuous('phylogenetic informativeness')
     return plot
 
-def multiple_locus_net_informativeness_facet(locus_table, net_pi_table, loci):
-    if loci[0].lower() != 'all':
-        qry = '''"SELECT {0}.locus, time, pi FROM {0}, {1} 
-            WHERE {0}.id = {1}.id and locus in {2}"'''.format(locus_table,
-            net_pi_table, tuple(loci))
-    else:
-        qry = '''"SELECT {0}.locus, time, pi FROM {0}, {1} 
-            WHERE {0}.id = {1}.id"'''.format(locus_table,
-            net_pi_table)
-    frame = robjects.r('''dbGetQuery(con, {})'''.format(qry))
+def multiple_locus_net_informativeness_facet(c, loci, threshold):
+    frame = get_net_frame(c, loci, threshold)
     gg_frame = ggplot2.ggplot(frame)
     plot = gg_frame + ggplot2.aes_string(x = 'time', y='pi') + \
         ggplot2.geom_point(ggplot2.aes_string(colour = 'locus'), size = 3, \
@@ -118,28 +122,33 @@ def order_intervals(intervals):
     sorted_intervals = [e[k] for k in ky]
     return "c{0}".format(tuple(sorted_intervals))
 
-def get_interval_query(intervals, loci, locus_table, interval_table):
+def get_interval_query(intervals, loci, locus_table, interval_table,
+        threshold):
     #pdb.set_trace()
+    clause = get_threshold_clause(threshold)
     if intervals[0].lower() != 'all' and (loci is None or loci[0] == 'all'):
         qry = '''"SELECT {0}.locus, interval, pi FROM {0}, {1} 
-            WHERE {0}.id = {1}.id and interval in {2}"'''.format(locus_table,
-            interval_table, tuple(intervals))
+            WHERE {0}.id = {1}.id and interval in {2} and {3}"'''.format(
+            locus_table, interval_table, tuple(intervals), clause)
     elif intervals[0].lower() != 'all' and loci[0].lower() != 'all':
         qry = '''"SELECT {0}.locus, interval, pi FROM {0}, {1} 
-            WHERE {0}.id = {1}.id and interval in {2} and locus in {3}"'''.format(locus_table,
-            interval_table, tuple(intervals), tuple(loci))
+            WHERE {0}.id = {1}.id and interval in {2} and locus in {3} and
+            {4}"'''.format(locus_table,
+            interval_table, tuple(intervals), tuple(loci), clause)
     elif intervals[0].lower() == 'all' and loci[0].lower() != 'all':
         qry = '''"SELECT {0}.locus, interval, pi FROM {0}, {1} 
-            WHERE {0}.id = {1}.id and locus in {2}"'''.format(locus_table,
-            interval_table, tuple(loci))
+            WHERE {0}.id = {1}.id and locus in {2} and {3}"'''.format(
+            locus_table, interval_table, tuple(loci), clause)
     else:
         qry = '''"SELECT {0}.locus, interval, pi FROM {0}, {1} 
-            WHERE {0}.id = {1}.id"'''.format(locus_table,
-            interval_table)
+            WHERE {0}.id = {1}.id and {2}"'''.format(locus_table,
+            interval_table, clause)
     return qry
 
-def interval(locus_table, interval_table, intervals, loci, boxplot = True):
-    qry = get_interval_query(intervals, loci, locus_table, interval_table)
+def interval(locus_table, interval_table, intervals, loci, threshold,
+        boxplot = True):
+    qry = get_interval_query(intervals, loci, locus_table, interval_table,
+            threshold)
     frame = robjects.r('''data <- dbGetQuery(con, {})'''.format(qry))
     # because we're sorting by interval, which is a factor, we need to
     # explicitly re-sort the data by the first integer value
@@ -172,24 +181,26 @@ def interval(locus_table, interval_table, intervals, loci, boxplot = True):
                 ggplot2.scale_x_discrete('interval (years ago)')
     return plot
 
-def make_plot(args):
+def make_plot(args, c):
     plots = []
     if args.plot_type == 'pi-locus' and args.loci is not None:
         for locus in args.loci:
-            plots.append(single_locus_net_informativeness(LOCUS, PI, locus))
+            plots.append(single_locus_net_informativeness(c, locus,
+                args.threshold))
     elif args.plot_type == 'pi-facet' and \
             args.loci is not None:
-        plots.append(multiple_locus_net_informativeness_facet(LOCUS, PI,
-            args.loci))
+        plots.append(multiple_locus_net_informativeness_facet(c, args.loci,
+            args.threshold))
     elif args.plot_type == 'pi-scatterplot' and \
             args.loci is not None:
-        plots.append(multiple_locus_net_informativeness_scatterplot(LOCUS, PI,
-            args.loci))
+        plots.append(multiple_locus_net_informativeness_scatterplot(c,
+            args.loci, args.threshold))
     elif args.plot_type == 'pi-interval-boxplot' and args.intervals is not None:
-        plots.append(interval(LOCUS, INTERVAL, args.intervals, args.loci))
+        plots.append(interval(LOCUS, INTERVAL, args.intervals, args.loci,
+            args.threshold))
     elif args.plot_type == 'pi-interval-barplot' and args.intervals is not None:
         plots.append(interval(LOCUS, INTERVAL, args.intervals, args.loci,
-            boxplot = False))
+            args.threshold, boxplot = False))
 
     plotter = tapir.rfunctions.setup_plotter(args.output, tapir.get_output_type(args.output),
             args.width, args.height, "in", args.dpi)
@@ -199,13 +210,22 @@ def make_plot(args):
 
 def main():
     args = get_args()
+    # net PI is read from python, intervals through R
+    conn = sqlite3.connect(args.database)
+    c = conn.cursor()
+    # a database holds a row per locus for each threshold it was computed at
+    try:
+        args.threshold = get_threshold(c, args.threshold)
+    except ValueError as e:
+        sys.exit("\n{0}".format(e))
     # ggplot2 gets loaded as a module.  here load sqlite
     # and iterface through robjects
     tapir.rfunctions.load_sqlite()
     # connect R to db
     tapir.rfunctions.get_db_conn(args.database)
-    make_plot(args)
+    make_plot(args, c)
     tapir.rfunctions.close_db_conn()
+    conn.close()
 
 if __name__ == '__main__':
     main()
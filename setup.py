@@ -26,12 +26,14 @@ if __name__ == '__main__':
             "numpy >= 1.3",
             "scipy >= 0.9.0",
             "nose >= 0.10.0",
+            "scandir >= 1.0",
             ],
         scripts=[
             "bin/tapir_compute.py",
             "bin/tapir_plot.py",
             "bin/tapir_matplot.py",
-            "bin/tapir_compare.py"
+            "bin/tapir_compare.py",
+            "bin/tapir_merge.py",
             ],
         packages=[
             'tapir',
@@ -47,11 +47,21 @@ from tests import test
 
 from db import *
 from base import *
+from newick import *
+from alignment import *
 from compute import *
+from cache import *
+from scheduler import *
+from hyphy import *
+from rates import *
+from store import *
 from pkg_resources import resource_filename
 
 def get_hyphy_conf():
     return resource_filename(__name__, 'data/models_and_rates.bf')
 
+def get_hyphy_batch_conf():
+    return resource_filename(__name__, 'data/models_and_rates_batch.bf')
+
 def get_test_files():
     return resource_filename(__name__, 'tests/test-data')
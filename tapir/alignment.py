@@ -0,0 +1,264 @@
+"""
+File: alignment.py
+
+Description: read FASTA, PHYLIP, and NEXUS alignments (optionally gzipped)
+straight into arrays of characters
+
+"""
+
+import os
+import re
+import gzip
+import mmap
+import numpy
+import shutil
+
+# the alignments we'll pick up from a directory
+ALIGNMENT_EXTENSIONS = ','.join(['*.nex', '*.nexus', '*.fasta', '*.fas',
+    '*.fa', '*.fna', '*.phy', '*.phylip'] + ['*.nex.gz', '*.nexus.gz',
+    '*.fasta.gz', '*.fas.gz', '*.fa.gz', '*.fna.gz', '*.phy.gz',
+    '*.phylip.gz'])
+
+FORMATS = {
+        '.nex':'nexus',
+        '.nexus':'nexus',
+        '.fasta':'fasta',
+        '.fas':'fasta',
+        '.fa':'fasta',
+        '.fna':'fasta',
+        '.phy':'phylip',
+        '.phylip':'phylip',
+    }
+
+WHITESPACE = ' \t\r\n'
+
+COMMENTS = re.compile(r'\[[^\]]*\]')
+# polymorphic and uncertain states are never informative
+MULTISTATES = re.compile(r'\{[^}]*\}|\([^)]*\)')
+FASTA_RECORDS = re.compile(r'>([^\n]*)\n([^>]*)')
+NEXUS_MATRIX = re.compile(r'\bmatrix\b(.*?);', re.I | re.S)
+NEXUS_NCHAR = re.compile(r'\bnchar\s*=\s*(\d+)', re.I)
+NEXUS_MATCHCHAR = re.compile(r'\bmatchchar\s*=', re.I)
+NEXUS_INTERLEAVE = re.compile(r'\binterleave(?:\s*=\s*(\w+))?', re.I)
+NEXUS_LABEL = re.compile(r"\s*('(?:[^']|'')*'|\S+)\s*(.*)")
+CHARSETS = re.compile(r"\bcharset\s+\*?\s*('(?:[^']|'')*'|[^\s=;]+)\s*=\s*([^;]*);",
+    re.I)
+# a position or range (1-offset, inclusive), with an optional stride
+CHARSET_RANGE = re.compile(r'^(\d+)(?:-(\d+|\.))?(?:\\(\d+))?$')
+
+
+class AlignmentError(Exception):
+    """the alignment isn't in a form we can read"""
+    pass
+
+def get_format(path):
+    """Guess the format of an alignment from its extension"""
+    name = path[:-3] if path.endswith('.gz') else path
+    return FORMATS.get(os.path.splitext(name)[1].lower())
+
+def get_alignment_data(path):
+    """Return the contents of an alignment file, memory-mapped unless it is
+    gzipped"""
+    with open(path, 'rb') as f:
+        if f.read(2) == '\x1f\x8b':
+            f.seek(0)
+            return gzip.GzipFile(fileobj = f).read()
+        try:
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            # empty files can't be mapped
+            raise AlignmentError("{0} is empty".format(path))
+
+def get_taxon_label(token):
+    """Read a label the way newick and nexus do, so labels from alignments
+    match those in trees"""
+    if token.startswith("'") and token.endswith("'") and len(token) > 1:
+        return token[1:-1].replace("''", "'")
+    return token.replace('_', ' ')
+
+def get_charset_name(token):
+    """Unquote a charset name.  Unlike taxon labels, underscores are kept, as
+    charset names aren't matched against a tree"""
+    if token.startswith("'") and token.endswith("'") and len(token) > 1:
+        return token[1:-1].replace("''", "'")
+    return token
+
+def get_array(labels, sequences):
+    """Stack sequences into a taxa x sites array of (uint8) characters"""
+    if not sequences:
+        raise AlignmentError("no sequences")
+    if len(set([len(s) for s in sequences])) != 1:
+        raise AlignmentError("sequences are not all the same length")
+    if len(set(labels)) != len(labels):
+        raise AlignmentError("duplicate taxa")
+    array = numpy.frombuffer(''.join(sequences), dtype = numpy.uint8)
+    return labels, array.reshape(len(sequences), -1)
+
+def parse_fasta(data):
+    """Parse an aligned FASTA file"""
+    labels, sequences = [], []
+    for match in FASTA_RECORDS.finditer(data):
+        label, sequence = match.groups()
+        labels.append(get_taxon_label(label.strip().split(None, 1)[0]))
+        sequences.append(sequence.translate(None, WHITESPACE))
+    return get_array(labels, sequences)
+
+def parse_phylip(data):
+    """Parse a relaxed (whitespace-delimited) PHYLIP file, sequential or
+    interleaved"""
+    lines = [line for line in data[:].splitlines() if line.strip()]
+    try:
+        ntax, nchar = [int(i) for i in lines[0].split()[:2]]
+    except (IndexError, ValueError):
+        raise AlignmentError("bad PHYLIP header")
+    lines = lines[1:]
+    # sequential, with sequences possibly wrapped over several lines
+    labels, sequences = [], []
+    for line in lines:
+        if sequences and len(sequences[-1]) < nchar:
+            sequences[-1] += line.translate(None, WHITESPACE)
+        else:
+            label, sequence = (line.split(None, 1) + [''])[:2]
+            labels.append(label)
+            sequences.append(sequence.translate(None, WHITESPACE))
+    if len(labels) != ntax or [len(s) for s in sequences] != [nchar] * ntax:
+        # interleaved: labels on the first block only
+        labels, sequences = [], []
+        for k, line in enumerate(lines):
+            if k < ntax:
+                label, sequence = (line.split(None, 1) + [''])[:2]
+                labels.append(label)
+                sequences.append([sequence.translate(None, WHITESPACE)])
+            else:
+                sequences[k % ntax].append(line.translate(None, WHITESPACE))
+        sequences = [''.join(s) for s in sequences]
+    if len(labels) != ntax or [len(s) for s in sequences] != [nchar] * ntax:
+        raise AlignmentError("expected {0} taxa of {1} sites".format(ntax,
+            nchar))
+    return get_array([get_taxon_label(l) for l in labels], sequences)
+
+def parse_nexus(data):
+    """Parse the matrix of a NEXUS DATA (or CHARACTERS) block, sequential or
+    interleaved"""
+    matrix = NEXUS_MATRIX.search(data)
+    if not matrix:
+        raise AlignmentError("no matrix")
+    header = data[:matrix.start()]
+    nchar = NEXUS_NCHAR.search(header)
+    if not nchar:
+        raise AlignmentError("no nchar")
+    nchar = int(nchar.group(1))
+    if NEXUS_MATCHCHAR.search(header):
+        raise AlignmentError("matchchar is not supported")
+    interleaved = NEXUS_INTERLEAVE.search(header)
+    interleaved = bool(interleaved) and \
+            (interleaved.group(1) or 'yes').lower() != 'no'
+    labels, sequences, lengths = [], {}, {}
+    for line in COMMENTS.sub('', matrix.group(1)).splitlines():
+        if not line.strip():
+            continue
+        if labels and not interleaved and lengths[labels[-1]] < nchar:
+            # a sequential sequence wrapped onto the next line
+            label, sequence = labels[-1], line
+        else:
+            label, sequence = NEXUS_LABEL.match(line).groups()
+            if label not in sequences:
+                labels.append(label)
+                sequences[label], lengths[label] = [], 0
+        sequence = MULTISTATES.sub('?', sequence).translate(None, WHITESPACE)
+        sequences[label].append(sequence)
+        lengths[label] += len(sequence)
+    return get_array([get_taxon_label(l) for l in labels],
+        [''.join(sequences[l]) for l in labels])
+
+PARSERS = {
+        'fasta':parse_fasta,
+        'phylip':parse_phylip,
+        'nexus':parse_nexus,
+    }
+
+def read_alignment(path, format = None):
+    """Read an alignment into a list of taxon labels and a taxa x sites array
+    of (uint8) characters.  The format is guessed from the extension, then
+    from the contents, unless given"""
+    data = get_alignment_data(path)
+    try:
+        if not format:
+            format = get_format(path)
+        if not format:
+            start = data[:64].lstrip()
+            if start.startswith('>'):
+                format = 'fasta'
+            elif start.upper().startswith('#NEXUS'):
+                format = 'nexus'
+            else:
+                format = 'phylip'
+        return PARSERS[format](data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+def parse_charsets(data, nchar = None):
+    """Parse the charsets in `data` (a NEXUS sets block, or bare charset
+    statements).  Returns a list of (name, slices) in the order given, where
+    the slices (0-offset) select the sites of each charset.  `nchar` is needed
+    only for ranges ending in '.'"""
+    charsets = []
+    for match in CHARSETS.finditer(COMMENTS.sub('', data)):
+        name, definition = match.groups()
+        # allow '1 - 100 \ 3' as well as '1-100\3'
+        definition = re.sub(r'\s*([-\\])\s*', r'\1', definition)
+        slices = []
+        for item in definition.replace(',', ' ').split():
+            found = CHARSET_RANGE.match(item)
+            if not found:
+                raise AlignmentError("can't read charset {0}: {1}".format(name,
+                    item))
+            start, end, step = found.groups()
+            if end == '.':
+                if not nchar:
+                    raise AlignmentError("charset {0} needs nchar".format(name))
+                end = nchar
+            if nchar and int(end or start) > nchar:
+                raise AlignmentError("charset {0} runs past site {1}".format(
+                    name, nchar))
+            slices.append(slice(int(start) - 1, int(end or start),
+                int(step or 1)))
+        charsets.append((get_charset_name(name), slices))
+    if not charsets:
+        raise AlignmentError("no charsets")
+    return charsets
+
+def get_charsets(path, nchar = None):
+    """Parse the charsets in the file at `path`"""
+    data = get_alignment_data(path)
+    try:
+        return parse_charsets(data[:], nchar)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+def get_partition(array, slices):
+    """Select the sites in `slices` from the last axis of `array`, as a view
+    if there is only one slice"""
+    if len(slices) == 1:
+        return array[..., slices[0]]
+    return numpy.concatenate([array[..., s] for s in slices], axis = -1)
+
+def get_partition_size(slices):
+    """Count the sites in `slices`"""
+    return sum([len(xrange(s.start, s.stop, s.step)) for s in slices])
+
+def get_uncompressed(path, d):
+    """Return the path of an uncompressed copy of `path` in `d` (or of `path`
+    itself, if it isn't gzipped) for programs that can't read gzip"""
+    if not path.endswith('.gz'):
+        return path
+    pth = os.path.join(d, os.path.basename(path)[:-3])
+    if not os.path.exists(pth):
+        # write, then rename, so nobody reads a partial file
+        temp = "{0}.{1}.tmp".format(pth, os.getpid())
+        with open(temp, 'wb') as out:
+            shutil.copyfileobj(gzip.open(path, 'rb'), out)
+        os.rename(temp, pth)
+    return pth
@@ -11,9 +11,20 @@ Description: functions common to picme and helpers
 
 import os
 import sys
-import glob
+import fnmatch
+import functools
 import argparse
 
+# stream directories with scandir (python 3.5, or the scandir package) when
+# we can, as it can usually tell files from folders without a stat
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 #import pdb
 
 class FullPaths(argparse.Action):
@@ -32,6 +43,14 @@ def is_dir(dirname):
     else:
         return dirname
 
+def is_dir_or_file(path):
+    """Checks if a path is an actual directory or file"""
+    if not os.path.exists(path):
+        msg = "{0} is not a directory or file".format(path)
+        raise argparse.ArgumentTypeError(msg)
+    else:
+        return path
+
 def mkdir(path):
     try:
         os.mkdir(path)
@@ -99,25 +118,167 @@ def get_list_from_ranges(string):
         raise argparse.ArgumentTypeError(msg.format(e))
     return ranges
 
-def get_files(d, extension):
+# hyphy model strings for the named models (all use empirical base frequencies)
+MODELS = {
+        'JC':'000000',
+        'F81':'000000',
+        'HKY':'010010',
+        'TRN':'010020',
+        'GTR':'012345',
+    }
+
+def get_models(string):
+    """Convert a comma-separated list of model names or hyphy model strings
+    (e.g. HKY,012345) to the model candidates passed to hyphy"""
+    if string.lower() == 'all':
+        return 'all'
+    models = []
+    for model in string.split(','):
+        model = MODELS.get(model.strip().upper(), model.strip())
+        if len(model) != 6 or not model.isdigit() or model[0] != '0':
+            msg = "{0} is not a model name ({1}) or a hyphy model string"
+            raise argparse.ArgumentTypeError(msg.format(model,
+                ', '.join(sorted(MODELS))))
+        models.append(model)
+    return ','.join(models)
+
+def get_entries(d):
+    """Yield the (name, is_file) of the (non-hidden) entries in `d`, as the
+    directory is read.  `is_file` is a function: with scandir it is usually
+    answered from the listing, without it it stats the entry, so only call
+    it for the entries you want"""
+    try:
+        if scandir:
+            for entry in scandir(d):
+                if not entry.name.startswith('.'):
+                    yield entry.name, entry.is_file
+        else:
+            for name in os.listdir(d):
+                if not name.startswith('.'):
+                    yield name, functools.partial(os.path.isfile,
+                        os.path.join(d, name))
+    except OSError:
+        # like glob, a missing directory holds no files
+        return
+
+def iter_files(d, extension):
+    """Yield the files in `d` matching any of the comma-separated patterns in
+    `extension`, as the directory is read"""
+    patterns = [e.strip(' ') for e in extension.split(',')]
+    for name, is_file in get_entries(d):
+        for pattern in patterns:
+            if fnmatch.fnmatch(name, pattern):
+                # match first, so only the matches are stat-ed
+                if is_file():
+                    yield os.path.join(d, name)
+                break
+
+def get_no_files_error(d, extension):
+    """Return the IOError for a folder without files of `extension` type"""
     if ',' in extension:
         extension = extension.strip(' ').split(',')
     else:
         extension = [extension]
-    files = []
-    for e in extension:
-        files.extend(glob.glob(os.path.join(d, e)))
+    msg = "There appear to be no files of {0} type in {1}"
+    return IOError(msg.format(extension, d))
+
+def get_files(d, extension):
+    files = list(iter_files(d, extension))
     if files == []:
-        msg = "There appear to be no files of {0} type in {1}"
-        raise IOError(msg.format(extension, d))
+        raise get_no_files_error(d, extension)
     else:
         return files
 
+def parse_manifest(filename):
+    """Parses a manifest of input files, one per line, each optionally
+    followed (tab-delimited) by the start and end (0-offset) of a subset of
+    sites and a name for the subset.  Relative paths are relative to the
+    manifest"""
+    d = os.path.dirname(os.path.abspath(filename))
+    with open(filename) as rfile:
+        for line in rfile:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                fields = line.split("\t", 3)
+                path = os.path.join(d, os.path.expanduser(fields[0]))
+                if len(fields) == 1:
+                    yield path, None
+                    continue
+                start, end = fields[1:3]
+                if len(fields) > 3:
+                    name = fields[3]
+                else:
+                    name = "{0}-{1}".format(start, end)
+                yield path, (name, int(start), int(end))
+
+def get_manifest(filename):
+    """Return the files in a manifest, in order, and the (name, start, end)
+    subsets given for each (by file name, as in a subset map file)"""
+    files, names, subsets = [], {}, {}
+    for path, subset in parse_manifest(filename):
+        name = os.path.basename(path)
+        if name not in names:
+            if not os.path.isfile(path):
+                raise IOError("{0} (in {1}) does not exist".format(path,
+                    filename))
+            files.append(path)
+            names[name] = path
+        elif names[name] != path:
+            # their results, locus names, and subsets would collide
+            raise ValueError("{0} and {1} (in {2}) have the same file name".format(
+                names[name], path, filename))
+        if subset:
+            if not 0 <= subset[1] <= subset[2]:
+                raise ValueError("{0}: the subset {1} of {2} runs from {3} to {4}".format(
+                    filename, subset[0], name, subset[1], subset[2]))
+            subsets.setdefault(name, []).append(subset)
+    if files == []:
+        raise IOError("There appear to be no files in {0}".format(filename))
+    return files, subsets
+
+def get_shard_spec(string):
+    """Convert a shard given as I/N (the I-th of N, from 1) to a 0-offset
+    (index, count) tuple"""
+    try:
+        index, count = [int(i) for i in string.split('/')]
+        assert 1 <= index <= count
+    except (ValueError, AssertionError):
+        msg = "Cannot convert {0} to a shard I/N".format(string)
+        raise argparse.ArgumentTypeError(msg)
+    return index - 1, count
+
 def parse_subset_map_file(filename):
-    """Parses a subset map file for alignment names and sites of interest"""
+    """Parses a subset map file for alignment names, sites of interest, and
+    (optionally) subset names"""
     with open(filename) as rfile:
         for line in rfile:
             line = line.strip()
             if line:
-                align, start, end = line.split("\t", 2)
-                yield align, [int(start), int(end)]
+                fields = line.split("\t", 3)
+                align, start, end = fields[:3]
+                if len(fields) > 3:
+                    name = fields[3]
+                else:
+                    name = "{0}-{1}".format(start, end)
+                yield align, [int(start), int(end)], name
+
+def get_subset_map(filename):
+    """Return the (name, start, end) subsets in a subset map file, for each
+    alignment"""
+    subsets = {}
+    for align, (start, end), name in parse_subset_map_file(filename):
+        if not 0 <= start <= end:
+            raise ValueError("{0}: the subset {1} of {2} runs from {3} to {4}".format(
+                filename, name, align, start, end))
+        subsets.setdefault(align, []).append((name, start, end))
+    return subsets
+
+def get_window(string):
+    """Convert a window given as SIZE or SIZE,STEP to a (size, step) tuple"""
+    try:
+        window = [int(i) for i in string.split(',')]
+        assert 1 <= len(window) <= 2 and min(window) > 0
+    except (ValueError, AssertionError):
+        msg = "Cannot convert {0} to a window size and step".format(string)
+        raise argparse.ArgumentTypeError(msg)
+    return window[0], window[-1]
@@ -0,0 +1,115 @@
+"""
+File: cache.py
+
+Description: persistent, content-addressed cache of hyphy site rates
+
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+
+from distutils.spawn import find_executable
+
+
+def get_default_cache_dir():
+    """Return the default location of the site-rate cache"""
+    return os.path.join(os.path.expanduser('~'), '.tapir', 'cache')
+
+def get_hyphy_version(hyphy):
+    """Identify the hyphy binary by its resolved path, size, and mtime"""
+    path = os.path.realpath(find_executable(hyphy) or hyphy)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path
+    return "{0}:{1}:{2!r}".format(path, stat.st_size, stat.st_mtime)
+
+def get_file_digest(path, block_size = 2**20):
+    """Return the sha1 hex digest of the contents of `path`"""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def get_cache_key(alignment, tree, template, version, options = ''):
+    """Hash the inputs that determine the hyphy site rates for a locus,
+    including any `options` sent to the template"""
+    sha = hashlib.sha1()
+    for path in (alignment, tree, template):
+        sha.update(get_file_digest(path))
+    sha.update(version)
+    sha.update(options)
+    return sha.hexdigest()
+
+def get_cache_entry(cache_dir, key):
+    """Return the path of the cache entry for `key`"""
+    # fan out over subdirectories to keep directories small
+    return os.path.join(cache_dir, key[:2], key + '.rates')
+
+def get_cached_rates(cache_dir, key, output):
+    """Copy the cached rates for `key` to `output`.  Returns True on a hit"""
+    entry = get_cache_entry(cache_dir, key)
+    try:
+        shutil.copyfile(entry, output)
+    except IOError:
+        # missing, or evicted from under us
+        return False
+    # touch the entry so eviction is least-recently-used
+    try:
+        os.utime(entry, None)
+    except OSError:
+        pass
+    return True
+
+def put_cached_rates(cache_dir, key, output):
+    """Store the rates file `output` in the cache under `key`"""
+    entry = get_cache_entry(cache_dir, key)
+    try:
+        os.makedirs(os.path.dirname(entry))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(entry)):
+            raise
+    # copy, then rename, so concurrent readers never see a partial entry.
+    # the temp file is unique to this call, as threads share a pid
+    fd, temp = tempfile.mkstemp(suffix = '.tmp', prefix = os.path.basename(
+        entry) + '.', dir = os.path.dirname(entry))
+    try:
+        with os.fdopen(fd, 'wb') as dst, open(output, 'rb') as src:
+            shutil.copyfileobj(src, dst)
+        # mkstemp makes the file private; give it the mode of the original
+        shutil.copymode(output, temp)
+        os.rename(temp, entry)
+    except:
+        os.remove(temp)
+        raise
+    return entry
+
+def evict_cache(cache_dir, max_size = None, max_age = None):
+    """Remove cache entries older than `max_age` seconds, then the least
+    recently used entries until the cache is under `max_size` bytes.  Returns
+    the number of entries removed"""
+    entries = []
+    for root, dirs, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith('.rates'):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+    # oldest first
+    entries.sort()
+    total = sum([size for mtime, size, path in entries])
+    oldest = time.time() - max_age if max_age is not None else None
+    removed = 0
+    for mtime, size, path in entries:
+        expired = oldest is not None and mtime < oldest
+        oversize = max_size is not None and total > max_size
+        if not (expired or oversize):
+            break
+        os.remove(path)
+        total -= size
+        removed += 1
+    return removed
@@ -12,37 +12,80 @@ Description: functions for tree manip and pi computation
 import os
 import sys
 import json
-import time
+import hashlib
+import tempfile
 import numpy
 import dendropy
 
+import newick
+from alignment import read_alignment, get_format, get_taxon_label, \
+        AlignmentError
+
 from scipy import integrate
 from scipy import vectorize
-from collections import defaultdict
 
+# default memory ceiling (in bytes) for blocks of the time x site PI matrix
+PI_BLOCK_MEMORY = 4 * 2**20
+
+# the tree to use for each (pruned) tree name, so each taxon set is only
+# looked at once per process
+PRUNED_TREES = {}
+
+# lookup table of the byte values that count towards informativeness
+NUCLEOTIDES = numpy.zeros(256, dtype = bool)
+NUCLEOTIDES[numpy.frombuffer(b'ACGTacgt', dtype = numpy.uint8)] = True
+
+def get_site_rate_cache_name(rate_file, correction = 1):
+    """Return the name of the binary sidecar holding the parsed rates for
+    `rate_file`, keyed by its size, mtime, and the correction factor"""
+    stat = os.stat(rate_file)
+    key = "{0}:{1!r}:{2!r}".format(stat.st_size, stat.st_mtime, float(correction))
+    return "{0}.{1}.npy".format(rate_file, hashlib.sha1(key).hexdigest()[:16])
 
-def parse_site_rates(rate_file, correction = 1, test = False, count = 0):
+def write_site_rate_cache(rate_file, correction, rates, corrected):
+    """Write raw and corrected rates to a memory-mappable sidecar, removing
+    any stale sidecars for `rate_file`"""
+    cache = get_site_rate_cache_name(rate_file, correction)
+    directory, name = os.path.split(cache)
+    prefix = os.path.basename(rate_file) + '.'
+    for f in os.listdir(directory or os.curdir):
+        stale = f.startswith(prefix) and f.endswith('.npy') and \
+                len(f) == len(name) and f != name
+        if stale:
+            try:
+                os.remove(os.path.join(directory, f))
+            except OSError:
+                # another process got there first
+                pass
+    # write to a temp file of our own, then rename, so a reader never sees a
+    # partial sidecar and concurrent writers don't clobber each other
+    fd, temp = tempfile.mkstemp(prefix = name + '.', suffix = '.tmp',
+        dir = directory or os.curdir)
+    with os.fdopen(fd, 'wb') as f:
+        numpy.save(f, numpy.vstack((rates, corrected)))
+    os.rename(temp, cache)
+    return cache
+
+def parse_site_rates(rate_file, correction = 1, test = False):
     """Parse the site rate file returned from hyphy to a vector of rates"""
-    # for whatever reason, when run in a virtualenv (and perhaps in other
-    # cases, the file does not seem to be written quite before we try
-    # to read it.  so, pause and try to re-read up to three-times.
-    try:
-        data = json.load(open(rate_file, 'r'))
-    except IOError as e:
-        if count <= 3:
-            count += 1
-            time.sleep(0.1)
-            parse_site_rates(rate_file, correction, test, count)
-        else:
-            raise IOError("Cannot open {0}: {1}".format(rate_file, e))
-    rates = numpy.array([line["rate"] for line in data["sites"]["rates"]])
+    # reuse previously parsed rates when the sidecar is current
+    cache = get_site_rate_cache_name(rate_file, correction)
+    if os.path.exists(cache):
+        return numpy.load(cache, mmap_mode = 'r')[1]
+    with open(rate_file) as f:
+        data = json.load(f)
+    rates = numpy.array([line["rate"] for line in data["sites"]["rates"]], dtype = float)
     corrected = rates/correction
     if not test:
-        data["sites"]["corrected_rates"] = [{"site":k + 1,"rate":v} \
-                for k,v in enumerate(corrected)]
-        json.dump(data, open(rate_file,'w'), indent = 4)
+        write_site_rate_cache(rate_file, correction, rates, corrected)
     return corrected
 
+def get_site_rate_model(rate_file):
+    """Return the model hyphy chose for a site rate file, if it recorded one"""
+    with open(rate_file) as f:
+        data = json.load(f)
+    return data["sites"].get("model")
+
 def get_townsend_pi(time, rates):
     """Townsend et al. Equation10 """
     return 16 * (rates**2) * time * numpy.exp(-(4 * rates * time))
@@ -51,21 +94,78 @@ def get_integral_over_times(start, stop, rate):
     """Integrate over start and stop times"""
     return integrate.quad(get_townsend_pi, start, stop, args=(rate))
 
+def get_townsend_pi_antiderivative(time, rates):
+    """Antiderivative of Townsend et al. Equation10 with respect to time"""
+    # d/dt[-(4rt + 1) * e^(-4rt)] = 16 * r^2 * t * e^(-4rt)
+    return -(4 * rates * time + 1) * numpy.exp(-(4 * rates * time))
+
+def get_rate_histogram(rates, tolerance = 0.):
+    """Collapse a vector of site rates into its unique values and their
+    multiplicities.  If `tolerance` is set, positive rates are binned so that
+    every rate is within `tolerance` (relative) of its bin's representative"""
+    rates = numpy.ravel(rates)
+    rates = rates[numpy.isfinite(rates)]
+    if tolerance:
+        assert 0 < tolerance < 1, "Rate tolerance must be between 0 and 1"
+        rates = rates.copy()
+        positive = rates > 0
+        # geometric bins [q^k, q^(k+1)) with representative q^k/(1 - tolerance)
+        # keep every member within [1 - tolerance, 1 + tolerance] of it
+        q = (1 + tolerance)/(1 - tolerance)
+        k = numpy.floor(numpy.log(rates[positive])/numpy.log(q))
+        rates[positive] = q**k/(1 - tolerance)
+    unique, inverse = numpy.unique(rates, return_inverse = True)
+    return unique, numpy.bincount(inverse)
+
+def get_integrals_over_epochs(rates, epochs):
+    """Integrate PI for every rate over every epoch in a single broadcast,
+    returning an (epochs x rates) array"""
+    spans = numpy.asarray(epochs, dtype = float)
+    # columns of start and stop times against a row of rates
+    start = spans[:, 0].reshape(-1, 1)
+    stop = spans[:, 1].reshape(-1, 1)
+    rates = numpy.asarray(rates, dtype = float).reshape(1, -1)
+    return get_townsend_pi_antiderivative(stop, rates) - \
+            get_townsend_pi_antiderivative(start, rates)
+
 def get_time(start, stop, step = 1):
     """Given start and stop times, return a column of times over which we're working"""
     # reshape array into columns from row
     return numpy.reshape(numpy.array(range(start, stop, step)), (-1,1))
 
+def get_correction_factor(length, leaves):
+    """Return the power of ten that brings the mean branch length of a tree
+    under 10"""
+    mean_branch_length = length/(2 * leaves - 3)
+    string_len = len(str(int(mean_branch_length + 0.5)))
+    if string_len > 1:
+        return 10 ** string_len
+    return 1
+
+def correct_newick_branch_lengths(tree_file, d = ""):
+    """Scale branch lengths to values shorter than 100, working on the newick
+    directly rather than through dendropy"""
+    parents, lengths, labels = newick.get_newick_from_path(tree_file)
+    depth, length, leaves = newick.get_tree_stats(parents, lengths)
+    correction_factor = get_correction_factor(length, leaves)
+    lengths /= correction_factor
+    pth = os.path.join(d, 'Tree_{0}_{1}.newick'.format(correction_factor, depth))
+    with open(pth, 'w') as f:
+        f.write(newick.write_newick(parents, lengths, labels) + "\n")
+    return depth, correction_factor, pth
+
 def correct_branch_lengths(tree_file, format, d = ""):
     """Scale branch lengths to values shorter than 100"""
+    if format == 'newick':
+        try:
+            return correct_newick_branch_lengths(tree_file, d)
+        except newick.NewickError:
+            # let dendropy have a go
+            pass
     tree = dendropy.Tree.get_from_path(tree_file, format)
     depth = tree.seed_node.distance_from_tip()
-    mean_branch_length = tree.length()/(2 * len(tree.leaf_nodes()) - 3)
-    string_len = len(str(int(mean_branch_length + 0.5)))
-    if string_len > 1:
-        correction_factor = 10 ** string_len
-    else:
-        correction_factor = 1
+    correction_factor = get_correction_factor(tree.length(),
+            len(tree.leaf_nodes()))
     for edge in tree.preorder_edge_iter():
         if edge.length:
             edge.length /= correction_factor
@@ -73,37 +173,266 @@ def correct_branch_lengths(tree_file, format, d = ""):
     tree.write_to_path(pth, 'newick')
     return depth, correction_factor, pth
 
+def get_pruned_tree_name(tree, taxa):
+    """Return the name of the copy of `tree` pruned to `taxa`, which is
+    shared by every locus with the same taxon set"""
+    digest = hashlib.sha1("\n".join(sorted(taxa))).hexdigest()[:16]
+    return "{0}.{1}.newick".format(os.path.splitext(tree)[0], digest)
+
+def get_tree_labels(tree):
+    """Return the labels of the tips of the newick `tree`, read as dendropy
+    reads them"""
+    try:
+        parents, lengths, labels = newick.get_newick_from_path(tree)
+    except newick.NewickError:
+        # let dendropy have a go
+        return set([leaf.taxon.label for leaf in dendropy.Tree.get_from_path(
+            tree, 'newick').leaf_nodes()])
+    leaves = numpy.ones(len(parents), dtype = bool)
+    leaves[parents[parents >= 0]] = False
+    return set([get_taxon_label(labels[node]) for node in
+        numpy.flatnonzero(leaves)])
+
+def prune_tree(tree, taxa):
+    """Prune the newick `tree` to the taxa in `taxa`, returning the path of the
+    pruned tree, or of `tree` itself if there is nothing to prune"""
+    pth = get_pruned_tree_name(tree, taxa)
+    if pth in PRUNED_TREES:
+        return PRUNED_TREES[pth]
+    if os.path.exists(pth):
+        PRUNED_TREES[pth] = pth
+        return pth
+    labels = get_tree_labels(tree)
+    missing = set(taxa) - labels
+    if missing:
+        raise ValueError("taxa missing from the tree: {0}".format(
+                ', '.join(sorted(missing))))
+    if labels == set(taxa):
+        # most loci have every taxon; remember that, rather than reread the
+        # tree for each of them
+        PRUNED_TREES[pth] = tree
+        return tree
+    pruned = dendropy.Tree.get_from_path(tree, 'newick')
+    pruned.prune_taxa_with_labels(labels - set(taxa))
+    # pruning can leave a stem below the new root
+    pruned.seed_node.edge.length = None
+    # write, then rename, so concurrent loci never read a partial tree
+    temp = "{0}.{1}.{2}.tmp".format(pth, os.getpid(), id(pruned))
+    pruned.write_to_path(temp, 'newick')
+    os.rename(temp, pth)
+    PRUNED_TREES[pth] = pth
+    return pth
+
 def get_net_pi_for_periods(pi, times):
     """Sum across the PI values for the requested times"""
     sums = numpy.nansum(pi, axis=1)[times]
     return dict(zip(times, sums))
 
-def get_net_integral_for_epochs(rates, epochs):
-    """Given a set of epochs, integrate rates over those start and stop times"""
+def get_net_pi(time, rates, max_memory = PI_BLOCK_MEMORY, weights = None):
+    """Sum PI across sites for each time, working through the time x site
+    matrix in blocks that stay under `max_memory` bytes.  If given, `weights`
+    holds the number of sites sharing each rate"""
+    time = numpy.ravel(time)
+    rates = numpy.ravel(rates)
+    # undefined sites contribute nothing, so drop them up front
+    finite = numpy.isfinite(rates)
+    rates = rates[finite]
+    if weights is not None:
+        weights = numpy.ravel(weights)[finite]
+    pi_net = numpy.zeros(len(time))
+    if not len(rates):
+        return pi_net
+    # each block needs ~3 float64 temporaries (4rt, exp(-4rt), and PI)
+    cells = max(1, int(max_memory) // (3 * 8))
+    site_step = min(len(rates), cells)
+    time_step = max(1, cells // site_step)
+    for i in xrange(0, len(time), time_step):
+        t = time[i:i + time_step].reshape(-1, 1)
+        for j in xrange(0, len(rates), site_step):
+            pi = get_townsend_pi(t, rates[j:j + site_step])
+            if weights is None:
+                pi_net[i:i + time_step] += pi.sum(axis = 1)
+            else:
+                pi_net[i:i + time_step] += numpy.dot(pi, weights[j:j + site_step])
+    return pi_net
+
+def get_net_pi_for_times(pi_net, times):
+    """Return the net PI at the requested times"""
+    return dict(zip(times, pi_net[times]))
+
+def get_pi_for_rates(time, rates, times, epochs, engine = 'site',
+        tolerance = 0., max_memory = PI_BLOCK_MEMORY):
+    """Return the net PI, the PI at `times` and the integral of PI over
+    `epochs` for a vector of site rates.  The `site` engine works site-by-site;
+    the `unique` engine works once per unique (or binned, given `tolerance`)
+    rate, weighted by the number of sites sharing that rate"""
+    if engine == 'unique':
+        rates, weights = get_rate_histogram(rates, tolerance)
+    else:
+        rates = numpy.ravel(rates)
+        rates, weights = rates[numpy.isfinite(rates)], None
+    pi_net = get_net_pi(time, rates, max_memory, weights)
+    pi_times = get_net_pi_for_times(pi_net, times)
+    pi_epochs = get_net_integral_for_epochs(rates, epochs, weights = weights)
+    return pi_net, pi_times, pi_epochs
+
+def get_site_pi_index(time, rates, times, epochs):
+    """Build prefix sums, over sites, of the PI at `times` and the integral of
+    PI over `epochs`, so the totals for any range of sites take a single
+    subtraction.  Returns a (times + epochs) x (sites + 1) array"""
+    rates = numpy.asarray(rates, dtype = float)
+    # sites without a rate contribute nothing (PI and its integral are 0 at 0)
+    rates = numpy.where(numpy.isfinite(rates), rates, 0.)
+    at = numpy.asarray(time, dtype = float)[times].reshape(-1, 1)
+    site_pi = get_townsend_pi(at, rates.reshape(1, -1))
+    if len(epochs):
+        site_pi = numpy.vstack((site_pi, get_integrals_over_epochs(rates,
+            epochs)))
+    index = numpy.zeros((len(site_pi), len(rates) + 1))
+    numpy.cumsum(site_pi, axis = 1, out = index[:, 1:])
+    return index
+
+def get_subset_pi(index, times, epochs, subsets, time = None, rates = None,
+        max_memory = PI_BLOCK_MEMORY):
+    """Look up the PI at `times` and over `epochs` for each (name, start, end)
+    site range in `subsets`.  Returns (name, start, end, step, net PI, PI at
+    times, PI over epochs) for each, where the step is always 1.  The net PI
+    is summed over each range of `rates` if `time` and `rates` are given, and
+    is None otherwise"""
+    if not subsets:
+        return []
+    names, starts, ends = zip(*subsets)
+    # like slicing, ranges stop at the end of the alignment
+    sites = index.shape[1] - 1
+    starts = numpy.clip(starts, 0, sites)
+    ends = numpy.clip(ends, 0, sites)
+    totals = index[:, ends] - index[:, starts]
+    spans = ["{0}-{1}".format(span[0], span[1]) for span in epochs]
+    results = []
+    for k, name in enumerate(names):
+        pi_times = dict(zip(times, totals[:len(times), k]))
+        pi_epochs = dict([(span, {'sum(integral)':v, 'sum(error)':0.}) for
+            span, v in zip(spans, totals[len(times):, k])])
+        pi_net = None
+        if rates is not None:
+            pi_net = get_net_pi(time, numpy.ravel(rates)[starts[k]:ends[k]],
+                max_memory)
+        results.append((name, int(starts[k]), int(ends[k]), 1, pi_net,
+            pi_times, pi_epochs))
+    return results
+
+def get_stride_pi(time, rates, times, epochs, stride, engine = 'site',
+        tolerance = 0., max_memory = PI_BLOCK_MEMORY):
+    """Compute PI for every `stride`th site starting at each offset (e.g.
+    codon positions for a stride of 3), from strided views of the rates.
+    Returns results in the form of get_subset_pi(), with the net PI"""
+    rates = numpy.ravel(rates)
+    results = []
+    for offset in xrange(stride):
+        pi_net, pi_times, pi_epochs = get_pi_for_rates(time,
+            rates[offset::stride], times, epochs, engine, tolerance,
+            max_memory)
+        results.append(("position-{0}".format(offset + 1), offset, len(rates),
+            stride, pi_net, pi_times, pi_epochs))
+    return results
+
+def get_windows(sites, size, step = None):
+    """Return (name, start, end) for windows of `size` sites every `step`
+    sites along an alignment"""
+    step = step or size
+    if size < 1 or step < 1:
+        raise ValueError("Cannot make windows of {0} sites every {1} sites".format(
+            size, step))
+    return [("window-{0}-{1}".format(start, start + size), start, start + size)
+        for start in xrange(0, sites - size + 1, step)]
+
+def get_net_integral_for_epochs(rates, epochs, method = 'analytic', weights = None):
+    """Given a set of epochs, integrate rates over those start and stop times.
+    If given, `weights` holds the number of sites sharing each rate"""
+    for span in epochs:
+        assert span[0] < span[1], \
+            "Start time [{0}] is sooner than end time [{1}]".format(span[0],span[1])
+    if method == 'quad':
+        return get_net_quad_integral_for_epochs(rates, epochs, weights)
+    epochs_results = {}
+    if not len(epochs):
+        return epochs_results
+    integrals = get_integrals_over_epochs(rates, epochs)
+    if weights is None:
+        integrals = integrals.sum(axis = 1)
+    else:
+        integrals = numpy.dot(integrals, weights)
+    # the closed form is exact, so the error term is always zero
+    for span, integral in zip(epochs, integrals):
+        name = "{0}-{1}".format(span[0],span[1])
+        epochs_results[name] = {'sum(integral)':integral, 'sum(error)':0.}
+    return epochs_results
+
+def get_net_quad_integral_for_epochs(rates, epochs, weights = None):
+    """Given a set of epochs, numerically integrate rates over those start and
+    stop times"""
+    if weights is None:
+        weights = numpy.ones(len(rates))
     # vectorize the integral function to take our rates array as input
     vec_integrate = vectorize(get_integral_over_times)
     # scipy.integrate returns tuple of (integral, upper-error-bound)
-    # TODO:  figure out how we want to handle diff. time intervals here
     epochs_results = {}
     for span in epochs:
         name = "{0}-{1}".format(span[0],span[1])
-        assert span[0] < span[1], \
-            "Start time [{0}] is sooner than end time [{1}]".format(span[0],span[1])
         integral, error = vec_integrate(span[0],span[1], rates)
-        epochs_results[name] = {'sum(integral)':sum(integral), 'sum(error)':sum(error)}
+        epochs_results[name] = {'sum(integral)':numpy.dot(integral, weights),
+                'sum(error)':numpy.dot(error, weights)}
     return epochs_results
 
+def get_alignment(alignment):
+    """Read an alignment into a list of taxon labels and a taxa x sites array
+    of (uint8) characters"""
+    try:
+        return read_alignment(alignment)
+    except AlignmentError:
+        if get_format(alignment) != 'nexus':
+            raise
+    # nexus we can't read ourselves
+    return get_dendropy_alignment(alignment)
+
+def get_dendropy_alignment(alignment):
+    """Read a nexus alignment through dendropy into a list of taxon labels and
+    a taxa x sites array of (uint8) characters"""
+    taxa = dendropy.DnaCharacterMatrix.get_from_path(alignment, 'nexus')
+    labels, rows = [], []
+    for taxon, cells in taxa.items():
+        assert len(cells) == taxa.vector_size # should all have equal lengths
+        symbols = cells.symbols_as_string()
+        if len(symbols) != len(cells):
+            # multi-character (e.g. polymorphic) states are never informative
+            symbols = ''.join([str(c) if len(str(c)) == 1 else '?' for c in cells])
+        labels.append(taxon.label)
+        rows.append(numpy.frombuffer(symbols.encode('ascii'), dtype = numpy.uint8))
+    return labels, numpy.vstack(rows)
+
+def get_alignment_array(alignment):
+    """Read an alignment into a taxa x sites array of (uint8) characters"""
+    return get_alignment(alignment)[1]
+
 def get_informative_sites(alignment, threshold=4):
     """Returns a list, where True indicates a site which was over the threshold
     for informativeness.
     """
-    taxa = dendropy.DnaCharacterMatrix.get_from_path(alignment, 'nexus')
-    results = defaultdict(int)
-    for cells in taxa.sequences():
-        assert len(cells) == taxa.vector_size # should all have equal lengths
-        for idx, cell in enumerate(cells):
-            results[idx] += 1 if str(cell).upper() in "ATGC" else 0
-    return numpy.array([1 if results[x] >= threshold else numpy.nan for x in sorted(results)])
+    return get_informative_mask(get_alignment_array(alignment), threshold)
+
+def get_informative_mask(characters, threshold=4):
+    """As get_informative_sites(), for a taxa x sites array of characters"""
+    return get_threshold_mask(get_informative_counts(characters), threshold)
+
+def get_informative_counts(characters):
+    """Count the A, C, G, and T characters in each column of a taxa x sites
+    array of characters, from which masks for any threshold follow"""
+    return NUCLEOTIDES[characters].sum(axis = 0)
+
+def get_threshold_mask(counts, threshold=4):
+    """Returns a mask (1 or nan) of the sites whose counts from
+    get_informative_counts() reach `threshold`"""
+    return numpy.where(counts >= threshold, 1., numpy.nan)
 
 def cull_uninformative_rates(rates, inform):
     """Zeroes out rates which are uninformative"""
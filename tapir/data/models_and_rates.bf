@@ -7,6 +7,19 @@ fscanf(stdin, "String", FILE_TREE);
 // FILE_OUTPUT = FILE_NUCLEOTIDES + ".rates";
 //fprintf(stdout, "Output file: ");
 fscanf(stdin, "String", FILE_OUTPUT);
+// Comma-separated model strings (e.g. "010010,012345") to which the model
+// search is restricted, or "all" to fit every 4x4 reversible model
+fscanf(stdin, "String", MODEL_CANDIDATES);
+
+// the general reversible model is always fit (the others are nested in it),
+// but only counts towards the model average if it is a candidate
+gtrCandidate = 1;
+if (MODEL_CANDIDATES != "all") {
+    candidatePattern = MODEL_CANDIDATES$"012345";
+    if (candidatePattern[0] < 0) {
+        gtrCandidate = 0;
+    }
+}
 
 // If we want output into diff files:
 
@@ -565,15 +578,37 @@ for (v2 = 0; v2 <= 1; v2 = v2 + 1) {
                         break;
                     }
 
+                    modelDesc = "0" + Format(v2, 1, 0);
+                    modelDesc = modelDesc + Format(v3, 1, 0);
+                    modelDesc = modelDesc + Format(v4, 1, 0);
+                    modelDesc = modelDesc + Format(v5, 1, 0);
+                    modelDesc = modelDesc + Format(v6, 1, 0);
+
+                    if (MODEL_CANDIDATES != "all") {
+                        candidatePattern = MODEL_CANDIDATES$modelDesc;
+                        if (candidatePattern[0] < 0) {
+                            /* not a candidate: record it as rejected, with no
+                            likelihood, so it carries no Akaike weight */
+                            modelNum = modelNum + 1;
+                            resultCache [modelNum][0] = v2;
+                            resultCache [modelNum][1] = v3;
+                            resultCache [modelNum][2] = v4;
+                            resultCache [modelNum][3] = v5;
+                            resultCache [modelNum][4] = v6;
+                            resultCache [modelNum][5] = -1e100;
+                            resultCache [modelNum][6] = 0;
+                            resultCache [modelNum][7] = 0;
+                            resultCache [modelNum][8] = 0;
+                            for (skipColumn = 9; skipColumn < 14; skipColumn = skipColumn + 1) {
+                                resultCache [modelNum][skipColumn] = 1;
+                            }
+                            continue;
+                        }
+                    }
+
                     if (modelType > 0) {
                         paramCount	  = 0;
 
-                        modelDesc = "0" + Format(v2, 1, 0);
-                        modelDesc = modelDesc + Format(v3, 1, 0);
-                        modelDesc = modelDesc + Format(v4, 1, 0);
-                        modelDesc = modelDesc + Format(v5, 1, 0);
-                        modelDesc = modelDesc + Format(v6, 1, 0);
-
                         modelConstraintString = "";
 
                         AC = 1;
@@ -769,6 +804,20 @@ if (rejectCount < 202) {
 
     }
 
+    if (v4 == 0 && gtrCandidate == 0) {
+        /* every candidate was rejected in favor of the general reversible
+        model, which isn't one: fall back to the AIC-best candidate */
+        for (v2 = 1; v2 < 203; v2 = v2 + 1) {
+            if (resultCache[v2][5] > -1e100) {
+                AIC = -2 * resultCache[v2][5] + 2 * resultCache[v2][6];
+                if (AIC < v5) {
+                    v5 = AIC;
+                    v4 = v2;
+                }
+            }
+        }
+    }
+
 
     PRINT_DIGITS = 0;
     modelString = "0";
@@ -805,7 +854,12 @@ if (rejectCount < 202) {
 
 if (modelType) {
     modelAICs = {203, 2};
-    modelAICs[0][0] = 2 * (-resultCache[0][5] + resultCache[0][6] + Log(nucData.sites));
+    if (gtrCandidate) {
+        modelAICs[0][0] = 2 * (-resultCache[0][5] + resultCache[0][6] + Log(nucData.sites));
+    } else {
+        /* as for the other models that aren't candidates: no weight */
+        modelAICs[0][0] = 2 * (1e100 + resultCache[0][6] + Log(nucData.sites));
+    }
     modelAICs[0][1] = 0;
 
     for (v2 = 1; v2 < 203; v2 = v2 + 1) {
@@ -1030,6 +1084,9 @@ fprintf (FILE_OUTPUT, "\n\t\t\"subs_matrix\":{",
                               "\n\t\t\t\"CT\":", CT, ",",
                               "\n\t\t\t\"GT\":", GT, "\n\t\t},",);
 
+// record the AIC-best model, so reruns can restrict the search to it
+fprintf (FILE_OUTPUT, "\n\t\t\"model\":\"", bestModelString, "\",",);
+
 doneSites    = {myFilter.unique_sites,3}; /* Getting the different site patterns */
 fullSites    = {myFilter.sites,3};
 GetDataInfo    (dupInfo, myFilter); /*DupInfo is a matrix with the different categories/patterns of sites, duplicated sites info*/
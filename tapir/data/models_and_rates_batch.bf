@@ -0,0 +1,39 @@
+RequireVersion ("0.9920061127");
+
+/*
+    Batch driver for models_and_rates.bf.  Amortizes hyphy startup across
+    many loci by running the per-locus template once for each alignment in
+    this single process.
+
+    Reads, from stdin:
+
+        - the path to the per-locus template (e.g. models_and_rates.bf)
+        - the path to the tree file shared by every locus
+        - the number of loci
+        - for each locus, the path to the alignment, the path to the output,
+          and the models to consider (see MODEL_CANDIDATES)
+
+    Each locus is handed to the template as if its four lines (alignment,
+    tree, output, models) had been typed on stdin.
+*/
+
+fscanf(stdin, "String", BATCH_TEMPLATE);
+fscanf(stdin, "String", BATCH_TREE);
+fscanf(stdin, "Number", BATCH_COUNT);
+
+for (batchLocus = 0; batchLocus < BATCH_COUNT; batchLocus = batchLocus + 1) {
+    fscanf(stdin, "String", BATCH_NUCLEOTIDES);
+    fscanf(stdin, "String", BATCH_OUTPUT);
+    fscanf(stdin, "String", BATCH_MODELS);
+
+    batchInput = {};
+    batchInput["00"] = BATCH_NUCLEOTIDES;
+    batchInput["01"] = BATCH_TREE;
+    batchInput["02"] = BATCH_OUTPUT;
+    batchInput["03"] = BATCH_MODELS;
+
+    ExecuteAFile (BATCH_TEMPLATE, batchInput);
+    fprintf (stdout, "\nBatch locus ", batchLocus + 1, " of ", BATCH_COUNT, " written to ", BATCH_OUTPUT, "\n");
+}
+
+return 0;
@@ -10,30 +10,229 @@ Description:
 """
 
 import os
+import sys
 import sqlite3
+import numpy
+import itertools
 
-def create_probe_db(db_name):
-    """docstring for create_probe_database"""
+from alignment import FORMATS
+
+# extensions of the files a locus can come from
+LOCUS_EXTENSIONS = set(FORMATS.keys() + ['.rates'])
+
+# indexes for the plotting and compare queries.  these are built after
+# loading, which is much faster than keeping them up to date row by row
+INDEXES = [
+        ('loci_locus', 'loci', 'locus'),
+        ('net_id_time', 'net', 'id, time'),
+        ('interval_interval_pi', 'interval', 'interval, pi'),
+    ]
+
+# big-endian, so the hex() of each value in the blob reads most significant
+# nibble first
+NET_DTYPES = {
+        'float32':'>f4',
+        'float64':'>f8',
+    }
+
+# bits of mantissa, bits of exponent, and exponent bias, by size in bytes
+IEEE = {
+        4:(23, 8, 127),
+        8:(52, 11, 1023),
+    }
+
+# the tables copied when merging databases, and which of their columns hold
+# keys of loci, or of subsets, that must be offset
+MERGE_TABLES = [
+        ('loci', {'id':'loci'}),
+        ('net', {'id':'loci'}),
+        ('net_blob', {'id':'loci'}),
+        ('rates_blob', {'id':'loci'}),
+        ('discrete', {'id':'loci'}),
+        ('interval', {'id':'loci'}),
+        ('models', {'id':'loci'}),
+        ('subsets', {'id':'subsets', 'locus':'loci'}),
+        ('subset_net', {'id':'subsets'}),
+        ('subset_discrete', {'id':'subsets'}),
+        ('subset_interval', {'id':'subsets'}),
+    ]
+
+BYTES = ''.join("{0:02X} ".format(i) for i in xrange(256))
+
+def get_locus_name(path):
+    """Return the name under which a locus is stored"""
+    name = os.path.basename(path)
+    if name.endswith('.gz'):
+        name = name[:-3]
+    # only strip extensions we know, so charset names keep their dots
+    root, extension = os.path.splitext(name)
+    if extension.lower() in LOCUS_EXTENSIONS:
+        return root
+    return name
+
+def get_blob_decoder(size):
+    """Return SQL for the integer with the bits of the `size`-byte value at
+    `net_time.time` in the `net_blob.pi` blob"""
+    value = "hex(substr(net_blob.pi, net_time.time * {0} + 1, {0}))".format(size)
+    # sqlite can't read bytes from a blob, but it can find each byte's hex
+    # in a table of them; BYTES is "00 01 ... FF "
+    return ' | '.join(["(((instr('{0}', substr({1}, {2}, 2) || ' ') - 1) / 3) "
+        "<< {3})".format(BYTES, value, 2 * i + 1, 8 * (size - i - 1)) for i in
+        xrange(size)])
+
+def get_net_scales():
+    """Yield the size, sign and exponent bits, scale, and offset that turn the
+    mantissa of an IEEE 754 value into the value (mantissa * scale + offset),
+    so the `net` view needs no floating point functions.  The scale and
+    offset are NULL for inf and nan"""
+    for size, (mantissa, exponent, bias) in IEEE.iteritems():
+        for top in xrange(2 ** (exponent + 1)):
+            sign = -1. if top >> exponent else 1.
+            e = top & (2 ** exponent - 1)
+            if e == 2 ** exponent - 1:
+                yield size, top, None, None
+            elif e == 0:
+                # subnormal, without the implicit leading bit
+                yield size, top, sign * 2. ** (1 - bias - mantissa), 0.
+            else:
+                yield size, top, sign * 2. ** (e - bias - mantissa), \
+                    sign * 2. ** (e - bias)
+
+def create_compact_net(c, resume = False):
+    """Create tables holding the net PI of each locus (and, optionally, its
+    site rates) as a single blob, and a `net` view presenting them as rows
+    of (id, time, pi)"""
+    create = "CREATE TABLE IF NOT EXISTS" if resume else "CREATE TABLE"
+    c.execute('''{0} net_blob (id INTEGER PRIMARY KEY, start INT, step INT,
+        size INT, pi BLOB, FOREIGN KEY(id) REFERENCES loci(id) DEFERRABLE
+        INITIALLY DEFERRED)'''.format(create))
+    c.execute('''{0} rates_blob (id INTEGER PRIMARY KEY, size INT,
+        rates BLOB, FOREIGN KEY(id) REFERENCES loci(id) DEFERRABLE INITIALLY
+        DEFERRED)'''.format(create))
+    # the position of each value in a blob, for the view to join against
+    c.execute("{0} net_time (time INTEGER PRIMARY KEY)".format(create))
+    c.execute('''{0} net_scale (size INT, top INT, scale FLOAT, offset FLOAT,
+        PRIMARY KEY(size, top))'''.format(create))
+    c.execute("SELECT count(*) FROM net_scale")
+    if not c.fetchone()[0]:
+        c.executemany("INSERT INTO net_scale VALUES (?,?,?,?)",
+            get_net_scales())
+    # split each value into its mantissa and its sign and exponent (`top`)
+    c.execute('''CREATE VIEW {0} net AS SELECT id, time,
+        mantissa * net_scale.scale + net_scale.offset AS pi
+        FROM (SELECT id, time, size, value & ((1 << bits) - 1) AS mantissa,
+            (value >> bits) & ((1 << (8 * size - bits)) - 1) AS top
+        FROM (SELECT net_blob.id AS id, net_blob.start + net_blob.step *
+            net_time.time AS time, net_blob.size AS size, (CASE net_blob.size
+            WHEN 4 THEN 23 ELSE 52 END) AS bits, (CASE net_blob.size WHEN 4
+            THEN {1} ELSE {2} END) AS value
+        FROM net_blob JOIN net_time ON net_time.time < length(net_blob.pi) /
+            net_blob.size))
+        JOIN net_scale USING (size, top)'''.format(
+        "IF NOT EXISTS" if resume else "", get_blob_decoder(4),
+        get_blob_decoder(8)))
+
+def is_compact(c):
+    """Return True if a database stores net PI as blobs"""
+    c.execute('''SELECT count(*) FROM sqlite_master WHERE type = 'table' AND
+        name = 'net_blob' ''')
+    return bool(c.fetchone()[0])
+
+def create_tables(c, resume = False, compact = False):
+    """Create the tables holding PI results.  If `compact` is set, net PI is
+    stored as one blob per locus, behind a `net` view"""
+    # when resuming, keep whatever tables are already present
+    create = "CREATE TABLE IF NOT EXISTS" if resume else "CREATE TABLE"
+    c.execute('''{0} loci (id INTEGER PRIMARY KEY AUTOINCREMENT, locus TEXT,
+        threshold INT)'''.format(create))
+    if compact:
+        create_compact_net(c, resume)
+    else:
+        c.execute('''{0} net (id INT, time INT, pi FLOAT,
+            FOREIGN KEY(id) REFERENCES loci(id) DEFERRABLE INITIALLY
+            DEFERRED)'''.format(create))
+    c.execute('''{0} discrete (id INT, time INT, pi FLOAT, 
+        FOREIGN KEY(id) REFERENCES loci(id) DEFERRABLE INITIALLY
+        DEFERRED)'''.format(create))
+    c.execute('''{0} interval (id INT, interval TEXT, pi FLOAT,
+        error FLOAT, FOREIGN KEY(id) REFERENCES loci(id) DEFERRABLE
+        INITIALLY DEFERRED)'''.format(create))
+    c.execute('''{0} models (id INT, model TEXT, FOREIGN KEY(id) REFERENCES
+        loci(id) DEFERRABLE INITIALLY DEFERRED)'''.format(create))
+    c.execute('''{0} subsets (id INTEGER PRIMARY KEY AUTOINCREMENT,
+        locus INT, name TEXT, start INT, stop INT, step INT, FOREIGN KEY(locus)
+        REFERENCES loci(id) DEFERRABLE INITIALLY DEFERRED)'''.format(create))
+    c.execute('''{0} subset_net (id INT, time INT, pi FLOAT,
+        FOREIGN KEY(id) REFERENCES subsets(id) DEFERRABLE INITIALLY
+        DEFERRED)'''.format(create))
+    c.execute('''{0} subset_discrete (id INT, time INT, pi FLOAT,
+        FOREIGN KEY(id) REFERENCES subsets(id) DEFERRABLE INITIALLY
+        DEFERRED)'''.format(create))
+    c.execute('''{0} subset_interval (id INT, interval TEXT, pi FLOAT,
+        FOREIGN KEY(id) REFERENCES subsets(id) DEFERRABLE INITIALLY
+        DEFERRED)'''.format(create))
+
+def tune_connection(c):
+    """Set up a connection for bulk loading: a write-ahead log, fewer fsyncs,
+    and a larger page cache"""
+    c.execute("PRAGMA foreign_keys = ON")
+    c.execute("PRAGMA journal_mode = WAL")
+    # with WAL, this is still safe against corruption; we only risk losing
+    # the last commit(s) on power failure, which --resume picks up again
+    c.execute("PRAGMA synchronous = NORMAL")
+    c.execute("PRAGMA temp_store = MEMORY")
+    # in KiB, when negative
+    c.execute("PRAGMA cache_size = -65536")
+
+def create_indexes(c):
+    """Create the indexes the plotting and compare queries use"""
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = set([row[0] for row in c.fetchall()])
+    for name, table, columns in INDEXES:
+        # `net` is a view (indexed through net_blob) in compact databases
+        if table not in tables:
+            continue
+        c.execute("CREATE INDEX IF NOT EXISTS {0} ON {1}({2})".format(name,
+            table, columns))
+    c.execute("ANALYZE")
+
+def drop_indexes(c):
+    """Drop the indexes, before loading many rows"""
+    for name, table, columns in INDEXES:
+        c.execute("DROP INDEX IF EXISTS {0}".format(name))
+
+def finish_probe_db(conn, c):
+    """Index a loaded database and fold the write-ahead log back into it, so
+    the database is a single file again"""
+    create_indexes(c)
+    conn.commit()
+    c.execute("PRAGMA journal_mode = DELETE")
+
+def create_probe_db(db_name, resume = False, compact = False):
+    """Create the PI database.  If `resume` is set, an existing database is
+    opened as-is so that more loci can be added to it"""
     conn = sqlite3.connect(db_name)
     c = conn.cursor()
-    c.execute("PRAGMA foreign_keys = ON")
+    tune_connection(c)
+    if resume:
+        c.execute("SELECT type FROM sqlite_master WHERE name = 'net'")
+        stored = c.fetchone()
+        if stored and (stored[0] == 'view') != bool(compact):
+            conn.close()
+            raise ValueError("{0} stores net PI {1}".format(db_name,
+                "as blobs (use --compact-net)" if stored[0] == 'view' else
+                "as rows (don't use --compact-net)"))
     try:
-        c.execute("CREATE TABLE loci (id INTEGER PRIMARY KEY AUTOINCREMENT, locus TEXT)")
-        c.execute('''CREATE TABLE net (id INT, time INT, pi FLOAT,
-            FOREIGN KEY(id) REFERENCES loci(id) DEFERRABLE INITIALLY
-            DEFERRED)''')
-        c.execute('''CREATE TABLE discrete (id INT, time INT, pi FLOAT, 
-            FOREIGN KEY(id) REFERENCES loci(id) DEFERRABLE INITIALLY
-            DEFERRED)''')
-        c.execute('''CREATE TABLE interval (id INT, interval TEXT, pi FLOAT,
-            error FLOAT, FOREIGN KEY(id) REFERENCES loci(id) DEFERRABLE
-            INITIALLY DEFERRED)''')
+        create_tables(c, resume, compact)
     except sqlite3.OperationalError as e:
         if e[0] == 'table loci already exists':
             answer = raw_input("\n\tPI database already exists.  Overwrite [Y/n]? ")
             if answer == "Y" or "YES":
-                os.remove(db_name)
-                conn, c = create_probe_db(db_name)
+                conn.close()
+                for pth in [db_name, db_name + '-wal', db_name + '-shm']:
+                    if os.path.exists(pth):
+                        os.remove(pth)
+                conn, c = create_probe_db(db_name, compact = compact)
             else:
                 sys.exit(2)
         else:
@@ -41,21 +240,269 @@ def create_probe_db(db_name):
             pdb.set_trace()
     return conn, c
 
-def insert_pi_data(conn, c, pis):
+def get_completed_loci(c):
+    """Return the set of loci already stored in the database"""
+    c.execute("SELECT locus FROM loci")
+    return set([row[0] for row in c.fetchall()])
+
+def get_thresholds(c):
+    """Return the informativeness thresholds PI was stored at (None for loci
+    computed from site rates we were sent)"""
+    c.execute("SELECT DISTINCT threshold FROM loci")
+    return sorted([row[0] for row in c.fetchall()])
+
+def get_threshold(c, threshold = None):
+    """Return the threshold to read PI at: `threshold`, if the database holds
+    PI at it, or, if `threshold` is None, the only one the database holds"""
+    thresholds = get_thresholds(c)
+    if threshold is None:
+        if len(thresholds) > 1:
+            raise ValueError("The database holds PI at several informativeness "
+                "thresholds ({0}); choose one with --threshold".format(
+                ', '.join([str(t) for t in thresholds])))
+        return thresholds[0] if thresholds else None
+    if threshold not in thresholds:
+        raise ValueError("The database holds no PI at a threshold of {0}".format(
+            threshold))
+    return threshold
+
+def get_threshold_clause(threshold):
+    """Return SQL restricting the loci table to the loci at `threshold`"""
+    if threshold is None:
+        return "loci.threshold IS NULL"
+    return "loci.threshold = {0}".format(int(threshold))
+
+def get_locus_models(db_name):
+    """Return a dict of the model hyphy chose for each locus in a database"""
+    conn = sqlite3.connect(db_name)
+    c = conn.cursor()
+    c.execute('''SELECT loci.locus, models.model FROM loci, models WHERE
+        loci.id = models.id''')
+    models = dict(c.fetchall())
+    conn.close()
+    return models
+
+def get_blob(values, dtype):
+    """Pack an array as a blob of big-endian floats"""
+    return sqlite3.Binary(numpy.asarray(values, NET_DTYPES[dtype]).tostring())
+
+def get_array_from_blob(blob, size):
+    """Unpack a blob of big-endian floats of `size` bytes"""
+    return numpy.frombuffer(blob, '>f{0}'.format(size)).astype(numpy.float64)
+
+def extend_net_time(c, length):
+    """Make sure the `net` view can reach `length` values into a blob"""
+    c.execute("SELECT count(*) FROM net_time")
+    count = c.fetchone()[0]
+    if count < length:
+        c.executemany("INSERT INTO net_time VALUES (?)",
+            ((k,) for k in xrange(count, length)))
+
+def insert_pi_data(conn, c, pis, dtype = None, rates = False):
+    """Insert the results for a list of loci, one statement per table per
+    locus.  If `dtype` is set, net PI (and the site rates, if `rates` is set)
+    is stored as one blob of that type per locus.  This doesn't commit, so
+    callers can store many loci in a single transaction.  Returns the key of
+    each locus"""
+    keys = []
+    if dtype and pis:
+        extend_net_time(c, max([len(locus[3]) for locus in pis]))
     for locus in pis:
-        name, rates, mean_rate, pi, pi_net, times, epochs = locus
-        c.execute("INSERT INTO loci(locus) VALUES (?)",
-                (os.path.splitext(os.path.basename(name))[0],))
+        name, site_rates, mean_rate, pi_net, times, epochs, model, subsets, \
+                threshold = locus
+        c.execute("INSERT INTO loci(locus, threshold) VALUES (?,?)",
+                (get_locus_name(name), threshold))
         key = c.lastrowid
-        #pdb.set_trace()
-        for k,v in enumerate(pi_net):
-            c.execute("INSERT INTO net VALUES (?,?,?)", (key, k,
-                v))
+        keys.append(key)
+        if dtype:
+            # net PI is stored by position, from time 0 in steps of 1
+            c.execute("INSERT INTO net_blob VALUES (?,?,?,?,?)", (key, 0, 1,
+                int(NET_DTYPES[dtype][-1]), get_blob(pi_net, dtype)))
+            if rates and site_rates is not None:
+                c.execute("INSERT INTO rates_blob VALUES (?,?,?)", (key,
+                    int(NET_DTYPES[dtype][-1]), get_blob(site_rates, dtype)))
+        else:
+            c.executemany("INSERT INTO net VALUES (?,?,?)",
+                itertools.izip(itertools.repeat(key), itertools.count(),
+                pi_net))
         if times:
-            for k,v in times.iteritems():
-                c.execute("INSERT INTO discrete VALUES (?,?,?)", (key, k, v))
+            c.executemany("INSERT INTO discrete VALUES (?,?,?)",
+                ((key, k, v) for k,v in times.iteritems()))
         if epochs:
-            for k,v in epochs.iteritems():
-                c.execute("INSERT INTO interval VALUES (?,?,?,?)", (key, k,
-                v['sum(integral)'], v['sum(error)']))
-    return
+            c.executemany("INSERT INTO interval VALUES (?,?,?,?)",
+                ((key, k, v['sum(integral)'], v['sum(error)']) for k,v in
+                epochs.iteritems()))
+        if model:
+            c.execute("INSERT INTO models VALUES (?,?)", (key, model))
+        for subset in subsets or []:
+            subset, start, stop, step, subset_net, subset_times, subset_epochs = subset
+            c.execute('''INSERT INTO subsets(locus, name, start, stop, step)
+                VALUES (?,?,?,?,?)''', (key, subset, start, stop, step))
+            subset_key = c.lastrowid
+            if subset_net is not None:
+                c.executemany("INSERT INTO subset_net VALUES (?,?,?)",
+                    itertools.izip(itertools.repeat(subset_key),
+                    itertools.count(), subset_net))
+            c.executemany("INSERT INTO subset_discrete VALUES (?,?,?)",
+                ((subset_key, k, v) for k,v in subset_times.iteritems()))
+            c.executemany("INSERT INTO subset_interval VALUES (?,?,?)",
+                ((subset_key, k, v['sum(integral)']) for k,v in
+                subset_epochs.iteritems()))
+    return keys
+
+def get_net_curves(c, thresholds = None, loci = None):
+    """Yield the locus, times, and net PI of each locus in a database, as
+    arrays, whichever way net PI is stored.  If given, only loci at one of
+    `thresholds`, and only the loci named in `loci`, are read"""
+    clauses, params = [], []
+    if thresholds is not None:
+        clauses.append("(" + " OR ".join([get_threshold_clause(t) for t in
+            thresholds]) + ")")
+    if loci is not None:
+        clauses.append("loci.locus IN ({0})".format(",".join("?" * len(loci))))
+        params.extend(loci)
+    where = ''
+    if clauses:
+        where = "WHERE " + " AND ".join(clauses)
+    if is_compact(c):
+        c.execute('''SELECT loci.locus, start, step, size, pi FROM loci JOIN
+            net_blob USING (id) {0} ORDER BY id'''.format(where), params)
+        for locus, start, step, size, blob in c.fetchall():
+            pi = get_array_from_blob(blob, size)
+            yield locus, start + step * numpy.arange(len(pi)), pi
+    else:
+        c.execute('''SELECT id, loci.locus, time, pi FROM loci JOIN net
+            USING (id) {0} ORDER BY id, time'''.format(where), params)
+        for key, rows in itertools.groupby(c.fetchall(), lambda row: row[0]):
+            ids, loci, times, pi = zip(*rows)
+            yield loci[0], numpy.array(times), numpy.array(pi)
+
+def get_stored_rates(c):
+    """Yield the locus and site rates of each locus whose rates were stored"""
+    if not is_compact(c):
+        return
+    c.execute('''SELECT loci.locus, size, rates FROM loci JOIN rates_blob
+        USING (id) ORDER BY id''')
+    for locus, size, blob in c.fetchall():
+        yield locus, get_array_from_blob(blob, size)
+
+def get_tables(c, schema = 'main'):
+    """Return the names of the tables (not views) in a database"""
+    c.execute("SELECT name FROM {0}.sqlite_master WHERE type = 'table'".format(
+        schema))
+    return set([row[0] for row in c.fetchall()])
+
+def get_columns(c, table, schema = 'main'):
+    """Return the columns of a table"""
+    c.execute("PRAGMA {0}.table_info({1})".format(schema, table))
+    return [row[1] for row in c.fetchall()]
+
+def get_intervals_and_times(c, schema = 'main'):
+    """Return the intervals and the times of interest in a database"""
+    c.execute("SELECT DISTINCT interval FROM {0}.interval ORDER BY interval".format(
+        schema))
+    intervals = [row[0] for row in c.fetchall()]
+    c.execute("SELECT DISTINCT time FROM {0}.discrete ORDER BY time".format(
+        schema))
+    return intervals, [row[0] for row in c.fetchall()]
+
+def create_merged_table(c):
+    """Create the table listing the databases merged into this one"""
+    c.execute("CREATE TABLE IF NOT EXISTS shards (path TEXT PRIMARY KEY)")
+
+def get_merged_shards(c):
+    """Return the set of databases merged into this one"""
+    create_merged_table(c)
+    c.execute("SELECT path FROM shards")
+    return set([row[0] for row in c.fetchall()])
+
+def copy_shard(c, tables):
+    """Copy the tables of the database attached as `shard` to the end of the
+    main database, offsetting its keys past those already there"""
+    offsets = {}
+    for table in ['loci', 'subsets']:
+        c.execute("SELECT coalesce(max(id), 0) FROM main.{0}".format(table))
+        offsets[table] = c.fetchone()[0]
+    for table, keys in MERGE_TABLES:
+        if table not in tables:
+            continue
+        columns = get_columns(c, table)
+        present = set(get_columns(c, table, 'shard'))
+        # columns added since the shard was made are left NULL
+        values = []
+        for column in columns:
+            if column not in present:
+                values.append("NULL")
+            elif column in keys:
+                values.append("{0} + {1}".format(column, offsets[keys[column]]))
+            else:
+                values.append(column)
+        c.execute("INSERT INTO main.{0}({1}) SELECT {2} FROM shard.{0}".format(
+            table, ', '.join(columns), ', '.join(values)))
+    if 'net_blob' in tables:
+        c.execute("SELECT max(length(pi) / size) FROM shard.net_blob")
+        extend_net_time(c, c.fetchone()[0] or 0)
+
+def merge_databases(db_name, shards, resume = False, finish = True):
+    """Merge the PI databases in `shards`, one at a time, into a new database
+    (or, if `resume` is set, into an existing one, skipping shards already
+    in it).  The intervals and times of interest must be the same in every
+    shard.  Returns the number of shards merged"""
+    if os.path.exists(db_name) and not resume:
+        raise ValueError("{0} already exists".format(db_name))
+    # opening (or attaching) a missing file would create it
+    for shard in shards:
+        if not os.path.isfile(shard):
+            raise IOError("{0} does not exist".format(shard))
+    # the storage of net PI follows the first shard
+    compact = False
+    if shards:
+        conn = sqlite3.connect(shards[0])
+        compact = is_compact(conn.cursor())
+        conn.close()
+    conn, c = create_probe_db(db_name, resume = True, compact = compact)
+    drop_indexes(c)
+    done = get_merged_shards(c)
+    tables = get_tables(c)
+    c.execute("SELECT count(*) FROM loci")
+    reference = get_intervals_and_times(c) if c.fetchone()[0] else None
+    conn.commit()
+    merged = 0
+    for shard in shards:
+        shard = os.path.abspath(shard)
+        if shard in done:
+            continue
+        c.execute("ATTACH DATABASE ? AS shard", (shard,))
+        try:
+            shard_tables = get_tables(c, 'shard')
+            if 'loci' not in shard_tables:
+                raise ValueError("{0} is not a PI database".format(shard))
+            if ('net_blob' in shard_tables) != compact:
+                raise ValueError("{0} doesn't store net PI {1}".format(shard,
+                    "as blobs" if compact else "as rows"))
+            c.execute("SELECT count(*) FROM shard.loci")
+            if c.fetchone()[0]:
+                found = get_intervals_and_times(c, 'shard')
+                if reference is None:
+                    reference = found
+                elif found != reference:
+                    raise ValueError("intervals or times in {0} differ from "
+                        "those already merged".format(shard))
+                copy_shard(c, tables & shard_tables)
+            # a merged database passes on the shards it was made from
+            if 'shards' in shard_tables:
+                c.execute("INSERT INTO shards SELECT path FROM shard.shards")
+            else:
+                c.execute("INSERT INTO shards VALUES (?)", (shard,))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            c.execute("DETACH DATABASE shard")
+        merged += 1
+    if finish:
+        finish_probe_db(conn, c)
+    c.close()
+    conn.close()
+    return merged
@@ -0,0 +1,117 @@
+"""
+File: hyphy.py
+
+Description: run hyphy jobs with timeouts and retries
+
+"""
+
+import os
+import json
+import time
+import tempfile
+
+from subprocess import Popen, PIPE, STDOUT
+
+
+class HyphyError(Exception):
+    """hyphy failed, possibly transiently"""
+    pass
+
+class HyphyTimeout(HyphyError):
+    """hyphy ran longer than we allow"""
+    pass
+
+class HyphyNotFound(Exception):
+    """the hyphy executable could not be started"""
+    pass
+
+def is_complete_rates_file(output):
+    """Returns True once hyphy has finished writing a parseable rates file"""
+    try:
+        with open(output) as f:
+            data = json.load(f)
+        return "rates" in data["sites"]
+    except (IOError, ValueError, KeyError, TypeError):
+        return False
+
+def wait_for_rates_file(output, timeout = 10., poll = 0.1):
+    """Wait up to `timeout` seconds for a complete rates file at `output`"""
+    deadline = time.time() + timeout
+    while not is_complete_rates_file(output):
+        if time.time() > deadline:
+            raise HyphyError("hyphy did not write {0}".format(output))
+        time.sleep(poll)
+
+def run_hyphy_process(hyphy, template, towrite, timeout = None, poll = 0.1):
+    """Run hyphy on `template`, sending it `towrite`, and killing it if it runs
+    longer than `timeout` seconds.  Returns what hyphy wrote to stdout"""
+    # send stdout to a file, so a chatty job can't fill the pipe and block
+    # while we are polling it
+    log = tempfile.TemporaryFile()
+    try:
+        try:
+            job = Popen([hyphy, template], stdin=PIPE, stdout=log, stderr=STDOUT)
+        except OSError as e:
+            if e.errno == 2:
+                raise HyphyNotFound("hyphy not found")
+            raise HyphyNotFound("couldn't communicate with hyphy: {0}".format(e))
+        job.stdin.write(towrite)
+        job.stdin.close()
+        start = time.time()
+        while job.poll() is None:
+            if timeout and time.time() - start > timeout:
+                job.kill()
+                job.wait()
+                raise HyphyTimeout("hyphy timed out after {0} seconds".format(timeout))
+            time.sleep(poll)
+        log.seek(0)
+        stdout = log.read()
+    finally:
+        log.close()
+    if stdout.startswith("Error") or job.returncode != 0:
+        raise HyphyError("hyphy error ({0}): {1}".format(job.returncode, stdout))
+    return stdout
+
+def run_hyphy_once(hyphy, template, towrite, output, timeout = None,
+        poll = 0.1):
+    """Run a single hyphy job and return its output once `output` is
+    completely written"""
+    if os.path.exists(output):
+        os.remove(output)
+    stdout = run_hyphy_process(hyphy, template, towrite, timeout, poll)
+    wait_for_rates_file(output, poll = poll)
+    return stdout
+
+def run_hyphy(hyphy, template, towrite, output, timeout = None, retries = 0,
+        poll = 0.1):
+    """Run a hyphy job, retrying up to `retries` times if it fails, times out,
+    or doesn't write a complete rates file"""
+    for attempt in xrange(retries + 1):
+        try:
+            return run_hyphy_once(hyphy, template, towrite, output, timeout,
+                poll)
+        except HyphyError as e:
+            error = e
+    raise error
+
+def run_hyphy_batch(hyphy, batch_template, template, tree, jobs,
+        timeout = None, retries = 0, poll = 0.1):
+    """Run `template` for several (alignment, output, models) jobs against the
+    same tree from a single hyphy process driven by `batch_template`.  Any job
+    without a complete rates file afterwards is rerun on its own.  `timeout`
+    applies per job"""
+    for alignment, output, models in jobs:
+        if os.path.exists(output):
+            os.remove(output)
+    towrite = "\n".join([template, tree, str(len(jobs))] +
+            [line for job in jobs for line in job])
+    try:
+        run_hyphy_process(hyphy, batch_template, towrite,
+            timeout * len(jobs) if timeout else None, poll)
+    except HyphyError:
+        # whatever the batch didn't finish is picked up below
+        pass
+    for alignment, output, models in jobs:
+        if not is_complete_rates_file(output):
+            run_hyphy(hyphy, template, "\n".join([alignment, tree, output,
+                models]), output, timeout, retries, poll)
@@ -0,0 +1,129 @@
+"""
+File: newick.py
+
+Description: read and write newick trees as flat arrays, without building a
+tree of objects
+
+"""
+
+import re
+import numpy
+
+# a quoted label, a comment, a delimiter, or an unquoted label/length
+TOKENS = re.compile(r"""\s*(?:('(?:[^']|'')*')|(\[[^\]]*\])|([(),:;])|([^\s(),:;\[\]']+))""")
+
+
+class NewickError(Exception):
+    """the tree isn't newick we can read"""
+    pass
+
+def parse_newick(string):
+    """Parse the first tree in a newick string.  Returns the parent of each
+    node (-1 for the root), the length of the edge above each node (nan if
+    there is none), and each node's label (as written, '' if there is none),
+    with nodes in preorder"""
+    parents, lengths, labels = [-1], [numpy.nan], ['']
+    current, depth, length, ended = 0, 0, False, False
+    position = 0
+    for match in TOKENS.finditer(string):
+        if match.start() != position:
+            raise NewickError("unexpected characters at {0}".format(position))
+        position = match.end()
+        quoted, comment, delimiter, word = match.groups()
+        if comment:
+            continue
+        if length:
+            try:
+                lengths[current] = float(word)
+            except (TypeError, ValueError):
+                raise NewickError("bad branch length: {0}".format(match.group()))
+            length = False
+        elif delimiter == '(':
+            depth += 1
+            parents.append(current)
+            lengths.append(numpy.nan)
+            labels.append('')
+            current = len(parents) - 1
+        elif delimiter == ',':
+            if not depth:
+                raise NewickError("',' outside of parentheses")
+            parents.append(parents[current])
+            lengths.append(numpy.nan)
+            labels.append('')
+            current = len(parents) - 1
+        elif delimiter == ')':
+            depth -= 1
+            if depth < 0:
+                raise NewickError("unbalanced parentheses")
+            current = parents[current]
+        elif delimiter == ':':
+            length = True
+        elif delimiter == ';':
+            ended = True
+            break
+        else:
+            if labels[current] or not numpy.isnan(lengths[current]):
+                raise NewickError("unexpected label: {0}".format(match.group()))
+            labels[current] = quoted or word
+    if not ended and string[position:].strip():
+        raise NewickError("unexpected characters at {0}".format(position))
+    if depth or length:
+        raise NewickError("incomplete tree")
+    return numpy.array(parents), numpy.array(lengths), labels
+
+def get_newick_from_path(path):
+    """Parse the first tree in a newick file"""
+    with open(path) as f:
+        return parse_newick(f.read())
+
+def get_children(parents):
+    """Return the children of each node, in order"""
+    children = [[] for parent in parents]
+    for node, parent in enumerate(parents):
+        if parent >= 0:
+            children[parent].append(node)
+    return children
+
+def get_tree_stats(parents, lengths):
+    """Return the depth (greatest distance from the root to a tip), the total
+    branch length, and the number of leaves of a parsed tree"""
+    edges = numpy.nan_to_num(lengths)
+    leaves = numpy.ones(len(parents), dtype = bool)
+    leaves[parents[parents >= 0]] = False
+    # plain lists are much faster than arrays element-by-element
+    up, edge = parents.tolist(), edges.tolist()
+    distance = [0.] * len(up)
+    # children always follow their parents in preorder
+    for node in xrange(len(up) - 1, 0, -1):
+        parent = up[node]
+        distance[parent] = max(distance[parent], edge[node] + distance[node])
+    return distance[0], float(edges.sum()), int(leaves.sum())
+
+def write_newick(parents, lengths, labels):
+    """Write a parsed tree as a newick string"""
+    children = get_children(parents)
+    def suffix(node):
+        if numpy.isnan(lengths[node]):
+            return labels[node]
+        return "{0}:{1!r}".format(labels[node], float(lengths[node]))
+    out = []
+    stack = [0]
+    # None closes the node below it on the stack, -1 separates siblings
+    while stack:
+        node = stack.pop()
+        if node is None:
+            out.append(')')
+            out.append(suffix(stack.pop()))
+        elif node < 0:
+            out.append(',')
+        elif children[node]:
+            out.append('(')
+            stack.extend([node, None])
+            for k, child in enumerate(reversed(children[node])):
+                if k:
+                    stack.append(-1)
+                stack.append(child)
+        else:
+            out.append(suffix(node))
+    out.append(';')
+    return ''.join(out)
@@ -0,0 +1,214 @@
+"""
+File: rates.py
+
+Description: estimate site rates in-process, as an alternative to hyphy
+
+"""
+
+import numpy
+import dendropy
+
+from scipy import optimize
+
+from compute import get_alignment
+
+# map nucleotides to states 0-3; gaps, ambiguities, and the rest are missing (4)
+STATES = numpy.zeros(256, dtype = numpy.uint8) + 4
+STATES[numpy.frombuffer(b'ACGTacgt', dtype = numpy.uint8)] = [0, 1, 2, 3] * 2
+
+# the partial likelihood of each state at a tip
+TIP_PARTIALS = numpy.vstack((numpy.eye(4), numpy.ones(4)))
+
+# grid used to bracket the ML rate of each site pattern before refining it
+RATE_GRID = numpy.concatenate(([0.], numpy.logspace(-4, 3, 71)))
+
+GOLDEN = (numpy.sqrt(5.) - 1.) / 2.
+
+# limits on the exchangeabilities (relative to GT) and on the overall rate
+# fit alongside them
+EXCHANGEABILITY_BOUNDS = (1e-2, 1e2)
+
+# a site whose best log-likelihood is within this of its likelihood at the top
+# of RATE_GRID has no identifiable rate
+PLATEAU = 1e-6
+
+
+def get_site_patterns(states):
+    """Collapse a taxa x sites array of states into its unique site patterns.
+    Returns the patterns (taxa x patterns), the number of sites with each
+    pattern, and the pattern of each site"""
+    # view each column as a single record so numpy.unique compares columns
+    columns = numpy.ascontiguousarray(states.T)
+    records = columns.view(numpy.dtype((numpy.void, columns.shape[1])))
+    unique, index, inverse = numpy.unique(records.ravel(), return_index = True,
+            return_inverse = True)
+    return states[:, index], numpy.bincount(inverse), inverse
+
+def get_base_frequencies(states):
+    """Empirical base frequencies of an array of states, ignoring missing data"""
+    counts = numpy.bincount(states.ravel(), minlength = 5)[:4] + 1.
+    return counts / counts.sum()
+
+def get_rate_matrix(exchangeabilities, freqs):
+    """Build a GTR rate matrix from the six exchangeabilities (AC, AG, AT, CG,
+    CT, GT), scaled to one expected substitution per unit time"""
+    Q = numpy.zeros((4, 4))
+    Q[numpy.triu_indices(4, 1)] = exchangeabilities
+    Q = (Q + Q.T) * freqs
+    Q[numpy.diag_indices(4)] = -Q.sum(1)
+    return Q / -numpy.dot(freqs, numpy.diag(Q))
+
+def get_eigensystem(Q, freqs):
+    """Decompose reversible Q through its symmetric form, so P(t) = left *
+    exp(values * t) * right"""
+    root = numpy.sqrt(freqs)
+    values, vectors = numpy.linalg.eigh(Q * root[:, None] / root[None, :])
+    return values, vectors / root[:, None], vectors.T * root[None, :]
+
+def get_transition_matrices(eigensystem, lengths):
+    """Transition matrices for an array of branch lengths, with shape
+    lengths.shape + (4, 4)"""
+    values, left, right = eigensystem
+    exp = numpy.exp(numpy.multiply.outer(lengths, values))
+    # clip the rounding error that can leave tiny negative probabilities
+    return numpy.maximum(numpy.dot(left * exp[..., None, :], right), 0.)
+
+def get_pruning_order(tree, labels):
+    """Walk a dendropy tree in postorder.  Returns a list of (children, rows,
+    lengths) for each internal node, where children index earlier entries in
+    the list and rows index `labels` for tips (-1 if the taxon is absent from
+    the alignment).  The root comes last"""
+    rows = dict([(label, row) for row, label in enumerate(labels)])
+    missing = set(labels) - set([leaf.taxon.label for leaf in tree.leaf_nodes()])
+    if missing:
+        raise ValueError("taxa missing from the tree: {0}".format(
+                ', '.join(sorted(missing))))
+    order, index = [], {}
+    for node in tree.postorder_node_iter():
+        if node.is_leaf():
+            continue
+        children, tips, lengths = [], [], []
+        for child in node.child_nodes():
+            if child.is_leaf():
+                children.append(-1)
+                tips.append(rows.get(child.taxon.label, -1))
+            else:
+                children.append(index[child])
+                tips.append(-1)
+            lengths.append(child.edge.length or 0.)
+        index[node] = len(order)
+        order.append((children, tips, numpy.array(lengths)))
+    return order
+
+def get_pattern_log_likelihoods(order, patterns, freqs, eigensystem, rates):
+    """Log-likelihood of each site pattern at each rate.  `rates` has shape
+    (1, R) to evaluate every pattern at the same R rates, or (patterns, R) to
+    give every pattern its own rates.  Returns a patterns x R array"""
+    count = patterns.shape[1]
+    tips = TIP_PARTIALS[patterns]
+    partials, scale = [], numpy.zeros((count, rates.shape[1]))
+    for children, rows, lengths in order:
+        node = 1.
+        for child, row, length in zip(children, rows, lengths):
+            P = get_transition_matrices(eigensystem, rates * length)
+            if child < 0:
+                partial = tips[row][:, None, :] if row >= 0 else numpy.ones(4)
+            else:
+                partial = partials[child]
+                # free children as we go; each is only needed once
+                partials[child] = None
+            node = node * (P * partial[..., None, :]).sum(-1)
+        # rescale to avoid underflow on big trees
+        biggest = node.max(-1)
+        biggest[biggest == 0] = 1.
+        node = node / biggest[..., None]
+        scale += numpy.log(biggest)
+        partials.append(node)
+    with numpy.errstate(divide = 'ignore'):
+        return numpy.log(numpy.dot(partials[-1], freqs)) + scale
+
+def get_exchangeabilities(order, patterns, counts, freqs):
+    """Maximum-likelihood GTR exchangeabilities for the alignment, relative to
+    GT, with all sites evolving at the same rate.  That rate is fit alongside
+    them (hyphy refits the branch lengths instead), and every parameter is
+    optimized on a log scale within EXCHANGEABILITY_BOUNDS, so the few changes
+    of a short locus can't drive them to degenerate values"""
+    def cost(parameters):
+        exchangeabilities = numpy.append(numpy.exp(parameters[:5]), 1.)
+        eigensystem = get_eigensystem(get_rate_matrix(exchangeabilities, freqs),
+                freqs)
+        lnL = get_pattern_log_likelihoods(order, patterns, freqs, eigensystem,
+                numpy.exp(parameters[5:]).reshape(1, 1))[:, 0]
+        return -numpy.dot(counts, lnL)
+    bounds = numpy.log(EXCHANGEABILITY_BOUNDS)
+    best, lnL, info = optimize.fmin_l_bfgs_b(cost, numpy.zeros(6),
+            approx_grad = True, bounds = [bounds] * 6, pgtol = 1e-4)
+    return numpy.append(numpy.exp(best[:5]), 1.)
+
+def get_grid_climb(lnL, start):
+    """Index of the grid point each row of `lnL` climbs to from `start`, going
+    uphill in whichever direction the likelihood first rises"""
+    rises = numpy.diff(lnL, axis = 1) > 0
+    # uphill to higher rates, until the likelihood stops rising
+    stops = ~rises[:, start:]
+    above = start + numpy.where(stops.any(1), stops.argmax(1), stops.shape[1])
+    # or downhill to lower rates, until it would fall
+    stops = rises[:, :start][:, ::-1]
+    below = start - numpy.where(stops.any(1), stops.argmax(1), start)
+    return numpy.where(rises[:, start], above, below)
+
+def get_pattern_rates(order, patterns, freqs, eigensystem, iterations = 30):
+    """Maximum-likelihood rate of each site pattern on the fixed tree.  Like
+    hyphy, the search starts from a rate of 1 and climbs to the nearest
+    maximum, which is bracketed on RATE_GRID, then refined by a golden-section
+    search run over all patterns at once.  Patterns whose likelihood is no
+    better there than at the top of the grid (where the tips are saturated,
+    or with only one taxon) have no identifiable rate, and get nan"""
+    lnL = get_pattern_log_likelihoods(order, patterns, freqs, eigensystem,
+            RATE_GRID[None, :])
+    best = get_grid_climb(lnL, numpy.abs(RATE_GRID - 1.).argmin())
+    low = RATE_GRID[numpy.maximum(best - 1, 0)]
+    high = RATE_GRID[numpy.minimum(best + 1, len(RATE_GRID) - 1)]
+    for i in xrange(iterations):
+        step = GOLDEN * (high - low)
+        probes = numpy.column_stack((high - step, low + step))
+        lnL_probes = get_pattern_log_likelihoods(order, patterns, freqs,
+                eigensystem, probes)
+        left = lnL_probes[:, 0] >= lnL_probes[:, 1]
+        high = numpy.where(left, probes[:, 1], high)
+        low = numpy.where(left, low, probes[:, 0])
+    rates = (low + high) / 2.
+    at_best = get_pattern_log_likelihoods(order, patterns, freqs, eigensystem,
+            rates[:, None])[:, 0]
+    rates[at_best - lnL[:, -1] < PLATEAU] = numpy.nan
+    return rates
+
+def get_site_rates(states, tree, labels, model = 'GTR'):
+    """Estimate the rate of each site of a taxa x sites array of states on a
+    dendropy tree, in substitutions per unit of tree length"""
+    order = get_pruning_order(tree, labels)
+    freqs = get_base_frequencies(states)
+    patterns, counts, inverse = get_site_patterns(states)
+    if model == 'GTR':
+        exchangeabilities = get_exchangeabilities(order, patterns, counts, freqs)
+    else:
+        exchangeabilities = numpy.ones(6)
+    eigensystem = get_eigensystem(get_rate_matrix(exchangeabilities, freqs),
+            freqs)
+    rates = get_pattern_rates(order, patterns, freqs, eigensystem)
+    # nothing is known about the rate of a site without data
+    rates[(patterns < 4).sum(0) == 0] = numpy.nan
+    return rates[inverse]
+
+def estimate_site_rates(alignment, tree, model = 'GTR', correction = 1):
+    """Estimate site rates for an `alignment` on the fixed newick `tree`
+    without hyphy.  Returns an array like parse_site_rates()"""
+    labels, characters = get_alignment(alignment)
+    return estimate_array_site_rates(labels, characters, tree, model,
+        correction)
+
+def estimate_array_site_rates(labels, characters, tree, model = 'GTR',
+        correction = 1):
+    """As estimate_site_rates(), for a taxa x sites array of characters"""
+    tree = dendropy.Tree.get_from_path(tree, 'newick')
+    return get_site_rates(STATES[characters], tree, labels, model) / correction
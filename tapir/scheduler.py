@@ -0,0 +1,134 @@
+"""
+File: scheduler.py
+
+Description: stream work through a pool of processes
+
+"""
+
+import os
+import heapq
+import Queue
+import threading
+import traceback
+
+from multiprocessing import Pool, cpu_count
+
+# Queue.get() without a timeout cannot be interrupted in python 2
+WAIT = 2**31
+
+# marks the end of the items handed to a stage
+DONE = object()
+
+
+def get_cores(cores = None):
+    """Return the number of worker processes to use, leaving a core free for
+    the parent if no number is given"""
+    if cores:
+        return max(1, cores)
+    return max(1, cpu_count() - 1)
+
+def get_file_size(path):
+    """Return the size of a file, or 0 if we can't"""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def sort_by_size(items, path = lambda item: item):
+    """Sort items so that those with the largest files come first"""
+    return sorted(items, key = lambda item: get_file_size(path(item)),
+        reverse = True)
+
+def get_shard_items(items, index, count, size, name):
+    """Return the items in shard `index` (from 0) of `count` shards of about
+    equal total size.  Items are dealt, largest first, to the shard with the
+    least so far (ties broken by `name`, then shard number), so every node
+    given the same items computes the same shards"""
+    sized = sorted([(-size(item), name(item), k) for k, item in
+        enumerate(items)])
+    loads = [(0, shard) for shard in xrange(count)]
+    chosen = []
+    for negative, item_name, k in sized:
+        load, shard = heapq.heappop(loads)
+        if shard == index:
+            chosen.append(items[k])
+        heapq.heappush(loads, (load - negative, shard))
+    return chosen
+
+def _call(func, item):
+    """Run func(item) in a worker, returning exceptions rather than raising
+    them, because python 2 pools drop errors raised by apply_async tasks"""
+    try:
+        return True, func(item)
+    except Exception:
+        return False, traceback.format_exc()
+
+def _unwrap(result):
+    ok, value = result
+    if not ok:
+        raise Exception("worker failed:\n{0}".format(value))
+    return value
+
+def imap_bounded(func, items, processes = 1, max_pending = None):
+    """Yield func(item) for each of `items`, in the order results complete,
+    keeping no more than `max_pending` tasks outstanding at a time"""
+    if processes <= 1:
+        for item in items:
+            yield func(item)
+        return
+    if not max_pending:
+        max_pending = 2 * processes
+    pool = Pool(processes)
+    results = Queue.Queue()
+    pending = 0
+    try:
+        for item in items:
+            pool.apply_async(_call, (func, item), callback = results.put)
+            pending += 1
+            while pending >= max_pending:
+                pending -= 1
+                yield _unwrap(results.get(True, WAIT))
+        while pending:
+            pending -= 1
+            yield _unwrap(results.get(True, WAIT))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def imap_threaded(func, items, threads = 1, max_pending = None):
+    """Yield func(item) for each of `items`, in the order results complete,
+    using background threads.  Suited to stages that wait on subprocesses or
+    I/O, and lets the consumer run while the threads work.  At most
+    `max_pending` items are queued on either side of the threads"""
+    threads = max(1, threads)
+    if not max_pending:
+        max_pending = 2 * threads
+    inbox = Queue.Queue(max_pending)
+    outbox = Queue.Queue(max_pending)
+    def feed():
+        for item in items:
+            inbox.put(item)
+        for i in xrange(threads):
+            inbox.put(DONE)
+    def work():
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                outbox.put(DONE)
+                return
+            outbox.put(_call(func, item))
+    for target in [feed] + [work] * threads:
+        thread = threading.Thread(target = target)
+        # don't hang the interpreter if the consumer gives up early
+        thread.daemon = True
+        thread.start()
+    finished = 0
+    while finished < threads:
+        result = outbox.get(True, WAIT)
+        if result is DONE:
+            finished += 1
+        else:
+            yield _unwrap(result)
@@ -0,0 +1,139 @@
+"""
+File: store.py
+
+Description: a columnar store of PI results - loci x time, loci x time of
+interest, and loci x epoch .npy matrices that open as memory maps - kept
+alongside (and catalogued in) the PI database
+
+"""
+
+import os
+import numpy
+import struct
+
+# room for the .npy header, so it can be rewritten in place as rows are
+# added.  a multiple of 64, as numpy likes
+HEADER_SIZE = 128
+
+# the matrices in a store, in the order they are written
+STORE_MATRICES = ['net', 'times', 'epochs']
+
+
+def get_store_path(db_name):
+    """Return the directory of the store kept alongside a PI database"""
+    return "{0}-store".format(os.path.splitext(db_name)[0])
+
+def get_npy_header(shape):
+    """Return a .npy (version 1.0) header for a C-ordered float64 array,
+    padded to HEADER_SIZE bytes"""
+    header = "{{'descr': '<f8', 'fortran_order': False, 'shape': {0!r}, }}".format(
+        tuple([int(i) for i in shape]))
+    header = header.ljust(HEADER_SIZE - 11) + '\n'
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+
+def create_store_tables(c):
+    """Create the tables cataloguing the store: the row of each locus, and
+    the number of columns of each matrix"""
+    c.execute('''CREATE TABLE IF NOT EXISTS store (id INTEGER PRIMARY KEY,
+        row INT, FOREIGN KEY(id) REFERENCES loci(id) DEFERRABLE INITIALLY
+        DEFERRED)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS store_matrices (matrix TEXT
+        PRIMARY KEY, columns INT)''')
+
+def open_store_for_writing(c, path, time, times, epochs):
+    """Open (or create) the store at `path` to add loci to it.  Rows the
+    database doesn't know about (from an interrupted run) are dropped"""
+    create_store_tables(c)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    labels = {
+            'net':numpy.ravel(time),
+            'times':numpy.array(times),
+            'epochs':numpy.array(["{0}-{1}".format(*span) for span in epochs]),
+        }
+    c.execute("SELECT matrix, columns FROM store_matrices")
+    stored = dict(c.fetchall())
+    c.execute("SELECT count(*) FROM store")
+    rows = c.fetchone()[0]
+    files = []
+    for matrix in STORE_MATRICES:
+        columns = len(labels[matrix])
+        if matrix in stored and stored[matrix] != columns:
+            raise ValueError("the {0} matrix in {1} has {2} columns, not {3}".format(
+                matrix, path, stored[matrix], columns))
+        c.execute("INSERT OR REPLACE INTO store_matrices VALUES (?,?)", (matrix,
+            columns))
+        numpy.save(os.path.join(path, "{0}-columns.npy".format(matrix)),
+            labels[matrix])
+        pth = os.path.join(path, "{0}.npy".format(matrix))
+        f = open(pth, 'r+b' if os.path.exists(pth) else 'w+b')
+        size = HEADER_SIZE + rows * columns * 8
+        f.seek(0, os.SEEK_END)
+        if rows and f.tell() < size:
+            raise ValueError("{0} is missing rows".format(pth))
+        f.truncate(size)
+        f.seek(0)
+        f.write(get_npy_header((rows, columns)))
+        f.seek(size)
+        files.append((matrix, f, columns))
+    return {'path':path, 'rows':rows, 'files':files, 'times':times,
+        'epochs':labels['epochs']}
+
+def get_store_rows(store, locus):
+    """Return the row of each matrix for a locus"""
+    name, rates, mean_rate, pi_net, times, epochs, model, subsets, \
+            threshold = locus
+    return {
+            'net':pi_net,
+            'times':[times[t] for t in store['times']],
+            'epochs':[epochs[e]['sum(integral)'] for e in store['epochs']],
+        }
+
+def append_to_store(store, c, keys, pis):
+    """Add loci (with the database `keys` they were stored under) to the end
+    of the store.  Call sync_store once the database is committed"""
+    for key, locus in zip(keys, pis):
+        rows = get_store_rows(store, locus)
+        for matrix, f, columns in store['files']:
+            row = numpy.asarray(rows[matrix], dtype = '<f8')
+            if row.shape != (columns,):
+                raise ValueError("expected {0} values for the {1} matrix, not {2}".format(
+                    columns, matrix, row.size))
+            f.write(row.tostring())
+        c.execute("INSERT INTO store VALUES (?,?)", (key, store['rows']))
+        store['rows'] += 1
+    for matrix, f, columns in store['files']:
+        f.flush()
+
+def sync_store(store):
+    """Make the rows added so far visible to readers of the store"""
+    for matrix, f, columns in store['files']:
+        position = f.tell()
+        f.seek(0)
+        f.write(get_npy_header((store['rows'], columns)))
+        f.flush()
+        f.seek(position)
+
+def close_store(store):
+    """Close the files of a store opened for writing"""
+    for matrix, f, columns in store['files']:
+        f.close()
+
+def open_store(c, path):
+    """Open the store at `path`, catalogued in the database of cursor `c`.
+    Returns the (locus, threshold) of each row, and a dict of the matrices
+    (as read-only memory maps) and of their column labels"""
+    c.execute('''SELECT loci.locus, loci.threshold FROM store JOIN loci USING
+        (id) ORDER BY row''')
+    loci = c.fetchall()
+    matrices, labels = {}, {}
+    for matrix in STORE_MATRICES:
+        matrices[matrix] = numpy.load(os.path.join(path,
+            "{0}.npy".format(matrix)), mmap_mode = 'r')
+        labels[matrix] = numpy.load(os.path.join(path,
+            "{0}-columns.npy".format(matrix)))
+    # while a run is writing, the database and the store can be a batch apart
+    rows = min([len(loci)] + [len(m) for m in matrices.values()])
+    for matrix in STORE_MATRICES:
+        matrices[matrix] = matrices[matrix][:rows]
+    return loci[:rows], matrices, labels
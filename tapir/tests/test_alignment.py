@@ -0,0 +1,151 @@
+"""
+File: test_alignment.py
+
+Description: test methods for tapir.alignment
+
+"""
+
+import os
+import gzip
+import numpy
+import shutil
+import unittest
+import tempfile
+from tapir.alignment import *
+from tapir import get_test_files
+from tapir.compute import get_dendropy_alignment
+
+#import pdb
+
+FASTA = """>tax_1 first
+ACGT-
+AC
+>tax2
+ACGTN
+?T
+"""
+
+PHYLIP = """2 7
+tax_1 ACGT-AC
+tax2  ACGTN?T
+"""
+
+INTERLEAVED_PHYLIP = """2 7
+tax_1 ACGT
+tax2  ACGT
+
+-AC
+N?T
+"""
+
+INTERLEAVED_NEXUS = """#NEXUS
+begin data;
+    dimensions ntax=2 nchar=7;
+    format datatype=dna interleave=yes missing=? gap=-;
+matrix
+tax_1 ACGT [a comment]
+'tax2' ACG{AT}
+
+tax_1 -AC
+'tax2' N?T
+;
+end;
+"""
+
+SETS = """
+begin sets;
+    charset first = 1-3;
+    charset 'second one' = 4-.;
+    charset codon_3 = 1-7\\3;
+    charset [split] split = 1 5 - 6;
+end;
+"""
+
+class TestAlignment(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = get_test_files()
+        self.temp = tempfile.mkdtemp()
+        self.labels = ['tax 1', 'tax2']
+        self.expected = numpy.array([list('ACGT-AC'), list('ACGTN?T')])
+
+    def write(self, name, contents, compress = False):
+        pth = os.path.join(self.temp, name)
+        f = gzip.open(pth, 'wb') if compress else open(pth, 'w')
+        f.write(contents)
+        f.close()
+        return pth
+
+    def check(self, pth, format = None):
+        labels, array = read_alignment(pth, format)
+        assert array.dtype == numpy.uint8
+        assert labels == self.labels
+        assert (array.view('S1') == self.expected).all()
+
+    def test_fasta(self):
+        self.check(self.write('test.fasta', FASTA))
+
+    def test_phylip(self):
+        self.check(self.write('test.phy', PHYLIP))
+        self.check(self.write('test2.phy', INTERLEAVED_PHYLIP))
+
+    def test_interleaved_nexus(self):
+        self.expected[1, 3] = '?'
+        self.check(self.write('test.nex', INTERLEAVED_NEXUS))
+
+    def test_gzip(self):
+        self.check(self.write('test.fasta.gz', FASTA, True))
+        uncompressed = get_uncompressed(os.path.join(self.temp,
+            'test.fasta.gz'), self.temp)
+        assert open(uncompressed).read() == FASTA
+
+    def test_sniff_format(self):
+        self.check(self.write('test.txt', FASTA))
+        self.check(self.write('test2.txt', PHYLIP))
+
+    def test_bad_alignments(self):
+        self.assertRaises(AlignmentError, read_alignment,
+            self.write('ragged.fasta', ">a\nACGT\n>b\nAC\n"))
+        self.assertRaises(AlignmentError, read_alignment,
+            self.write('empty.fasta', ""))
+        self.assertRaises(AlignmentError, read_alignment,
+            self.write('short.phy', "2 7\ntax_1 ACGT\n"))
+
+    def test_nexus_against_dendropy(self):
+        for name in ['chr1_918.nex', 'informativeness_cutoff.nex']:
+            pth = os.path.join(self.loc, name)
+            labels, array = read_alignment(pth)
+            expected_labels, expected = get_dendropy_alignment(pth)
+            assert labels == expected_labels
+            assert (array == expected).all()
+
+    def test_charsets(self):
+        charsets = parse_charsets(INTERLEAVED_NEXUS + SETS, 7)
+        # underscores in charset names are kept
+        assert [name for name, slices in charsets] == ['first', 'second one',
+            'codon_3', 'split']
+        labels, array = read_alignment(self.write('test.fasta', FASTA))
+        characters = array.view('S1')
+        partitions = [get_partition(characters, s) for n, s in charsets]
+        assert (partitions[0] == self.expected[:, :3]).all()
+        assert (partitions[1] == self.expected[:, 3:]).all()
+        assert (partitions[2] == self.expected[:, [0, 3, 6]]).all()
+        assert (partitions[3] == self.expected[:, [0, 4, 5]]).all()
+        # single ranges are views of the supermatrix
+        assert partitions[0].base is not None
+        assert [get_partition_size(s) for n, s in charsets] == [3, 4, 3, 3]
+        # and rates are sliced the same way
+        rates = numpy.arange(7.)
+        assert get_partition(rates, charsets[2][1]).tolist() == [0., 3., 6.]
+
+    def test_bad_charsets(self):
+        self.assertRaises(AlignmentError, parse_charsets, SETS, 5)
+        self.assertRaises(AlignmentError, parse_charsets, SETS)
+        self.assertRaises(AlignmentError, parse_charsets,
+            "charset a = first;")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+if __name__ == '__main__':
+    unittest.main()
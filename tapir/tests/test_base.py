@@ -45,6 +45,33 @@ class TestTransform(unittest.TestCase):
         assert get_list_from_ranges('1-2,2-3,3-4') == \
                 [[1,2],[2,3],[3,4]]
 
+    def test_get_models(self):
+        assert get_models('all') == 'all'
+        assert get_models('HKY,gtr') == '010010,012345'
+        assert get_models('010020') == '010020'
+        self.assertRaises(argparse.ArgumentTypeError, get_models, 'K80')
+        self.assertRaises(argparse.ArgumentTypeError, get_models, '12345')
+
+    def test_subset_map(self):
+        handle, name = tempfile.mkstemp()
+        with open(name, 'w') as f:
+            f.write("a.nex\t0\t10\nb.nex\t5\t20\tprobe1\na.nex\t10\t30\n")
+        assert get_subset_map(name) == {
+                'a.nex':[('0-10', 0, 10), ('10-30', 10, 30)],
+                'b.nex':[('probe1', 5, 20)],
+            }
+        with open(name, 'w') as f:
+            f.write("a.nex\t0\t10\na.nex\t30\t10\n")
+        self.assertRaises(ValueError, get_subset_map, name)
+        os.close(handle)
+        os.remove(name)
+
+    def test_get_window(self):
+        assert get_window('100') == (100, 100)
+        assert get_window('100,10') == (100, 10)
+        self.assertRaises(argparse.ArgumentTypeError, get_window, '0')
+        self.assertRaises(argparse.ArgumentTypeError, get_window, '1,2,3')
+
     def test_get_files_1(self):
         observed = [os.path.basename(i) for i in
                 get_files(self.loc,'*.nex,*.nexus')]
@@ -58,5 +85,69 @@ class TestTransform(unittest.TestCase):
     def test_get_files_2(self):
         self.assertRaises(IOError, get_files, 'test-data','*.rrwrr')
 
+    def test_iter_files(self):
+        files = iter_files(self.loc, '*.nex,*.nexus')
+        # files are yielded as the directory is read
+        assert not isinstance(files, list)
+        assert sorted(files) == sorted(get_files(self.loc, '*.nex,*.nexus'))
+        assert list(iter_files(os.path.join(self.loc, 'missing'), '*')) == []
+
+    def test_iter_files_stats_matches(self):
+        import tapir.base
+        d = tempfile.mkdtemp()
+        for name in ['a.nex', 'b.nex'] + ['{0}.rates'.format(i) for i in range(20)]:
+            open(os.path.join(d, name), 'w').close()
+        os.mkdir(os.path.join(d, 'c.nex'))
+        stats = []
+        isfile, found = os.path.isfile, tapir.base.scandir
+        def counted(path):
+            stats.append(path)
+            return isfile(path)
+        os.path.isfile, tapir.base.scandir = counted, None
+        try:
+            files = sorted(iter_files(d, '*.nex'))
+        finally:
+            os.path.isfile, tapir.base.scandir = isfile, found
+        assert files == [os.path.join(d, 'a.nex'), os.path.join(d, 'b.nex')]
+        # only the entries that match are stat-ed
+        assert len(stats) == 3
+        shutil.rmtree(d)
+
+    def test_manifest(self):
+        d = tempfile.mkdtemp()
+        name = os.path.join(d, 'manifest.txt')
+        b = os.path.join(self.loc, 'chr1_918.nex')
+        open(os.path.join(d, 'a.nex'), 'w').close()
+        with open(name, 'w') as f:
+            f.write("# loci\na.nex\n{0}\t5\t20\tprobe1\n"
+                "{0}\t20\t30\n\n".format(b))
+        files, subsets = get_manifest(name)
+        assert files == [os.path.join(d, 'a.nex'), b]
+        assert subsets == {'chr1_918.nex':[('probe1', 5, 20), ('20-30', 20, 30)]}
+        shutil.rmtree(d)
+
+    def test_bad_manifest(self):
+        d = tempfile.mkdtemp()
+        name = os.path.join(d, 'manifest.txt')
+        os.mkdir(os.path.join(d, 'other'))
+        for f in ['chr1_918.nex', os.path.join('other', 'chr1_918.nex')]:
+            open(os.path.join(d, f), 'w').close()
+        for lines, error in [
+                ("chr1_918.nex\nmissing.nex\n", IOError),
+                ("chr1_918.nex\nother/chr1_918.nex\n", ValueError),
+                ("chr1_918.nex\t20\t5\n", ValueError),
+            ]:
+            with open(name, 'w') as f:
+                f.write(lines)
+            self.assertRaises(error, get_manifest, name)
+        shutil.rmtree(d)
+
+    def test_get_shard_spec(self):
+        assert get_shard_spec('1/4') == (0, 4)
+        assert get_shard_spec('4/4') == (3, 4)
+        for string in ['0/4', '5/4', '1', 'a/b']:
+            self.assertRaises(argparse.ArgumentTypeError, get_shard_spec,
+                string)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,89 @@
+"""
+File: test_cache.py
+
+Description: test methods for tapir.cache
+
+"""
+
+import os
+import time
+import shutil
+import unittest
+import threading
+import tempfile
+from tapir.cache import *
+from tapir import get_test_files
+from tapir import get_hyphy_conf
+
+#import pdb
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = get_test_files()
+        self.cache = tempfile.mkdtemp()
+        self.alignment = os.path.join(self.loc, 'chr1_918.nex')
+        self.tree = os.path.join(self.loc, 'Euteleost.tree')
+        self.rates = os.path.join(self.loc, 'test-uniform-draw-weights.rates.json')
+
+    def test_cache_key(self):
+        key = get_cache_key(self.alignment, self.tree, get_hyphy_conf(), 'v1')
+        assert key == get_cache_key(self.alignment, self.tree,
+                get_hyphy_conf(), 'v1')
+        assert key != get_cache_key(self.alignment, self.tree,
+                get_hyphy_conf(), 'v2')
+        assert key != get_cache_key(os.path.join(self.loc,
+                'informativeness_cutoff.nex'), self.tree, get_hyphy_conf(), 'v1')
+
+    def test_cache_round_trip(self):
+        output = os.path.join(self.cache, 'output.rates')
+        assert not get_cached_rates(self.cache, 'abcdef', output)
+        put_cached_rates(self.cache, 'abcdef', self.rates)
+        assert get_cached_rates(self.cache, 'abcdef', output)
+        assert open(output).read() == open(self.rates).read()
+
+    def test_concurrent_puts(self):
+        # threads share a pid, so each put needs its own temp file
+        temps = []
+        rename = os.rename
+        def recorded(src, dst):
+            temps.append(src)
+            rename(src, dst)
+        os.rename = recorded
+        try:
+            threads = [threading.Thread(target = put_cached_rates, args = (
+                self.cache, 'abcdef', self.rates)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.rename = rename
+        assert len(set(temps)) == 4
+        entry = get_cache_entry(self.cache, 'abcdef')
+        assert open(entry).read() == open(self.rates).read()
+        assert os.listdir(os.path.dirname(entry)) == [os.path.basename(entry)]
+
+    def test_evict_by_age(self):
+        entry = put_cached_rates(self.cache, 'abcdef', self.rates)
+        stale = time.time() - 10 * 86400
+        os.utime(entry, (stale, stale))
+        put_cached_rates(self.cache, '123456', self.rates)
+        assert evict_cache(self.cache, max_age = 86400) == 1
+        assert not os.path.exists(entry)
+
+    def test_evict_by_size(self):
+        for key in ['aa1111', 'bb2222', 'cc3333']:
+            put_cached_rates(self.cache, key, self.rates)
+        size = os.path.getsize(self.rates)
+        # the least recently used entry goes first
+        lru = get_cache_entry(self.cache, 'bb2222')
+        os.utime(lru, (0, 0))
+        assert evict_cache(self.cache, max_size = 2 * size) == 1
+        assert not os.path.exists(lru)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache)
+
+if __name__ == '__main__':
+    unittest.main()
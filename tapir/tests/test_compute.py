@@ -10,7 +10,9 @@ Copyright 2011 Brant C. Faircloth. All rights reserved.
 
 import os
 import numpy
+import shutil
 import unittest
+import tempfile
 from tapir.compute import *
 from tapir import get_test_files
 
@@ -32,6 +34,28 @@ class TestTransform(unittest.TestCase):
         corrected_expected = self.expected/10.
         assert observed.all() == corrected_expected.all()
 
+    def test_site_rate_sidecar(self):
+        temp = tempfile.mkdtemp()
+        rate_file = os.path.join(temp, 'test.rates')
+        shutil.copy(os.path.join(self.loc,'test-uniform-draw-weights.rates.json'),
+            rate_file)
+        original = open(rate_file).read()
+        parsed = parse_site_rates(rate_file, 10.)
+        # the json is left alone and the rates land in the sidecar
+        assert open(rate_file).read() == original
+        cache = get_site_rate_cache_name(rate_file, 10.)
+        assert os.path.exists(cache)
+        cached = parse_site_rates(rate_file, 10.)
+        assert isinstance(cached, numpy.memmap)
+        numpy.testing.assert_array_equal(parsed, cached)
+        # a new correction factor replaces the stale sidecar
+        parse_site_rates(rate_file, 100.)
+        assert not os.path.exists(cache)
+        # and no temp files are left behind
+        assert sorted(os.listdir(temp)) == ['test.rates', os.path.basename(
+            get_site_rate_cache_name(rate_file, 100.))]
+        shutil.rmtree(temp)
+
     def tearDown(self):
         pass
 
@@ -59,6 +83,85 @@ class TestTownsendAndIntegrationAgainstPhydesign(unittest.TestCase):
                 3
         )
 
+    def test_blocked_net_pi(self):
+        rates = numpy.array(self.rates)
+        rates[::7] = numpy.nan
+        expected = numpy.nansum(get_townsend_pi(self.time, rates), axis = 1)
+        # a tiny ceiling forces blocking over both times and sites
+        for max_memory in [1, 1000, PI_BLOCK_MEMORY]:
+            observed = get_net_pi(self.time, rates, max_memory)
+            assert numpy.allclose(observed, expected)
+        times = get_net_pi_for_times(observed, [10, 20, 50])
+        self.assertAlmostEqual(times[20], expected[20])
+
+    def test_unique_rate_engine(self):
+        # repeat the rates, as gamma categories would
+        rates = numpy.tile(self.rates, 5)
+        epochs = [[0,10], [20,100]]
+        site = get_pi_for_rates(self.time, rates, [10, 20], epochs)
+        unique = get_pi_for_rates(self.time, rates, [10, 20], epochs,
+                engine = 'unique')
+        assert numpy.allclose(site[0], unique[0])
+        self.assertAlmostEqual(site[1][20], unique[1][20])
+        self.assertAlmostEqual(site[2]['0-10']['sum(integral)'],
+                unique[2]['0-10']['sum(integral)'])
+
+    def test_site_pi_index(self):
+        rates = self.rates.copy()
+        rates[3] = numpy.nan
+        times, epochs = [10, 20], [[0,10], [20,100]]
+        index = get_site_pi_index(self.time, rates, times, epochs)
+        subsets = [('a', 0, 50), ('b', 25, 75)] + get_windows(len(rates), 40, 20)
+        results = get_subset_pi(index, times, epochs, subsets)
+        assert [r[0] for r in results] == ['a', 'b', 'window-0-40',
+            'window-20-60', 'window-40-80', 'window-60-100']
+        for name, start, end, step, pi_net, pi_times, pi_epochs in results:
+            net, expected_times, expected_epochs = get_pi_for_rates(self.time,
+                rates[start:end], times, epochs)
+            assert pi_net is None
+            for t in times:
+                self.assertAlmostEqual(pi_times[t], expected_times[t])
+            for span in expected_epochs:
+                self.assertAlmostEqual(pi_epochs[span]['sum(integral)'],
+                    expected_epochs[span]['sum(integral)'])
+
+    def test_subset_net_pi(self):
+        rates = numpy.ravel(self.rates)[:100]
+        times, epochs = [10, 20], [[0,10]]
+        index = get_site_pi_index(self.time, rates, times, epochs)
+        results = get_subset_pi(index, times, epochs, [('a', 10, 60)],
+            self.time, rates)
+        net = get_pi_for_rates(self.time, rates[10:60], times, epochs)[0]
+        assert numpy.allclose(results[0][4], net)
+
+    def test_windows(self):
+        assert get_windows(10, 4) == [('window-0-4', 0, 4), ('window-4-8', 4, 8)]
+        assert get_windows(10, 4, 3)[-1] == ('window-6-10', 6, 10)
+        self.assertRaises(ValueError, get_windows, 10, 0)
+        self.assertRaises(ValueError, get_windows, 10, 4, -1)
+
+    def test_stride_pi(self):
+        times, epochs = [10, 20], [[0,10], [20,100]]
+        results = get_stride_pi(self.time, self.rates, times, epochs, 3)
+        assert [r[0] for r in results] == ['position-1', 'position-2',
+            'position-3']
+        rates = numpy.ravel(self.rates)
+        total = get_pi_for_rates(self.time, rates, times, epochs)
+        for name, start, end, step, pi_net, pi_times, pi_epochs in results:
+            expected = get_pi_for_rates(self.time, rates[start::3], times, epochs)
+            assert numpy.allclose(pi_net, expected[0])
+        # the positions add up to the whole locus
+        assert numpy.allclose(sum([r[4] for r in results]), total[0])
+        self.assertAlmostEqual(sum([r[5][20] for r in results]), total[1][20])
+
+    def test_binned_rate_histogram(self):
+        unique, counts = get_rate_histogram(self.rates, tolerance = 0.01)
+        assert counts.sum() == len(self.rates)
+        assert len(unique) <= len(numpy.unique(self.rates))
+        # every rate is close to one of the bin representatives
+        for rate in self.rates[self.rates > 0]:
+            assert numpy.min(numpy.abs(unique - rate)/unique) <= 0.01
+
     def test_townsend_pi_integration_against_phydesign(self):
         vec_integrate = vectorize(get_integral_over_times)
         # these are values output from phydesign for the uniform-draw-rates
@@ -70,6 +173,23 @@ class TestTownsendAndIntegrationAgainstPhydesign(unittest.TestCase):
             #pdb.set_trace()
             self.assertAlmostEqual(sum(integral), expected[k], 4)
 
+    def test_analytic_integration_against_phydesign(self):
+        expected = [0.93453,0.10628,0.05855,0.12638,1.03698,2.08840]
+        epochs = [[0,10], [10,15], [15,20], [20,30], [20,70], [20,100]]
+        observed = get_net_integral_for_epochs(self.rates, epochs)
+        for k, pair in enumerate(epochs):
+            name = "{0}-{1}".format(pair[0], pair[1])
+            self.assertAlmostEqual(observed[name]['sum(integral)'], expected[k], 4)
+            assert observed[name]['sum(error)'] == 0.
+
+    def test_analytic_integration_against_quad(self):
+        epochs = [[0,10], [10,15], [20,100]]
+        analytic = get_net_integral_for_epochs(self.rates, epochs)
+        quad = get_net_integral_for_epochs(self.rates, epochs, method = 'quad')
+        for name in analytic:
+            self.assertAlmostEqual(analytic[name]['sum(integral)'],
+                quad[name]['sum(integral)'], 8)
+
     def cleanUp(self):
         pass
 
@@ -90,6 +210,50 @@ class TestTreeAdjustment(unittest.TestCase):
     def tearDown(self):
         os.remove(self.observed)
 
+class TestTreePruning(unittest.TestCase):
+    def setUp(self):
+        self.loc = get_test_files()
+        self.temp = tempfile.mkdtemp()
+        depth, correction, self.tree = correct_branch_lengths(
+            os.path.join(self.loc,'Euteleost.tree'), 'newick', self.temp)
+
+    def test_prune_tree(self):
+        taxa = ['oryLat2', 'gasAcu1', 'tetNig2']
+        pruned = prune_tree(self.tree, taxa)
+        assert pruned == get_pruned_tree_name(self.tree, reversed(taxa))
+        observed = dendropy.Tree.get_from_path(pruned, 'newick')
+        assert sorted([l.taxon.label for l in observed.leaf_nodes()]) == sorted(taxa)
+        assert observed.length() == 1.0 + 0.93 + 0.93 + 0.07
+        # loci with the same taxon set share the pruned tree
+        mtime = os.path.getmtime(pruned)
+        assert prune_tree(self.tree, list(reversed(taxa))) == pruned
+        assert os.path.getmtime(pruned) == mtime
+
+    def test_prune_nothing(self):
+        taxa = ['danRer6', 'oryLat2', 'gasAcu1', 'fr2', 'tetNig2']
+        assert prune_tree(self.tree, taxa) == self.tree
+        # the answer is remembered, so the tree isn't read again
+        tree = open(self.tree).read()
+        with open(self.tree, 'w') as f:
+            f.write('not a tree')
+        assert prune_tree(self.tree, list(reversed(taxa))) == self.tree
+        with open(self.tree, 'w') as f:
+            f.write(tree)
+
+    def test_tree_labels(self):
+        tree = os.path.join(self.temp, 'labels.newick')
+        with open(tree, 'w') as f:
+            f.write("((Homo_sapiens:1,'Pan''s troglodytes':1):1,b:2);")
+        expected = set([leaf.taxon.label for leaf in dendropy.Tree.get_from_path(
+            tree, 'newick').leaf_nodes()])
+        assert get_tree_labels(tree) == expected
+
+    def test_prune_missing_taxa(self):
+        self.assertRaises(ValueError, prune_tree, self.tree, ['danRer6', 'zz'])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
 class TestInformativenessCutoff(unittest.TestCase):
     def setUp(self):
         self.threshold = 3
@@ -108,6 +272,27 @@ class TestInformativenessCutoff(unittest.TestCase):
         assert observed_informative_sites.all() == \
             self.expected_informative_sites.all()
 
+    def test_informative_sites_match_stored_values(self):
+        alignment = os.path.join(self.loc, 'chr1_918.nex')
+        observed_informative_sites = get_informative_sites(alignment, self.threshold)
+        numpy.testing.assert_array_equal(observed_informative_sites,
+            self.expected_informative_sites)
+
+    def test_threshold_masks_from_counts(self):
+        alignment = os.path.join(self.loc, 'chr1_918.nex')
+        counts = get_informative_counts(get_alignment_array(alignment))
+        assert counts.max() <= 5
+        for threshold in [1, 3, 4, 5]:
+            numpy.testing.assert_array_equal(get_threshold_mask(counts,
+                threshold), get_informative_sites(alignment, threshold))
+
+    def test_alignment_array(self):
+        alignment = os.path.join(self.loc, 'informativeness_cutoff.nex')
+        sites = get_alignment_array(alignment)
+        assert sites.shape == (5, 4)
+        assert sites.dtype == numpy.uint8
+        assert sites[4].tostring() == b'GGGG'
+
     def test_cull_informative_rates(self):
         alignment = os.path.join(self.loc, 'chr1_918.nex')
         expected_culled = numpy.load(os.path.join(self.loc,
@@ -0,0 +1,244 @@
+"""
+File: test_db.py
+
+Description: test methods for tapir.db
+
+"""
+
+import os
+import numpy
+import shutil
+import unittest
+import tempfile
+from tapir.db import *
+
+#import pdb
+
+class TestDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.temp, 'test.sqlite')
+        self.epochs = {'0-10':{'sum(integral)':1., 'sum(error)':0.}}
+        self.subsets = [('probe1', 0, 10, 1, None, {1:0.2}, self.epochs),
+                ('position-1', 0, 10, 3, numpy.array([0., 0.1]), {1:0.1},
+                self.epochs)]
+        self.locus = ['/path/to/chr1_918.nex', None, 0.1,
+                numpy.array([0., 0.5, 0.25]), {1:0.5}, self.epochs, '010010',
+                self.subsets, 3]
+
+    def test_insert_pi_data(self):
+        conn, c = create_probe_db(self.db_name)
+        insert_pi_data(conn, c, [self.locus])
+        conn.commit()
+        assert get_completed_loci(c) == set(['chr1_918'])
+        c.execute("SELECT threshold FROM loci")
+        assert c.fetchall() == [(3,)]
+        c.execute("SELECT time, pi FROM net ORDER BY time")
+        assert c.fetchall() == [(0, 0.), (1, 0.5), (2, 0.25)]
+        conn.close()
+        assert get_locus_models(self.db_name) == {'chr1_918':'010010'}
+
+    def test_insert_subsets(self):
+        conn, c = create_probe_db(self.db_name)
+        insert_pi_data(conn, c, [self.locus])
+        conn.commit()
+        c.execute('''SELECT loci.locus, subsets.name, start, stop, time, pi FROM
+            loci, subsets, subset_discrete WHERE loci.id = subsets.locus AND
+            subsets.id = subset_discrete.id''')
+        assert c.fetchall() == [('chr1_918', 'probe1', 0, 10, 1, 0.2),
+            ('chr1_918', 'position-1', 0, 10, 1, 0.1)]
+        c.execute("SELECT interval, pi FROM subset_interval")
+        assert c.fetchall() == [('0-10', 1.), ('0-10', 1.)]
+        c.execute("SELECT id, time, pi FROM subset_net")
+        assert c.fetchall() == [(2, 0, 0.), (2, 1, 0.1)]
+        conn.close()
+
+    def test_indexes(self):
+        conn, c = create_probe_db(self.db_name)
+        c.execute("PRAGMA journal_mode")
+        assert c.fetchone()[0] == 'wal'
+        loci = [['locus{0}.nex'.format(i)] + self.locus[1:3] +
+            [numpy.ones(100)] + self.locus[4:] for i in xrange(50)]
+        insert_pi_data(conn, c, [self.locus] + loci)
+        conn.commit()
+        finish_probe_db(conn, c)
+        c.execute("PRAGMA journal_mode")
+        assert c.fetchone()[0] == 'delete'
+        # the compare query reads intervals in order of PI from the index
+        c.execute('''EXPLAIN QUERY PLAN SELECT loci.locus, interval, pi FROM
+            loci, interval WHERE loci.id = interval.id AND interval = '0-10'
+            ORDER BY pi DESC''')
+        plan = ' '.join([row[-1] for row in c.fetchall()])
+        assert 'interval_interval_pi' in plan
+        assert 'TEMP B-TREE' not in plan
+        # and the plot query finds a locus, then its net PI, by index
+        c.execute('''EXPLAIN QUERY PLAN SELECT loci.locus, time, pi FROM loci,
+            net WHERE loci.id = net.id AND locus = 'chr1_918' ''')
+        plan = ' '.join([row[-1] for row in c.fetchall()])
+        assert 'loci_locus' in plan and 'net_id_time' in plan
+        # indexes can be dropped for loading and rebuilt
+        drop_indexes(c)
+        create_indexes(c)
+        conn.close()
+
+    def test_compact_net(self):
+        for dtype in ['float32', 'float64']:
+            db_name = os.path.join(self.temp, dtype + '.sqlite')
+            conn, c = create_probe_db(db_name, compact = True)
+            self.locus[1] = numpy.array([0.5, numpy.nan])
+            self.locus[3] = numpy.array([0., 0.5, -0.1, 1e-40, numpy.nan])
+            insert_pi_data(conn, c, [self.locus], dtype, rates = True)
+            conn.commit()
+            finish_probe_db(conn, c)
+            assert is_compact(c)
+            expected = self.locus[3].astype(NET_DTYPES[dtype]).tolist()
+            # the view decodes blobs into the usual rows
+            c.execute('''SELECT loci.locus, time, pi FROM loci, net WHERE
+                loci.id = net.id AND locus = 'chr1_918' ORDER BY time''')
+            rows = c.fetchall()
+            assert [row[1] for row in rows] == range(5)
+            assert [row[2] for row in rows][:4] == expected[:4]
+            assert rows[4][2] is None
+            # and python reads them as arrays
+            curves = list(get_net_curves(c))
+            assert len(curves) == 1 and curves[0][0] == 'chr1_918'
+            assert curves[0][1].tolist() == range(5)
+            assert curves[0][2][:4].tolist() == expected[:4]
+            rates = list(get_stored_rates(c))
+            assert rates[0][1][0] == 0.5 and numpy.isnan(rates[0][1][1])
+            conn.close()
+        # a compact database can't be resumed as a row database
+        self.assertRaises(ValueError, create_probe_db, db_name, True)
+
+    def test_net_curves_from_rows(self):
+        conn, c = create_probe_db(self.db_name)
+        insert_pi_data(conn, c, [self.locus])
+        conn.commit()
+        assert not is_compact(c)
+        curves = list(get_net_curves(c))
+        assert curves[0][1].tolist() == [0, 1, 2]
+        assert curves[0][2].tolist() == [0., 0.5, 0.25]
+        assert list(get_stored_rates(c)) == []
+        conn.close()
+
+    def test_bytes(self):
+        assert BYTES.split() == ["{0:02X}".format(i) for i in range(256)]
+        # building the table leaves nothing behind in tapir
+        import tapir
+        assert not hasattr(tapir, 'i')
+
+    def test_thresholds(self):
+        conn, c = create_probe_db(self.db_name)
+        insert_pi_data(conn, c, [self.locus])
+        conn.commit()
+        assert get_threshold(c) == 3
+        assert get_threshold(c, 3) == 3
+        self.assertRaises(ValueError, get_threshold, c, 4)
+        other = list(self.locus)
+        other[3] = numpy.array([0., 0.1, 0.2])
+        other[-1] = 4
+        insert_pi_data(conn, c, [other])
+        conn.commit()
+        assert get_thresholds(c) == [3, 4]
+        # loci computed at several thresholds need one chosen
+        self.assertRaises(ValueError, get_threshold, c)
+        curves = list(get_net_curves(c, [4]))
+        assert len(curves) == 1
+        assert curves[0][2].tolist() == [0., 0.1, 0.2]
+        assert len(list(get_net_curves(c))) == 2
+        assert list(get_net_curves(c, [3], ['chr1_917'])) == []
+        curves = list(get_net_curves(c, [3], ['chr1_918']))
+        assert curves[0][2].tolist() == [0., 0.5, 0.25]
+        conn.close()
+
+    def make_shard(self, name, loci, compact = False):
+        db_name = os.path.join(self.temp, name)
+        conn, c = create_probe_db(db_name, compact = compact)
+        insert_pi_data(conn, c, loci, 'float64' if compact else None)
+        conn.commit()
+        finish_probe_db(conn, c)
+        conn.close()
+        return db_name
+
+    def test_merge_databases(self):
+        other = ['/path/to/other.nex'] + self.locus[1:]
+        shards = [self.make_shard('a.sqlite', [self.locus, other]),
+            self.make_shard('b.sqlite', [other, self.locus])]
+        merged = os.path.join(self.temp, 'merged.sqlite')
+        assert merge_databases(merged, shards) == 2
+        conn = sqlite3.connect(merged)
+        c = conn.cursor()
+        c.execute("SELECT id, locus FROM loci ORDER BY id")
+        assert c.fetchall() == [(1, 'chr1_918'), (2, 'other'), (3, 'other'),
+            (4, 'chr1_918')]
+        # keys of loci and subsets are offset past the first shard
+        c.execute("SELECT DISTINCT id FROM net ORDER BY id")
+        assert c.fetchall() == [(1,), (2,), (3,), (4,)]
+        c.execute("SELECT id, locus FROM subsets ORDER BY id")
+        assert c.fetchall() == [(1, 1), (2, 1), (3, 2), (4, 2), (5, 3), (6, 3),
+            (7, 4), (8, 4)]
+        c.execute("SELECT DISTINCT id FROM subset_net ORDER BY id")
+        assert c.fetchall() == [(2,), (4,), (6,), (8,)]
+        assert get_merged_shards(c) == set(shards)
+        conn.close()
+        # merging again skips what is already there
+        self.assertRaises(ValueError, merge_databases, merged, shards)
+        assert merge_databases(merged, shards, resume = True) == 0
+        # and a merged database passes on the shards it was made from
+        remerged = os.path.join(self.temp, 'remerged.sqlite')
+        merge_databases(remerged, [merged])
+        conn = sqlite3.connect(remerged)
+        assert get_merged_shards(conn.cursor()) == set(shards)
+        conn.close()
+
+    def test_merge_inconsistent_databases(self):
+        different = list(self.locus)
+        different[5] = {'0-20':{'sum(integral)':1., 'sum(error)':0.}}
+        shards = [self.make_shard('a.sqlite', [self.locus]),
+            self.make_shard('b.sqlite', [different])]
+        merged = os.path.join(self.temp, 'merged.sqlite')
+        self.assertRaises(ValueError, merge_databases, merged, shards)
+        # the consistent shard was kept
+        conn = sqlite3.connect(merged)
+        assert get_merged_shards(conn.cursor()) == set(shards[:1])
+        conn.close()
+        # and shards must exist, and be PI databases
+        self.assertRaises(IOError, merge_databases, merged, [os.path.join(
+            self.temp, 'missing.sqlite')], True)
+        open(os.path.join(self.temp, 'empty.sqlite'), 'w').close()
+        self.assertRaises(ValueError, merge_databases, merged, [os.path.join(
+            self.temp, 'empty.sqlite')], True)
+        # shards must store net PI the same way
+        compact = self.make_shard('c.sqlite', [self.locus], compact = True)
+        self.assertRaises(ValueError, merge_databases, merged, [compact],
+            True)
+
+    def test_merge_compact_databases(self):
+        shards = [self.make_shard('a.sqlite', [self.locus], True),
+            self.make_shard('b.sqlite', [self.locus], True)]
+        merged = os.path.join(self.temp, 'merged.sqlite')
+        merge_databases(merged, shards)
+        conn = sqlite3.connect(merged)
+        c = conn.cursor()
+        assert is_compact(c)
+        c.execute("SELECT id, time, pi FROM net ORDER BY id, time")
+        assert c.fetchall() == [(1, 0, 0.), (1, 1, 0.5), (1, 2, 0.25),
+            (2, 0, 0.), (2, 1, 0.5), (2, 2, 0.25)]
+        conn.close()
+
+    def test_resume(self):
+        conn, c = create_probe_db(self.db_name)
+        insert_pi_data(conn, c, [self.locus])
+        conn.commit()
+        conn.close()
+        # resuming keeps the loci already stored
+        conn, c = create_probe_db(self.db_name, resume = True)
+        assert get_completed_loci(c) == set(['chr1_918'])
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+File: test_hyphy.py
+
+Description: test methods for tapir.hyphy, using stand-in hyphy executables
+
+"""
+
+import os
+import json
+import stat
+import shutil
+import unittest
+import tempfile
+from distutils.spawn import find_executable
+from tapir.hyphy import *
+from tapir import get_test_files
+from tapir import get_hyphy_conf
+from tapir import get_hyphy_batch_conf
+
+#import pdb
+
+# reads the alignment, tree, and output lines, then writes canned rates
+SUCCEED = """#!/bin/sh
+read alignment; read tree; read output
+cp {rates} "$output"
+"""
+
+HANG = """#!/bin/sh
+exec sleep 30
+"""
+
+# fails the first time it is run, then succeeds
+FLAKY = """#!/bin/sh
+read alignment; read tree; read output
+if [ ! -e {marker} ]; then touch {marker}; echo "Error: flaky"; exit 1; fi
+cp {rates} "$output"
+"""
+
+# in batch mode, only writes the first locus; otherwise acts like SUCCEED
+BATCH = """#!/bin/sh
+case "$1" in
+  *_batch.bf)
+    read template; read tree; read count; read alignment; read output
+    echo "$count" > {marker}
+    cp {rates} "$output" ;;
+  *)
+    read alignment; read tree; read output
+    cp {rates} "$output" ;;
+esac
+"""
+
+# a real hyphy, for the tests of the batch language itself
+HYPHY = find_executable('hyphy2') or find_executable('HYPHYMP')
+
+class TestHyphyRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = get_test_files()
+        self.temp = tempfile.mkdtemp()
+        self.rates = os.path.join(self.loc, 'test-uniform-draw-weights.rates.json')
+        self.output = os.path.join(self.temp, 'test.rates')
+        self.towrite = "\n".join(['alignment', 'tree', self.output, 'all'])
+
+    def stand_in(self, script):
+        path = os.path.join(self.temp, 'hyphy')
+        with open(path, 'w') as f:
+            f.write(script.format(rates = self.rates,
+                marker = os.path.join(self.temp, 'marker')))
+        os.chmod(path, stat.S_IRWXU)
+        return path
+
+    def test_run_hyphy(self):
+        hyphy = self.stand_in(SUCCEED)
+        run_hyphy(hyphy, get_hyphy_conf(), self.towrite, self.output)
+        assert is_complete_rates_file(self.output)
+
+    def test_run_hyphy_timeout(self):
+        hyphy = self.stand_in(HANG)
+        self.assertRaises(HyphyTimeout, run_hyphy, hyphy, get_hyphy_conf(),
+                self.towrite, self.output, timeout = 0.5, poll = 0.05)
+
+    def test_run_hyphy_retry(self):
+        hyphy = self.stand_in(FLAKY)
+        self.assertRaises(HyphyError, run_hyphy, hyphy, get_hyphy_conf(),
+                self.towrite, self.output)
+        os.remove(os.path.join(self.temp, 'marker'))
+        run_hyphy(hyphy, get_hyphy_conf(), self.towrite, self.output,
+                retries = 1)
+        assert is_complete_rates_file(self.output)
+
+    def test_hyphy_not_found(self):
+        self.assertRaises(HyphyNotFound, run_hyphy,
+                os.path.join(self.temp, 'missing'), get_hyphy_conf(),
+                self.towrite, self.output, retries = 3)
+
+    def test_run_hyphy_batch(self):
+        hyphy = self.stand_in(BATCH)
+        jobs = [('alignment{0}'.format(i), os.path.join(self.temp,
+                'test{0}.rates'.format(i)), 'all') for i in range(3)]
+        run_hyphy_batch(hyphy, get_hyphy_batch_conf(), get_hyphy_conf(),
+                'tree', jobs)
+        # one batch of three, then the two loci it missed run on their own
+        assert open(os.path.join(self.temp, 'marker')).read().strip() == '3'
+        for alignment, output, models in jobs:
+            assert is_complete_rates_file(output)
+
+    def test_incomplete_rates_file(self):
+        with open(self.output, 'w') as f:
+            f.write('{"sites": {"rates": [')
+        assert not is_complete_rates_file(self.output)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+@unittest.skipUnless(HYPHY, "needs hyphy")
+class TestModelAveraging(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = get_test_files()
+        self.temp = tempfile.mkdtemp()
+        self.output = os.path.join(self.temp, 'test.rates')
+
+    def test_fixed_model(self):
+        # a single candidate gets all of the Akaike weight, so the averaged
+        # rates are those of HKY: AG = CT, and equal transversions
+        towrite = "\n".join([os.path.join(self.loc, 'chr1_918.nex'),
+                os.path.join(self.loc, 'Euteleost.tree'), self.output, '010010'])
+        run_hyphy(HYPHY, get_hyphy_conf(), towrite, self.output)
+        with open(self.output) as f:
+            sites = json.load(f)['sites']
+        matrix = sites['subs_matrix']
+        assert sites['model'] == '010010'
+        self.assertAlmostEqual(matrix['CT'], matrix['AG'])
+        for rate in ['AT', 'CG', 'GT']:
+            self.assertAlmostEqual(matrix[rate], matrix['AC'])
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+if __name__ == '__main__':
+    unittest.main()
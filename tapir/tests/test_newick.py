@@ -0,0 +1,66 @@
+"""
+File: test_newick.py
+
+Description: test methods for tapir.newick
+
+"""
+
+import os
+import numpy
+import shutil
+import dendropy
+import unittest
+import tempfile
+from tapir.newick import *
+from tapir import get_test_files
+from tapir import correct_branch_lengths
+
+#import pdb
+
+class TestNewick(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = get_test_files()
+        self.temp = tempfile.mkdtemp()
+        self.tree = os.path.join(self.loc, 'Euteleost.tree')
+
+    def test_parse_newick(self):
+        parents, lengths, labels = parse_newick(
+            "((a:1,'b c':2.5)[&comment]x:0.5,d:4);")
+        assert parents.tolist() == [-1, 0, 1, 1, 0]
+        assert labels == ['', 'x', 'a', "'b c'", 'd']
+        assert numpy.isnan(lengths[0])
+        assert lengths[1:].tolist() == [0.5, 1., 2.5, 4.]
+
+    def test_bad_newick(self):
+        for string in ['((a,b);', '(a,b));', '(a:x,b);', '#NEXUS\nbegin trees;']:
+            self.assertRaises(NewickError, parse_newick, string)
+
+    def test_round_trip(self):
+        string = "((a:1.0,'b c':2.5)x:0.5,d:4.0);"
+        assert write_newick(*parse_newick(string)) == string
+
+    def test_tree_stats_against_dendropy(self):
+        depth, length, leaves = get_tree_stats(*get_newick_from_path(self.tree)[:2])
+        tree = dendropy.Tree.get_from_path(self.tree, 'newick')
+        assert depth == tree.seed_node.distance_from_tip()
+        assert numpy.allclose(length, tree.length())
+        assert leaves == len(tree.leaf_nodes())
+
+    def test_correction_against_dendropy(self):
+        fast = correct_branch_lengths(self.tree, 'newick', self.temp)
+        tree = dendropy.Tree.get_from_path(self.tree, 'newick')
+        assert fast[0] == tree.seed_node.distance_from_tip()
+        assert os.path.basename(fast[2]) == 'Tree_{0}_{1}.newick'.format(
+            fast[1], tree.seed_node.distance_from_tip())
+        observed = dendropy.Tree.get_from_path(fast[2], 'newick')
+        for edge in tree.preorder_edge_iter():
+            if edge.length:
+                edge.length /= fast[1]
+        assert observed.as_string('newick') == tree.as_string('newick')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+if __name__ == '__main__':
+    unittest.main()
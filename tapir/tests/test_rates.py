@@ -0,0 +1,143 @@
+"""
+File: test_rates.py
+
+Description: test methods for tapir.rates
+
+"""
+
+import os
+import numpy
+import shutil
+import dendropy
+import unittest
+import tempfile
+from tapir.rates import *
+from tapir import get_test_files
+from tapir import correct_branch_lengths
+
+#import pdb
+
+class TestRates(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = get_test_files()
+        self.temp = tempfile.mkdtemp()
+        self.freqs = numpy.array([0.1, 0.2, 0.3, 0.4])
+        self.Q = get_rate_matrix(numpy.array([1., 2., 1., 1., 3., 1.]),
+            self.freqs)
+        self.eigensystem = get_eigensystem(self.Q, self.freqs)
+
+    def test_rate_matrix(self):
+        assert numpy.allclose(self.Q.sum(1), 0.)
+        # one expected substitution per unit time
+        assert numpy.allclose(-numpy.dot(self.freqs, numpy.diag(self.Q)), 1.)
+        # reversible
+        flux = self.freqs[:, None] * self.Q
+        assert numpy.allclose(flux, flux.T)
+
+    def test_transition_matrices(self):
+        P = get_transition_matrices(self.eigensystem, numpy.array([0., 0.5, 50.]))
+        assert P.shape == (3, 4, 4)
+        assert numpy.allclose(P[0], numpy.eye(4))
+        assert numpy.allclose(P.sum(-1), 1.)
+        assert numpy.allclose(P[2], numpy.tile(self.freqs, (4, 1)))
+
+    def test_states(self):
+        assert STATES[numpy.frombuffer(b'ACGTacgtN-?', dtype = numpy.uint8)].tolist() \
+            == [0, 1, 2, 3, 0, 1, 2, 3, 4, 4, 4]
+        # building the table leaves nothing behind to shadow tapir.base
+        import tapir.base
+        assert tapir.base.__name__ == 'tapir.base'
+
+    def test_site_patterns(self):
+        states = numpy.array([[0, 1, 0, 4], [2, 1, 2, 3]], dtype = numpy.uint8)
+        patterns, counts, inverse = get_site_patterns(states)
+        assert patterns.shape == (2, 3)
+        assert counts.sum() == 4
+        assert (patterns[:, inverse] == states).all()
+
+    def test_two_taxon_likelihood(self):
+        tree = dendropy.Tree.get_from_string('(a:0.2,b:0.3);', 'newick')
+        order = get_pruning_order(tree, ['a', 'b'])
+        patterns = numpy.array([[0, 1], [2, 1]], dtype = numpy.uint8)
+        rates = numpy.array([[0.5, 2.]])
+        lnL = get_pattern_log_likelihoods(order, patterns, self.freqs,
+            self.eigensystem, rates)
+        for k, rate in enumerate(rates[0]):
+            P = get_transition_matrices(self.eigensystem, 0.5 * rate)
+            expected = numpy.log(self.freqs[[0, 1]] * P[[0, 1], [2, 1]])
+            assert numpy.allclose(lnL[:, k], expected)
+        # per-pattern rates give the same answer
+        own = get_pattern_log_likelihoods(order, patterns, self.freqs,
+            self.eigensystem, numpy.array([[0.5], [2.]]))
+        assert numpy.allclose(own[:, 0], [lnL[0, 0], lnL[1, 1]])
+
+    def test_site_rates(self):
+        tree = dendropy.Tree.get_from_string('(((a:0.2,b:0.2):0.2,(c:0.2,d:0.2):0.2):0.2,'
+            '((e:0.2,f:0.2):0.2,(g:0.2,h:0.2):0.2):0.2);', 'newick')
+        labels = list('abcdefgh')
+        # constant, one, two, and three changes, saturated, and without data
+        sites = ['AAAAAAAA', 'AAAAAACC', 'AAAACCGG', 'AACCGGTT', 'ACGTACGT',
+            '--------']
+        states = STATES[numpy.array([[ord(base) for base in site] for site in
+            sites], dtype = numpy.uint8).T]
+        rates = get_site_rates(states, tree, labels, 'F81')
+        assert rates[0] < 1e-3
+        assert rates[0] < rates[1] < rates[2] < rates[3]
+        # no rate can be told from the saturated site, or the one without data
+        assert numpy.isnan(rates[4:]).all()
+        # the ML rate is a maximum
+        order = get_pruning_order(tree, labels)
+        freqs = get_base_frequencies(states)
+        eigensystem = get_eigensystem(get_rate_matrix(numpy.ones(6), freqs),
+            freqs)
+        lnL = get_pattern_log_likelihoods(order, states[:, [1]], freqs,
+            eigensystem, numpy.array([[rates[1] * 0.9, rates[1],
+            rates[1] * 1.1]]))[0]
+        assert lnL[1] >= lnL[0] and lnL[1] >= lnL[2]
+
+    def test_grid_climb(self):
+        lnL = numpy.array([
+                [0., 1., 2., 1., 0.],
+                [2., 1., 0., 1., 3.],
+                [0., 1., 0., 1., 2.],
+            ])
+        assert get_grid_climb(lnL, 2).tolist() == [2, 4, 4]
+        assert get_grid_climb(lnL, 1).tolist() == [2, 0, 1]
+
+    def test_missing_taxa(self):
+        tree = dendropy.Tree.get_from_string('(a:0.2,b:0.3);', 'newick')
+        self.assertRaises(ValueError, get_pruning_order, tree, ['a', 'z'])
+
+    def test_estimate_site_rates(self):
+        alignment = os.path.join(self.loc, 'chr1_918.nex')
+        depth, correction, tree = correct_branch_lengths(os.path.join(self.loc,
+            'Euteleost.tree'), 'newick', self.temp)
+        rates = estimate_site_rates(alignment, tree, correction = correction)
+        assert rates.shape == (226,)
+        assert (rates[~numpy.isnan(rates)] >= 0).all()
+        uncorrected = estimate_site_rates(alignment, tree, 'F81')
+        assert numpy.allclose(estimate_site_rates(alignment, tree, 'F81',
+            correction), uncorrected / correction, equal_nan = True)
+
+    def test_site_rates_against_hyphy(self):
+        # hyphy (as run by phydesign) on the same tree, in the same units
+        expected = numpy.load(os.path.join(self.loc,
+            'chr1_918-test-hyphy-rates.npy'))
+        depth, correction, tree = correct_branch_lengths(os.path.join(self.loc,
+            'Euteleost.tree'), 'newick', self.temp)
+        rates = estimate_site_rates(os.path.join(self.loc, 'chr1_918.nex'),
+            tree)
+        known = ~numpy.isnan(rates)
+        # hyphy puts the sites on a likelihood plateau at arbitrary rates (some
+        # in the hundreds), which we leave undefined
+        assert known.sum() > 150
+        assert numpy.isnan(rates[expected > 30]).all()
+        assert numpy.allclose(rates[known], expected[known], atol = 0.5)
+        assert numpy.corrcoef(rates[known], expected[known])[0, 1] > 0.95
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+if __name__ == '__main__':
+    unittest.main()
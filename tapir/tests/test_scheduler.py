@@ -0,0 +1,76 @@
+"""
+File: test_scheduler.py
+
+Description: test methods for tapir.scheduler
+
+"""
+
+import os
+import unittest
+from tapir.scheduler import *
+from tapir import get_test_files
+
+#import pdb
+
+def square(x):
+    return x * x
+
+def fail(x):
+    raise ValueError("bad item {0}".format(x))
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.loc = get_test_files()
+
+    def test_imap_bounded_serial(self):
+        assert list(imap_bounded(square, range(5))) == [0, 1, 4, 9, 16]
+
+    def test_imap_bounded_parallel(self):
+        observed = imap_bounded(square, range(20), processes = 2,
+                max_pending = 3)
+        assert sorted(observed) == [x * x for x in range(20)]
+
+    def test_imap_bounded_error(self):
+        observed = imap_bounded(fail, range(3), processes = 2)
+        self.assertRaises(Exception, list, observed)
+
+    def test_imap_threaded(self):
+        observed = imap_threaded(square, range(20), threads = 3,
+                max_pending = 2)
+        assert sorted(observed) == [x * x for x in range(20)]
+
+    def test_imap_threaded_error(self):
+        observed = imap_threaded(fail, range(3), threads = 2)
+        self.assertRaises(Exception, list, observed)
+
+    def test_stages(self):
+        # threads feeding processes, as tapir_compute.py does
+        rated = imap_threaded(square, range(10), threads = 2)
+        observed = imap_bounded(square, rated, processes = 2)
+        assert sorted(observed) == [x ** 4 for x in range(10)]
+
+    def test_sort_by_size(self):
+        files = [os.path.join(self.loc, f) for f in ['informativeness_cutoff.nex',
+                'chr1_918.nex', 'test-extension.nexus']]
+        observed = [os.path.basename(f) for f in sort_by_size(files)]
+        assert observed == ['chr1_918.nex', 'informativeness_cutoff.nex',
+                'test-extension.nexus']
+
+    def test_get_shard_items(self):
+        sizes = dict(zip('abcdefg', [7, 5, 4, 3, 3, 2, 1]))
+        shards = [get_shard_items(list('abcdefg'), k, 3, sizes.get,
+            lambda item: item) for k in range(3)]
+        # largest first, each to the shard with the least so far
+        assert shards == [['a', 'f'], ['b', 'e'], ['c', 'd', 'g']]
+        assert [sum([sizes[i] for i in shard]) for shard in shards] == [9, 8, 8]
+        # shards don't depend on the order items are found in
+        assert get_shard_items(list('gfedcba'), 1, 3, sizes.get,
+            lambda item: item) == ['b', 'e']
+
+    def test_get_cores(self):
+        assert get_cores(3) == 3
+        assert get_cores(0) >= 1
+
+if __name__ == '__main__':
+    unittest.main()
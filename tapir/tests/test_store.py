@@ -0,0 +1,92 @@
+"""
+File: test_store.py
+
+Description: test methods for tapir.store
+
+"""
+
+import os
+import numpy
+import shutil
+import unittest
+import tempfile
+from tapir.db import create_probe_db, insert_pi_data
+from tapir.store import *
+
+#import pdb
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp = tempfile.mkdtemp()
+        self.db_name = os.path.join(self.temp, 'test.sqlite')
+        self.path = get_store_path(self.db_name)
+        self.time = numpy.reshape(numpy.arange(3), (-1, 1))
+        self.times = [1, 2]
+        self.epochs = [[0, 1], [1, 3]]
+
+    def get_locus(self, name, value):
+        return [name, None, 0.1, numpy.array([0., value, value / 2.]),
+                {1:value, 2:value / 2.}, {'0-1':{'sum(integral)':value,
+                'sum(error)':0.}, '1-3':{'sum(integral)':2 * value,
+                'sum(error)':0.}}, None, [], 3]
+
+    def write(self, conn, c, pis):
+        store = open_store_for_writing(c, self.path, self.time, self.times,
+            self.epochs)
+        append_to_store(store, c, insert_pi_data(conn, c, pis), pis)
+        return store
+
+    def test_npy_header(self):
+        pth = os.path.join(self.temp, 'test.npy')
+        with open(pth, 'wb') as f:
+            f.write(get_npy_header((2, 3)))
+            f.write(numpy.arange(6.).tostring())
+        assert os.path.getsize(pth) == HEADER_SIZE + 48
+        assert (numpy.load(pth) == numpy.arange(6.).reshape(2, 3)).all()
+
+    def test_store(self):
+        conn, c = create_probe_db(self.db_name)
+        store = self.write(conn, c, [self.get_locus('a.nex', 0.5),
+            self.get_locus('b.nex', 1.)])
+        conn.commit()
+        sync_store(store)
+        close_store(store)
+        loci, matrices, labels = open_store(c, self.path)
+        assert loci == [('a', 3), ('b', 3)]
+        assert isinstance(matrices['net'], numpy.memmap)
+        assert matrices['net'].tolist() == [[0., 0.5, 0.25], [0., 1., 0.5]]
+        assert matrices['times'].tolist() == [[0.5, 0.25], [1., 0.5]]
+        assert matrices['epochs'].tolist() == [[0.5, 1.], [1., 2.]]
+        assert labels['net'].tolist() == [0, 1, 2]
+        assert labels['epochs'].tolist() == ['0-1', '1-3']
+        conn.close()
+
+    def test_resume_store(self):
+        conn, c = create_probe_db(self.db_name)
+        store = self.write(conn, c, [self.get_locus('a.nex', 0.5)])
+        conn.commit()
+        sync_store(store)
+        # an interrupted batch: written to the store, but never committed
+        append_to_store(store, c, insert_pi_data(conn, c,
+            [self.get_locus('b.nex', 1.)]), [self.get_locus('b.nex', 1.)])
+        close_store(store)
+        conn.rollback()
+        store = self.write(conn, c, [self.get_locus('c.nex', 2.)])
+        conn.commit()
+        sync_store(store)
+        close_store(store)
+        loci, matrices, labels = open_store(c, self.path)
+        assert [locus for locus, threshold in loci] == ['a', 'c']
+        assert matrices['net'][:, 1].tolist() == [0.5, 2.]
+        # the shape of a store is fixed once it is made
+        self.times = [1]
+        self.assertRaises(ValueError, open_store_for_writing, c, self.path,
+            self.time, self.times, self.epochs)
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+if __name__ == '__main__':
+    unittest.main()